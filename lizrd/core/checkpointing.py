@@ -0,0 +1,170 @@
+import time
+from typing import Dict, List, Optional
+
+import torch
+
+from lizrd.core.misc import Checkpoint, propagate_forward_pass_cache
+
+CHECKPOINTING_POLICIES = ["all", "every_k_blocks", "attention", "feedforward", "auto"]
+
+
+def get_checkpoints(model: torch.nn.Module) -> List[Checkpoint]:
+    return [module for module in model.modules() if isinstance(module, Checkpoint)]
+
+
+def should_checkpoint(
+    checkpoint: Checkpoint, policy: str, every_k_blocks: int = 1
+) -> bool:
+    """
+    Static policies, `checkpoint` wraps a residual sublayer of `TransformerBlock`, tagged with its `layer_type`
+    and `block_number`. `auto` starts from checkpointing everything, until `fit_checkpointing_to_memory_budget`.
+    """
+    if policy in ["all", "auto"]:
+        return True
+    elif policy == "every_k_blocks":
+        return checkpoint.block_number % every_k_blocks == 0
+    elif policy in ["attention", "feedforward"]:
+        return checkpoint.layer_type == policy
+    else:
+        raise ValueError(f"Unknown checkpointing policy: {policy}")
+
+
+def apply_checkpointing_policy(
+    model: torch.nn.Module, policy: str, every_k_blocks: int = 1
+):
+    for checkpoint in get_checkpoints(model):
+        checkpoint.enabled = should_checkpoint(checkpoint, policy, every_k_blocks)
+
+
+def measure_checkpoints(
+    model: torch.nn.Module,
+    example_input: torch.Tensor,
+    batch_size: Optional[int] = None,
+    mixed_precision: bool = False,
+) -> Dict[Checkpoint, dict]:
+    """
+    Runs a forward pass of `model` without checkpointing and measures for every `Checkpoint`
+    the bytes of activations that checkpointing it would free, i.e. tensors its sublayer saves for backward
+    except for its input, which the checkpoint keeps, and the seconds of its forward, the cost of recomputing it.
+    Under `None` are the bytes that stay in memory with any checkpointing, saved outside of checkpoints
+    or inputs of checkpoints.
+    Without checkpointing the full batch might not fit, so `example_input` can be a few sequences only,
+    and the measurements are scaled linearly to `batch_size` sequences.
+    """
+    if batch_size is None:
+        batch_size = example_input.shape[0]
+    checkpoints = get_checkpoints(model)
+    enabled = [checkpoint.enabled for checkpoint in checkpoints]
+    parameter_storages = {
+        parameter.untyped_storage().data_ptr() for parameter in model.parameters()
+    }
+    saved_storages = {checkpoint: set() for checkpoint in checkpoints + [None]}
+    stats = {
+        checkpoint: {"bytes": 0, "seconds": 0.0} for checkpoint in checkpoints + [None]
+    }
+    current = [None]
+
+    def synchronize():
+        if example_input.device.type == "cuda":
+            torch.cuda.synchronize(example_input.device)
+
+    def pre_hook(checkpoint, inputs):
+        synchronize()
+        current[0] = checkpoint
+        # the input of a checkpointed sublayer stays in memory, it is counted outside of checkpoints
+        storage = inputs[0].untyped_storage()
+        saved_storages[checkpoint].add(storage.data_ptr())
+        if storage.data_ptr() not in saved_storages[None]:
+            saved_storages[None].add(storage.data_ptr())
+            stats[None]["bytes"] += storage.nbytes()
+        stats[checkpoint]["start"] = time.time()
+
+    def post_hook(checkpoint, inputs, output):
+        synchronize()
+        stats[checkpoint]["seconds"] += time.time() - stats[checkpoint].pop("start")
+        current[0] = None
+
+    def pack_hook(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in parameter_storages and (
+            storage.data_ptr() not in saved_storages[current[0]]
+        ):
+            saved_storages[current[0]].add(storage.data_ptr())
+            stats[current[0]]["bytes"] += storage.nbytes()
+        return tensor
+
+    handles = []
+    for checkpoint in checkpoints:
+        checkpoint.enabled = False
+        handles.append(checkpoint.register_forward_pre_hook(pre_hook))
+        handles.append(checkpoint.register_forward_hook(post_hook))
+    if getattr(model, "forward_pass_cache", None) is None:
+        propagate_forward_pass_cache(model)
+    # the cache is shared with the training step, keep its entries out of the measurement
+    cached = dict(model.forward_pass_cache)
+    model.forward_pass_cache.clear()
+    try:
+        with torch.autograd.graph.saved_tensors_hooks(pack_hook, lambda x: x):
+            with torch.autocast(
+                device_type="cuda", enabled=mixed_precision, dtype=torch.float16
+            ):
+                model(example_input)
+    finally:
+        for handle in handles:
+            handle.remove()
+        for checkpoint, was_enabled in zip(checkpoints, enabled):
+            checkpoint.enabled = was_enabled
+        model.forward_pass_cache.clear()
+        model.forward_pass_cache.update(cached)
+
+    scale = batch_size / example_input.shape[0]
+    return {
+        checkpoint: {
+            "bytes": int(stat["bytes"] * scale),
+            "seconds": stat["seconds"] * scale,
+        }
+        for checkpoint, stat in stats.items()
+    }
+
+
+def fit_checkpointing_to_memory_budget(
+    model: torch.nn.Module,
+    example_input: torch.Tensor,
+    memory_budget_bytes: int,
+    batch_size: Optional[int] = None,
+    mixed_precision: bool = False,
+    stats: Optional[Dict[Checkpoint, dict]] = None,
+) -> List[Checkpoint]:
+    """
+    Checkpoints the fewest sublayers that bring the activations of a forward pass on `batch_size` sequences
+    like `example_input` within `memory_budget_bytes`, taking first the ones freeing the most memory
+    per second of recompute, so throughput only drops by what is needed to fit.
+    Returns the checkpointed sublayers.
+    """
+    if stats is None:
+        stats = measure_checkpoints(
+            model, example_input, batch_size, mixed_precision=mixed_precision
+        )
+    checkpoints = get_checkpoints(model)
+    excess_bytes = sum(stat["bytes"] for stat in stats.values()) - memory_budget_bytes
+    candidates = sorted(
+        checkpoints,
+        key=lambda checkpoint: stats[checkpoint]["bytes"]
+        / max(stats[checkpoint]["seconds"], 1e-9),
+        reverse=True,
+    )
+
+    selected = []
+    for checkpoint in candidates:
+        if excess_bytes <= 0:
+            break
+        selected.append(checkpoint)
+        excess_bytes -= stats[checkpoint]["bytes"]
+    if excess_bytes > 0:
+        print(
+            f"Checkpointing every sublayer leaves activations {excess_bytes / 2**20:.1f} MB over the budget"
+        )
+
+    for checkpoint in checkpoints:
+        checkpoint.enabled = checkpoint in selected
+    return selected
@@ -0,0 +1,146 @@
+from typing import Optional, Tuple
+
+import torch
+
+from lizrd.core import nn
+from lizrd.support import ash
+
+
+def get_head_logits(
+    hidden: torch.Tensor,
+    weight: torch.Tensor,
+    bias: Optional[torch.Tensor],
+    begin: int,
+    end: int,
+) -> torch.Tensor:
+    """Float32 logits of vocabulary entries `begin:end`, the matmul runs in the dtype of `hidden`."""
+    logits = (hidden @ weight[begin:end].to(hidden.dtype).T).float()
+    if bias is not None:
+        logits = logits + bias[begin:end].float()
+    return logits
+
+
+class ChunkedHeadCrossEntropy(torch.autograd.Function):
+    """
+    Cross-entropy of a linear head, computed over chunks of `vocab_chunk_size` vocabulary entries.
+    The log-sum-exp is accumulated online, so at most `(n_tokens, vocab_chunk_size)` logits exist at a time,
+    in forward and in backward, where the logits of every chunk are recomputed.
+    Returns the loss of every token and the argmax of its logits.
+    """
+
+    @staticmethod
+    def forward(
+        ctx,
+        hidden: torch.Tensor,
+        weight: torch.Tensor,
+        bias: Optional[torch.Tensor],
+        targets: torch.Tensor,
+        vocab_chunk_size: int,
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        n_tokens, vocab_size = hidden.shape[0], weight.shape[0]
+        rows = torch.arange(n_tokens, device=hidden.device)
+        running_max = torch.full(
+            (n_tokens,), float("-inf"), device=hidden.device, dtype=torch.float32
+        )
+        running_sum = torch.zeros_like(running_max)
+        target_logits = torch.zeros_like(running_max)
+        best_logits = torch.full_like(running_max, float("-inf"))
+        predictions = torch.zeros(n_tokens, dtype=torch.long, device=hidden.device)
+
+        for begin in range(0, vocab_size, vocab_chunk_size):
+            end = min(begin + vocab_chunk_size, vocab_size)
+            logits = get_head_logits(hidden, weight, bias, begin, end)
+
+            chunk_max, chunk_argmax = logits.max(dim=-1)
+            new_max = torch.maximum(running_max, chunk_max)
+            running_sum = running_sum * torch.exp(running_max - new_max) + torch.exp(
+                logits - new_max[:, None]
+            ).sum(dim=-1)
+            running_max = new_max
+
+            in_chunk = (targets >= begin) & (targets < end)
+            target_logits = torch.where(
+                in_chunk,
+                logits[rows, (targets - begin).clamp(0, end - begin - 1)],
+                target_logits,
+            )
+            # strictly greater keeps the first maximum, like argmax over the whole vocabulary
+            is_better = chunk_max > best_logits
+            best_logits = torch.where(is_better, chunk_max, best_logits)
+            predictions = torch.where(is_better, chunk_argmax + begin, predictions)
+
+        log_sum_exp = running_max + torch.log(running_sum)
+        ctx.save_for_backward(hidden, weight, bias, targets, log_sum_exp)
+        ctx.vocab_chunk_size = vocab_chunk_size
+        ctx.mark_non_differentiable(predictions)
+        return log_sum_exp - target_logits, predictions
+
+    @staticmethod
+    def backward(ctx, grad_loss: torch.Tensor, grad_predictions: torch.Tensor):
+        hidden, weight, bias, targets, log_sum_exp = ctx.saved_tensors
+        vocab_chunk_size = ctx.vocab_chunk_size
+        n_tokens, vocab_size = hidden.shape[0], weight.shape[0]
+        rows = torch.arange(n_tokens, device=hidden.device)
+        grad_hidden = torch.zeros(
+            hidden.shape, dtype=torch.float32, device=hidden.device
+        )
+        grad_weight = torch.zeros(
+            weight.shape, dtype=torch.float32, device=weight.device
+        )
+        grad_bias = (
+            torch.zeros(bias.shape, dtype=torch.float32, device=bias.device)
+            if bias is not None
+            else None
+        )
+        grad_loss = grad_loss.float()
+
+        for begin in range(0, vocab_size, vocab_chunk_size):
+            end = min(begin + vocab_chunk_size, vocab_size)
+            logits = get_head_logits(hidden, weight, bias, begin, end)
+            # d loss / d logits = softmax - one_hot(target)
+            grad_logits = torch.exp(logits - log_sum_exp[:, None])
+            in_chunk = (targets >= begin) & (targets < end)
+            grad_logits[rows[in_chunk], targets[in_chunk] - begin] -= 1.0
+            grad_logits *= grad_loss[:, None]
+
+            grad_hidden += grad_logits @ weight[begin:end].float()
+            grad_weight[begin:end] = grad_logits.T @ hidden.float()
+            if grad_bias is not None:
+                grad_bias[begin:end] = grad_logits.sum(dim=0)
+
+        return (
+            grad_hidden.to(hidden.dtype),
+            grad_weight.to(weight.dtype),
+            grad_bias.to(bias.dtype) if grad_bias is not None else None,
+            None,
+            None,
+        )
+
+
+def unwrap_shape_checks(module: nn.Module) -> nn.Module:
+    while isinstance(module, ash.Check):
+        module = module.layer
+    return module
+
+
+def chunked_head_cross_entropy(
+    hidden: torch.Tensor,
+    head: nn.Module,
+    targets: torch.Tensor,
+    vocab_chunk_size: int,
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Loss and argmax prediction of every token for `head` applied to `hidden`, without materializing the logits.
+    `head` has to be a linear layer, e.g. `llm.PredictionHead`.
+    """
+    linear = unwrap_shape_checks(head)
+    assert isinstance(linear, torch.nn.Linear), f"Expected a linear head, got {linear}"
+    hidden = hidden.to(linear.weight.device)
+    loss, predictions = ChunkedHeadCrossEntropy.apply(
+        hidden.reshape(-1, hidden.shape[-1]),
+        linear.weight,
+        linear.bias,
+        targets.to(linear.weight.device).reshape(-1).long(),
+        vocab_chunk_size,
+    )
+    return loss.reshape(targets.shape), predictions.reshape(targets.shape)
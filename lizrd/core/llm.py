@@ -1,11 +1,12 @@
 from collections import OrderedDict
-from typing import Literal, Callable, Optional
+from typing import Dict, Literal, Callable, Optional, Tuple
 from functools import partial
 
 import torch
 
 import lizrd.core.nn as nn
 from lizrd.core import misc
+from lizrd.core.checkpointing import apply_checkpointing_policy
 from lizrd.core.misc import Checkpoint, default
 from lizrd.support import ash
 
@@ -128,102 +129,295 @@ def LowRank(dinput, doutput, dlowrank):
     )
 
 
+def get_same_document_mask(module: nn.Module) -> Optional[torch.Tensor]:
+    """
+    `(..., 1, L, L)` mask of token pairs from the same document, so that documents packed
+    into one sequence don't attend to each other. Document ids of the tokens are taken from
+    `forward_pass_cache["document_ids"]`, without them the whole sequence is one document and None is returned.
+    """
+    forward_pass_cache = getattr(module, "forward_pass_cache", None) or {}
+    document_ids = forward_pass_cache.get("document_ids")
+    if document_ids is None:
+        return None
+    return document_ids[..., None, :, None] == document_ids[..., None, None, :]
+
+
+def mask_other_documents(module: nn.Module, attention_scores: torch.Tensor):
+    """Masks out, in place, keys from other documents than the query's, see `get_same_document_mask`."""
+    same_document = get_same_document_mask(module)
+    if same_document is None:
+        return
+    same_document = same_document.to(attention_scores.device)
+    attention_scores.masked_fill_(~same_document, float("-inf"))
+
+
+class KVCache:
+    """
+    Keys and values of the tokens processed so far by every `CausalAttention` layer, for incremental decoding.
+    Put in `forward_pass_cache["kv_cache"]`, each forward pass then only processes the new tokens
+    and attends to the cached ones. `position_offset` is the number of tokens already processed,
+    advance it after every forward pass.
+    With `padding_lengths`, sequences of the batch are left-padded with that many tokens:
+    padding is never attended to and positions of every sequence start after its padding.
+    """
+
+    def __init__(self, padding_lengths: Optional[torch.Tensor] = None):
+        self.keys_values: Dict[nn.Module, Tuple[torch.Tensor, torch.Tensor]] = {}
+        self.position_offset = 0
+        self.padding_lengths = padding_lengths
+
+    def update(
+        self, layer: nn.Module, k: torch.Tensor, v: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Appends the new keys and values of the layer, returns all of them."""
+        if layer in self.keys_values:
+            cached_k, cached_v = self.keys_values[layer]
+            k = torch.cat([cached_k, k], dim=-3)
+            v = torch.cat([cached_v, v], dim=-3)
+        self.keys_values[layer] = (k, v)
+        return k, v
+
+    def advance(self, n_tokens: int):
+        self.position_offset += n_tokens
+
+    def get_positions(self, n_tokens: int, device: torch.device) -> torch.Tensor:
+        positions = torch.arange(
+            self.position_offset, self.position_offset + n_tokens, device=device
+        )
+        if self.padding_lengths is None:
+            return positions
+        # padding tokens get position 0, their outputs are never used
+        return (positions - self.padding_lengths.to(device)[:, None]).clamp(min=0)
+
+    def get_padding_mask(
+        self, n_keys: int, device: torch.device
+    ) -> Optional[torch.Tensor]:
+        """`(batch, n_keys)` mask of padding keys, None without padding."""
+        if self.padding_lengths is None:
+            return None
+        keys = torch.arange(n_keys, device=device)
+        return keys < self.padding_lengths.to(device)[:, None]
+
+    def mask_padding(self, attention_scores: torch.Tensor):
+        """Masks out padding keys in place, with a finite value so that rows of padding queries are not NaN."""
+        is_padding = self.get_padding_mask(
+            attention_scores.shape[-1], attention_scores.device
+        )
+        if is_padding is None:
+            return
+        attention_scores.masked_fill_(
+            is_padding[:, None, None, :], torch.finfo(attention_scores.dtype).min
+        )
+
+
+def get_kv_cache(module: nn.Module) -> Optional[KVCache]:
+    forward_pass_cache = getattr(module, "forward_pass_cache", None) or {}
+    return forward_pass_cache.get("kv_cache")
+
+
+ATTENTION_BACKENDS = ["einsum", "sdpa"]
+
+
+def einsum_attention(
+    module: nn.Module,
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    causal: bool,
+    kv_cache: Optional[KVCache],
+) -> torch.Tensor:
+    """Reference implementation, materializes the `h l L` attention matrix."""
+    a = torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
+    a = a * (1 / q.shape[-1] ** 0.5)
+    if causal:
+        # queries are the last `l` of `L` tokens, the diagonal is shifted when keys are cached
+        a.masked_fill_(
+            torch.tril(torch.ones_like(a), diagonal=a.shape[-1] - a.shape[-2]) == 0,
+            float("-inf"),
+        )  # mask out future tokens
+    if kv_cache is not None:
+        kv_cache.mask_padding(a)
+    elif module.mask_document_boundaries:
+        mask_other_documents(module, a)
+    a = torch.softmax(a, dim=-1)
+    return torch.einsum("... h l L, ... L h d -> ... l h d", a, v)
+
+
+def sdpa_attention(
+    module: nn.Module,
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    causal: bool,
+    kv_cache: Optional[KVCache],
+) -> torch.Tensor:
+    """
+    `torch.nn.functional.scaled_dot_product_attention`, which can use fused kernels that never materialize
+    the attention matrix. A plain causal mask is passed as `is_causal`, other masks are built as boolean masks.
+    """
+    n_queries, n_keys = q.shape[-3], k.shape[-3]
+    allowed = None
+    if causal and kv_cache is not None:
+        # queries are the last `n_queries` of `n_keys` tokens
+        allowed = torch.ones(n_queries, n_keys, dtype=torch.bool, device=q.device)
+        allowed = torch.tril(allowed, diagonal=n_keys - n_queries)
+    if kv_cache is None and module.mask_document_boundaries:
+        same_document = get_same_document_mask(module)
+        if same_document is not None:
+            same_document = same_document.to(q.device)
+            if causal:
+                same_document = torch.tril(same_document)
+            allowed = same_document
+    if kv_cache is not None:
+        is_padding = kv_cache.get_padding_mask(n_keys, q.device)
+        if is_padding is not None:
+            # padding queries attend to themselves only, rows without any allowed key would be NaN
+            keys = torch.arange(n_keys, device=q.device)
+            is_own_key = keys == (n_keys - n_queries + keys[:n_queries, None])
+            allowed = allowed & (~is_padding[:, None, None, :] | is_own_key)
+    output = torch.nn.functional.scaled_dot_product_attention(
+        q.transpose(-3, -2),
+        k.transpose(-3, -2),
+        v.transpose(-3, -2),
+        attn_mask=allowed,
+        is_causal=causal and allowed is None,
+    )
+    return output.transpose(-3, -2)
+
+
+def attend(
+    module: nn.Module,
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    causal: bool,
+    kv_cache: Optional[KVCache] = None,
+) -> torch.Tensor:
+    if module.attention_backend == "einsum":
+        return einsum_attention(module, q, k, v, causal, kv_cache)
+    elif module.attention_backend == "sdpa":
+        return sdpa_attention(module, q, k, v, causal, kv_cache)
+    else:
+        raise ValueError(f"Unknown attention backend: {module.attention_backend}")
+
+
+class FusedQKVProjection(nn.Module):
+    """
+    Queries, keys and values computed with a single matmul, weights are initialized
+    like three separate `... dmodel -> ... heads dhead` EinMix layers.
+    """
+
+    def __init__(self, dmodel, heads, dhead):
+        super().__init__()
+        self.heads = heads
+        self.dhead = dhead
+        self.layer = misc.Linear(dmodel, 3 * heads * dhead, bias=True)
+
+    def forward(self, x) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        qkv = self.layer(x)
+        qkv = qkv.view(*qkv.shape[:-1], 3, self.heads, self.dhead)
+        return qkv.unbind(dim=-3)
+
+
+def convert_einmix_attention_state_dict(state_dict: dict, prefix: str):
+    """
+    Converts, in place, weights of attention saved with separate Q, K, V and D EinMix layers
+    to the fused layout, so that old checkpoints can still be loaded.
+    """
+    if f"{prefix}Q.layer.weight" not in state_dict:
+        return
+    weights, biases = [], []
+    for name in ["Q", "K", "V"]:
+        weight = state_dict.pop(f"{prefix}{name}.layer.weight")
+        weights.append(weight.reshape(weight.shape[0], -1).T)
+        biases.append(state_dict.pop(f"{prefix}{name}.layer.bias").reshape(-1))
+    state_dict[f"{prefix}input_projection.layer.weight"] = torch.cat(weights)
+    state_dict[f"{prefix}input_projection.layer.bias"] = torch.cat(biases)
+    weight = state_dict.pop(f"{prefix}D.layer.weight")
+    state_dict[f"{prefix}output_projection.weight"] = weight.reshape(
+        -1, weight.shape[-1]
+    ).T
+    state_dict[f"{prefix}output_projection.bias"] = state_dict.pop(
+        f"{prefix}D.layer.bias"
+    )
+
+
+def merge_heads(x: torch.Tensor) -> torch.Tensor:
+    return x.reshape(*x.shape[:-2], -1)
+
+
 @ash.check("... d -> ... d")
 class Attention(nn.Module):
-    def __init__(self, dmodel, heads, dhead=None):
+    def __init__(
+        self,
+        dmodel,
+        heads,
+        dhead=None,
+        mask_document_boundaries=False,
+        attention_backend: Literal["einsum", "sdpa"] = "einsum",
+    ):
         super(Attention, self).__init__()
         if dhead is None:
             assert dmodel % heads == 0
             dhead = dmodel // heads
+        assert attention_backend in ATTENTION_BACKENDS, attention_backend
 
         self.heads = heads
         self.dhead = dhead
         self.dmodel = dmodel
+        self.mask_document_boundaries = mask_document_boundaries
+        self.attention_backend = attention_backend
 
-        key_query_value_gen = lambda: misc.EinMix(
-            "... dmodel -> ... heads dhead",
-            weight_shape="dmodel heads dhead",
-            bias_shape="heads dhead",
-            dmodel=dmodel,
-            heads=heads,
-            dhead=dhead,
-        )
+        self.input_projection = FusedQKVProjection(dmodel, heads, dhead)
+        self.output_projection = misc.Linear(heads * dhead, dmodel, bias=True)
 
-        self.Q = key_query_value_gen()
-        self.K = key_query_value_gen()
-        self.V = key_query_value_gen()
-
-        combine_gen = lambda: misc.EinMix(
-            "... heads dhead -> ... dmodel",
-            weight_shape="heads dhead dmodel",
-            bias_shape="dmodel",
-            dmodel=dmodel,
-            heads=heads,
-            dhead=dhead,
-        )
-        self.D = combine_gen()
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_einmix_attention_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        q = self.Q(x)
-        k = self.K(x)
-        v = self.V(x)
-
-        a = torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
-        a = a * (1 / self.dhead**0.5)
-        a = torch.softmax(a, dim=-1)
-        prefinal = torch.einsum("... h l L, ... L h d -> ... l h d", a, v)
-        output = self.D(prefinal)
+        q, k, v = self.input_projection(x)
+        prefinal = attend(self, q, k, v, causal=False)
+        output = self.output_projection(merge_heads(prefinal))
         return output
 
 
 @ash.check("... d -> ... d")
 class CausalAttention(nn.Module):
-    def __init__(self, dmodel, heads, dhead=None):
+    def __init__(
+        self,
+        dmodel,
+        heads,
+        dhead=None,
+        mask_document_boundaries=False,
+        attention_backend: Literal["einsum", "sdpa"] = "einsum",
+    ):
         super(CausalAttention, self).__init__()
         if dhead is None:
             assert dmodel % heads == 0
             dhead = dmodel // heads
+        assert attention_backend in ATTENTION_BACKENDS, attention_backend
 
         self.heads = heads
         self.dhead = dhead
         self.dmodel = dmodel
+        self.mask_document_boundaries = mask_document_boundaries
+        self.attention_backend = attention_backend
 
-        key_query_value_gen = lambda: misc.EinMix(
-            "... dmodel -> ... heads dhead",
-            weight_shape="dmodel heads dhead",
-            bias_shape="heads dhead",
-            dmodel=dmodel,
-            heads=heads,
-            dhead=dhead,
-        )
+        self.input_projection = FusedQKVProjection(dmodel, heads, dhead)
+        self.output_projection = misc.Linear(heads * dhead, dmodel, bias=True)
 
-        self.Q = key_query_value_gen()
-        self.K = key_query_value_gen()
-        self.V = key_query_value_gen()
-
-        combine_gen = lambda: misc.EinMix(
-            "... heads dhead -> ... dmodel",
-            weight_shape="heads dhead dmodel",
-            bias_shape="dmodel",
-            dmodel=dmodel,
-            heads=heads,
-            dhead=dhead,
-        )
-        self.D = combine_gen()
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        convert_einmix_attention_state_dict(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        q = self.Q(x)
-        k = self.K(x)
-        v = self.V(x)
-
-        a = torch.einsum("... l h d, ... L h d -> ... h l L", q, k)
-        a = a * (1 / self.dhead**0.5)
-        a.masked_fill_(
-            torch.tril(torch.ones_like(a)) == 0, float("-inf")
-        )  # mask out future tokens
-        a = torch.softmax(a, dim=-1)
-        prefinal = torch.einsum("... h l L, ... L h d -> ... l h d", a, v)
-        output = self.D(prefinal)
+        q, k, v = self.input_projection(x)
+        kv_cache = get_kv_cache(self)
+        if kv_cache is not None:
+            k, v = kv_cache.update(self, k, v)
+        prefinal = attend(self, q, k, v, causal=True, kv_cache=kv_cache)
+        output = self.output_projection(merge_heads(prefinal))
         return output
 
 
@@ -271,6 +465,10 @@ def TransformerBlock(dmodel, layers, gradient_checkpointing, residual_fn):
     residual_layers = [residual_fn(layer=layer, name=name) for name, layer in layers]
     if gradient_checkpointing:
         residual_layers = [Checkpoint(layer) for layer in residual_layers]
+        # checkpointing policies choose sublayers by type and block
+        for checkpoint, (name, layer) in zip(residual_layers, layers):
+            checkpoint.layer_type = name
+            checkpoint.block_number = getattr(layer, "block_number", 0)
     return nn.Sequential(*residual_layers)
 
 
@@ -285,6 +483,8 @@ class TransformerTower(nn.Module):
         device: torch.device = None,
         model_fragmentation: Optional[list[int]] = None,
         residual_fn: Optional[Callable] = None,
+        checkpointing_policy: str = "all",
+        checkpoint_every_k_blocks: int = 1,
     ):
         super().__init__()
         misc.check_layer_funs(*layer_dict.values())
@@ -312,6 +512,10 @@ class TransformerTower(nn.Module):
             )
             self.blocks.append(name_and_block)
         self.blocks = nn.Sequential(OrderedDict(self.blocks))
+        if gradient_checkpointing:
+            apply_checkpointing_policy(
+                self, checkpointing_policy, checkpoint_every_k_blocks
+            )
 
     def forward(self, x):
         for i, block in enumerate(self.blocks):
@@ -347,7 +551,11 @@ class PositionalEmbedding(nn.Module):
         # TODO(jaszczur): add initialization as positional encoding
 
     def forward(self, x):
-        positions = torch.arange(0, x.shape[-1], device=x.device)
+        kv_cache = get_kv_cache(self)
+        if kv_cache is not None:
+            positions = kv_cache.get_positions(x.shape[-1], x.device)
+        else:
+            positions = torch.arange(0, x.shape[-1], device=x.device)
         positions = positions * torch.ones_like(x)
         embeddings = self.layer(positions)
         return embeddings
@@ -387,5 +595,11 @@ class LLM(nn.Module):
         )
         self.head = head
 
-    def forward(self, *args, **kwargs):
-        return self.full_model.forward(*args, **kwargs)
+    def forward(self, x, apply_head: bool = True):
+        """
+        With `apply_head=False` returns the encoder output, for losses that apply the head themselves.
+        They still have to go through `forward`, so that wrappers like DDP see the whole computation.
+        """
+        if not apply_head:
+            return self.encoder(x)
+        return self.full_model.forward(x)
@@ -54,6 +54,15 @@ class EinMix(nn.Module):
         if "..." in signature:
             self.change_anything = True
             self.og_signature = signature
+            beginning, end = signature.split("->")
+            beginning = beginning.split()
+            end = end.split()
+            assert beginning[0] == end[0] == "..."
+            # TODO(jaszczur): fix this hack below, properly
+            # parsed once here, so forward is only tensor ops and traces without graph breaks
+            self.n_non_ellipsis_dims = (
+                len(beginning) - 1 - (1 if "(" in "".join(beginning) else 0)
+            )
             signature = signature.replace("...", "squeezed")
         self.layer = OGEinMix(
             signature, weight_shape=weight_shape, bias_shape=bias_shape, **kwargs
@@ -65,19 +74,11 @@ class EinMix(nn.Module):
         if not self.change_anything:
             return self.layer(x)
         # else
-        beginning, end = self.og_signature.split("->")
-        beginning = beginning.split()
-        end = end.split()
-        assert beginning[0] == end[0] == "..."
-        # TODO(jaszczur): fix this hack below, properly
-        contracted_dims = (
-            len(x.shape) - len(beginning) + 1 + (1 if "(" in "".join(beginning) else 0)
-        )
-        ellipsis_shape = list(x.shape[:contracted_dims])
-        newx = torch.reshape(x, [-1] + list(x.shape[contracted_dims:]))
+        contracted_dims = x.dim() - self.n_non_ellipsis_dims
+        ellipsis_shape = x.shape[:contracted_dims]
+        newx = x.reshape(-1, *x.shape[contracted_dims:])
         output = self.layer(newx)
-        newoutput = torch.reshape(output, ellipsis_shape + list(output.shape[1:]))
-        return newoutput
+        return output.reshape(*ellipsis_shape, *output.shape[1:])
 
 
 @ash.check("... inp -> ... out")
@@ -182,19 +183,17 @@ class Chungus(nn.Module):
 
 
 class Checkpoint(nn.Module):
-    def __init__(self, module):
+    def __init__(self, module, enabled: bool = True):
         super(Checkpoint, self).__init__()
         self.module = module
-
-    def custom(self):
-        def custom_forward(*inputs):
-            output = self.module(inputs[0])
-            return output
-
-        return custom_forward
+        # switched by checkpointing policies, parameter names don't depend on it
+        self.enabled = enabled
 
     def forward(self, x):
-        return checkpoint(self.custom(), x)
+        if not self.enabled:
+            return self.module(x)
+        # the non-reentrant variant is traceable by torch.compile
+        return checkpoint(self.module, x, use_reentrant=False)
 
 
 def Sum(*layers):
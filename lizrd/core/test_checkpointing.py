@@ -0,0 +1,114 @@
+import torch
+
+from lizrd.core import llm
+from lizrd.core.misc import propagate_forward_pass_cache
+from lizrd.core.checkpointing import (
+    apply_checkpointing_policy,
+    fit_checkpointing_to_memory_budget,
+    get_checkpoints,
+    measure_checkpoints,
+)
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.train.train_utils import get_model
+
+
+def make_model(**kwargs):
+    dm = 32
+    return get_model(
+        max_length=16,
+        vocab_size=50,
+        ff_layer_fun=lambda: llm.FeedForward(dm, 4 * dm),
+        attention_layer_fun=lambda: llm.CausalAttention(dm, 4),
+        dm=dm,
+        n_blocks=4,
+        device=torch.device("cpu"),
+        gradient_checkpointing=True,
+        **kwargs,
+    )
+
+
+def get_enabled(model):
+    return [
+        (checkpoint.block_number, checkpoint.layer_type)
+        for checkpoint in get_checkpoints(model)
+        if checkpoint.enabled
+    ]
+
+
+class TestCheckpointingPolicies(GeneralTestCase):
+    def test_static_policies(self):
+        model = make_model(
+            checkpointing_policy="every_k_blocks", checkpoint_every_k_blocks=2
+        )
+        self.assertListEqual(
+            get_enabled(model),
+            [
+                (0, "attention"),
+                (0, "feedforward"),
+                (2, "attention"),
+                (2, "feedforward"),
+            ],
+        )
+        apply_checkpointing_policy(model, "feedforward")
+        self.assertListEqual(get_enabled(model), [(i, "feedforward") for i in range(4)])
+        apply_checkpointing_policy(model, "all")
+        self.assertEqual(len(get_enabled(model)), 8)
+        self.assertListEqual(list(make_model().state_dict()), list(model.state_dict()))
+
+    def test_same_gradients(self):
+        x = torch.randint(50, (2, 16))
+        results = []
+        for policy in ["all", "attention", "every_k_blocks"]:
+            torch.manual_seed(0)
+            model = make_model(checkpointing_policy=policy, checkpoint_every_k_blocks=3)
+            output = model(x)
+            output.sum().backward()
+            results.append((output, [p.grad for p in model.parameters()]))
+        expected_output, expected_grads = results[0]
+        for output, grads in results[1:]:
+            self.assertTensorAlmostEqual(output, expected_output)
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTensorAlmostEqual(grad, expected_grad)
+
+    def test_memory_budget(self):
+        model = make_model(checkpointing_policy="auto")
+        x = torch.randint(50, (2, 16))
+        stats = measure_checkpoints(model, x)
+        total_bytes = sum(stat["bytes"] for stat in stats.values())
+        kept_bytes = stats[None]["bytes"]
+
+        for budget, n_expected in [(total_bytes, 0), (kept_bytes, 8)]:
+            selected = fit_checkpointing_to_memory_budget(model, x, budget, stats=stats)
+            self.assertEqual(len(selected), n_expected)
+            self.assertEqual(len(get_enabled(model)), n_expected)
+
+        budget = (total_bytes + kept_bytes) // 2
+        selected = fit_checkpointing_to_memory_budget(model, x, budget, stats=stats)
+        self.assertTrue(0 < len(selected) < 8)
+        freed_bytes = sum(stats[checkpoint]["bytes"] for checkpoint in selected)
+        self.assertLessEqual(total_bytes - freed_bytes, budget)
+        # without the last chosen sublayer the activations would not fit
+        self.assertGreater(
+            total_bytes - freed_bytes + stats[selected[-1]]["bytes"], budget
+        )
+
+    def test_measurement_scales_with_batch_size(self):
+        model = make_model(checkpointing_policy="auto")
+        x = torch.randint(50, (4, 16))
+        full = measure_checkpoints(model, x)
+        scaled = measure_checkpoints(model, x[:1], batch_size=4)
+        for checkpoint in get_checkpoints(model):
+            self.assertEqual(scaled[checkpoint]["bytes"], full[checkpoint]["bytes"])
+        # outside of checkpoints, a few tensors don't depend on the batch size
+        self.assertAlmostEqual(
+            scaled[None]["bytes"] / full[None]["bytes"], 1.0, delta=0.05
+        )
+
+    def test_measurement_keeps_forward_pass_cache(self):
+        model = make_model(checkpointing_policy="auto")
+        propagate_forward_pass_cache(model)
+        document_ids = torch.zeros(4, 16, dtype=torch.long)
+        model.forward_pass_cache["document_ids"] = document_ids
+        measure_checkpoints(model, torch.randint(50, (1, 16)), batch_size=4)
+        self.assertIs(model.forward_pass_cache["document_ids"], document_ids)
+        self.assertListEqual(list(model.forward_pass_cache), ["document_ids"])
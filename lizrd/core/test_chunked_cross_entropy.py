@@ -0,0 +1,38 @@
+import torch
+import torch.nn.functional as F
+
+from lizrd.core import llm
+from lizrd.core.chunked_cross_entropy import chunked_head_cross_entropy
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestChunkedHeadCrossEntropy(GeneralTestCase):
+    def test_matches_full_logits(self):
+        torch.manual_seed(0)
+        batch, seql, dm, vocab_size = 3, 5, 16, 103
+        head = llm.PredictionHead(dm, vocab_size)
+        hidden = torch.randn(batch, seql, dm, requires_grad=True)
+        targets = torch.randint(0, vocab_size, (batch, seql))
+        # the last chunk is shorter than the others
+        for vocab_chunk_size in [10, 103, 1000]:
+            head.zero_grad()
+            hidden.grad = None
+            loss, predictions = chunked_head_cross_entropy(
+                hidden, head, targets, vocab_chunk_size
+            )
+            (loss * torch.arange(seql)).sum().backward()
+            grads = [hidden.grad, *[p.grad for p in head.parameters()]]
+
+            head.zero_grad()
+            hidden.grad = None
+            logits = head(hidden)
+            expected_loss = F.cross_entropy(
+                logits.reshape(-1, vocab_size), targets.reshape(-1), reduction="none"
+            ).reshape(batch, seql)
+            (expected_loss * torch.arange(seql)).sum().backward()
+            expected_grads = [hidden.grad, *[p.grad for p in head.parameters()]]
+
+            self.assertTensorAlmostEqual(loss, expected_loss)
+            self.assertTensorEqual(predictions, logits.argmax(dim=-1))
+            for grad, expected_grad in zip(grads, expected_grads):
+                self.assertTensorAlmostEqual(grad, expected_grad)
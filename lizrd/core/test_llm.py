@@ -1,6 +1,7 @@
 import torch
 
 from lizrd.core import llm
+from lizrd.core.misc import propagate_forward_pass_cache
 import unittest
 
 from lizrd.support.test_utils import GeneralTestCase
@@ -51,6 +52,23 @@ class AttentionTest(GeneralTestCase):
         self.assertShape(out, (batch, seql, dm))
 
 
+class DocumentMaskTest(GeneralTestCase):
+    def test_packed_documents_are_independent(self):
+        dm, heads, lengths = 32, 4, [3, 5, 2]
+        for attention_class in [llm.Attention, llm.CausalAttention]:
+            layer = attention_class(dm, heads, mask_document_boundaries=True)
+            propagate_forward_pass_cache(layer)
+            documents = [torch.normal(0.0, 1.0, (1, l, dm)) for l in lengths]
+            layer.forward_pass_cache["document_ids"] = torch.cat(
+                [torch.full((1, l), i) for i, l in enumerate(lengths)], dim=1
+            )
+            packed_output = layer(torch.cat(documents, dim=1))
+
+            layer.forward_pass_cache.clear()
+            separate_output = torch.cat([layer(d) for d in documents], dim=1)
+            self.assertTensorAlmostEqual(packed_output, separate_output)
+
+
 class EncoderTowerTest(GeneralTestCase):
     def test_basic(self):
         batch, seql, dm, heads, dff = 3, 7, 32, 4, 64
@@ -96,5 +114,104 @@ class BERTTest(GeneralTestCase):
         self.assertShape(output, (batch, seql, output_size))
 
 
+def make_gpt(
+    vocab_size,
+    max_length,
+    dm=32,
+    heads=4,
+    dff=64,
+    n_blocks=2,
+    attention_backend="einsum",
+):
+    embedding_layer = llm.EmbeddingLayer(
+        llm.PositionalEmbedding(max_length, dm),
+        llm.TokenEmbedding(vocab_size, dm),
+    )
+    layer_dict = {
+        "attention": lambda: llm.CausalAttention(
+            dm, heads, attention_backend=attention_backend
+        ),
+        "feedforward": lambda: llm.FeedForward(dm, dff),
+    }
+    encoder_tower = llm.TransformerTower(
+        n_blocks, dm, layer_dict, device=torch.device("cpu")
+    )
+    return llm.LLM(embedding_layer, encoder_tower, llm.PredictionHead(dm, vocab_size))
+
+
+class KVCacheTest(GeneralTestCase):
+    def test_incremental_forward_matches_full(self):
+        batch, seql, vocab_size = 3, 11, 107
+        for attention_backend in llm.ATTENTION_BACKENDS:
+            model = make_gpt(
+                vocab_size, max_length=33, attention_backend=attention_backend
+            )
+            propagate_forward_pass_cache(model)
+            input = torch.randint(0, vocab_size, (batch, seql))
+            full_output = model(input)
+
+            kv_cache = llm.KVCache()
+            model.forward_pass_cache["kv_cache"] = kv_cache
+            outputs = []
+            # a prompt of a few tokens, then one token at a time
+            for begin, end in [(0, 4)] + [(i, i + 1) for i in range(4, seql)]:
+                outputs.append(model(input[:, begin:end]))
+                kv_cache.advance(end - begin)
+            self.assertTensorAlmostEqual(torch.cat(outputs, dim=1), full_output)
+
+
+class AttentionBackendTest(GeneralTestCase):
+    def test_sdpa_matches_einsum(self):
+        batch, seql, dm, heads = 3, 10, 32, 4
+        input = torch.normal(0.0, 1.0, (batch, seql, dm))
+        document_ids = torch.randint(0, 3, (batch, seql)).sort(dim=-1).values
+        for attention_class in [llm.Attention, llm.CausalAttention]:
+            einsum_layer = attention_class(
+                dm, heads, mask_document_boundaries=True, attention_backend="einsum"
+            )
+            sdpa_layer = attention_class(
+                dm, heads, mask_document_boundaries=True, attention_backend="sdpa"
+            )
+            sdpa_layer.load_state_dict(einsum_layer.state_dict())
+            for layer in [einsum_layer, sdpa_layer]:
+                propagate_forward_pass_cache(layer)
+            self.assertTensorAlmostEqual(sdpa_layer(input), einsum_layer(input))
+
+            for layer in [einsum_layer, sdpa_layer]:
+                layer.forward_pass_cache["document_ids"] = document_ids
+            self.assertTensorAlmostEqual(sdpa_layer(input), einsum_layer(input))
+
+    def test_loads_separate_projections(self):
+        batch, seql, dm, heads, dhead = 2, 5, 16, 2, 6
+        state_dict = {
+            f"{name}.layer.weight": torch.randn(dm, heads, dhead) for name in "QKV"
+        }
+        state_dict.update(
+            {f"{name}.layer.bias": torch.randn(heads, dhead) for name in "QKV"}
+        )
+        state_dict["D.layer.weight"] = torch.randn(heads, dhead, dm)
+        state_dict["D.layer.bias"] = torch.randn(dm)
+        layer = llm.Attention(dm, heads, dhead)
+        layer.load_state_dict(state_dict)
+
+        x = torch.randn(batch, seql, dm)
+        q, k, v = [
+            torch.einsum(
+                "b l m, m h d -> b l h d", x, state_dict[f"{name}.layer.weight"]
+            )
+            + state_dict[f"{name}.layer.bias"]
+            for name in "QKV"
+        ]
+        a = torch.einsum("b l h d, b L h d -> b h l L", q, k) / dhead**0.5
+        prefinal = torch.einsum("b h l L, b L h d -> b l h d", a.softmax(-1), v)
+        expected = (
+            torch.einsum(
+                "b l h d, h d m -> b l m", prefinal, state_dict["D.layer.weight"]
+            )
+            + state_dict["D.layer.bias"]
+        )
+        self.assertTensorAlmostEqual(layer(x), expected)
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,11 +1,14 @@
 import copy
+import warnings
+
 import torch
 
 from lizrd.core import llm, misc
 from lizrd.core.misc import Chungus, Checkpoint
 from lizrd.datasets.wikibookdata import get_processed_dataset
+from lizrd.support import ash
 from lizrd.support.test_utils import GeneralTestCase, heavy_test, skip_test
-from lizrd.train.train_utils import get_model
+from lizrd.train.train_utils import compile_model, get_model
 
 
 class TestDense(GeneralTestCase):
@@ -242,6 +245,82 @@ class TestCheckpoint(GeneralTestCase):
             ).all(), f"parameter {name} failed, log of difference is: {torch.log10((grad - grad_checkpointed).abs().max())}"
 
 
+class TestCompile(GeneralTestCase):
+    def tearDown(self):
+        ash.set_checks_enabled(True)
+
+    @heavy_test
+    def test_compiles_without_graph_breaks(self):
+        dm, vocab_size, seql = 16, 50, 12
+        ff_layer_funs = [
+            lambda: llm.FeedForward(dm, 32),
+            lambda: misc.EinMix(
+                "... d -> ... e", weight_shape="d e", bias_shape="e", d=dm, e=dm
+            ),
+        ]
+        for ff_layer_fun in ff_layer_funs:
+            for gradient_checkpointing in [False, True]:
+                torch.manual_seed(0)
+                model = get_model(
+                    max_length=seql,
+                    vocab_size=vocab_size,
+                    ff_layer_fun=ff_layer_fun,
+                    attention_layer_fun=lambda: llm.CausalAttention(
+                        dm, 4, attention_backend="sdpa"
+                    ),
+                    dm=dm,
+                    n_blocks=2,
+                    device=torch.device("cpu"),
+                    gradient_checkpointing=gradient_checkpointing,
+                )
+                compiled_model = copy.deepcopy(model)
+                # fullgraph fails on any graph break, which would show as a warning of the fallback
+                compile_model(compiled_model, backend="aot_eager", fullgraph=True)
+                x = torch.randint(vocab_size, (2, seql))
+
+                with warnings.catch_warnings(record=True) as caught:
+                    warnings.simplefilter("always")
+                    for m in [model, compiled_model]:
+                        m(x).sum().backward()
+                self.assertFalse(any("Compiling" in str(w.message) for w in caught))
+                # shape checks are only off inside the compiled regions
+                self.assertTrue(ash.checks_enabled())
+                self.assertTensorAlmostEqual(compiled_model(x), model(x))
+                self.assertListEqual(
+                    list(compiled_model.state_dict()), list(model.state_dict())
+                )
+                for param, compiled_param in zip(
+                    model.parameters(), compiled_model.parameters()
+                ):
+                    self.assertTensorAlmostEqual(compiled_param.grad, param.grad)
+
+    def test_falls_back_to_eager_when_compilation_fails(self):
+        def failing_backend(graph_module, example_inputs):
+            raise RuntimeError("unsupported")
+
+        torch.manual_seed(0)
+        model = get_model(
+            max_length=12,
+            vocab_size=50,
+            ff_layer_fun=lambda: llm.FeedForward(16, 32),
+            attention_layer_fun=lambda: llm.CausalAttention(16, 4),
+            dm=16,
+            n_blocks=1,
+            device=torch.device("cpu"),
+        )
+        x = torch.randint(50, (2, 12))
+        expected = model(x)
+        compile_model(model, backend=failing_backend)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            output = model(x)
+        self.assertTrue(any("Compiling" in str(w.message) for w in caught))
+        self.assertTensorAlmostEqual(output, expected)
+        # regions are back to their eager forward
+        self.assertNotIn("forward", vars(model.head))
+        self.assertTensorAlmostEqual(model(x), expected)
+
+
 class TestModelParallel(GeneralTestCase):
     def test_get_current_device(self):
         obj = llm.TransformerTower(0, 100, {})  # Replace with the name of your class
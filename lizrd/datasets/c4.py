@@ -5,14 +5,30 @@ from datasets import load_dataset
 from transformers import GPT2TokenizerFast
 
 from lizrd.datasets.processor import ProcessedGPTExample
+from lizrd.text.datasets import get_shard_size
 
 
 NUM_C4_TOKENS = 173_648_052_806  # number of tokens in the C4 dataset
 
 
 class C4Dataset(Dataset):
-    def __init__(self, seq_length: int, batch_size: int, split: str = "train"):
+    """
+    With `world_size > 1`, the dataset only holds the documents with `document_id % world_size == rank`.
+    The DataLoader sampler gives every worker different indices of that shard.
+    """
+
+    def __init__(
+        self,
+        seq_length: int,
+        batch_size: int,
+        split: str = "train",
+        rank: int = 0,
+        world_size: int = 1,
+    ):
+        assert 0 <= rank < world_size
         self.dataset = load_dataset("c4", "en", split=split)
+        self.rank = rank
+        self.world_size = world_size
         self.seq_length = seq_length
         self.tokenizer = GPT2TokenizerFast.from_pretrained(
             "gpt2", additional_special_tokens=["<sequence_sep>"]
@@ -30,7 +46,10 @@ class C4Dataset(Dataset):
         )
 
     def __len__(self):
-        return len(self.dataset)
+        return get_shard_size(len(self.dataset), self.rank, self.world_size)
+
+    def get_document_id(self, idx: int) -> int:
+        return self.rank + idx * self.world_size
 
     def __getitem__(self, idx):
         tokenized = self.get_tokenized_sample(idx)
@@ -47,8 +66,8 @@ class C4Dataset(Dataset):
         result["input_ids"] = []
         result["attention_mask"] = []
         current_length = 0
-        document_id = idx
-        rand = random.Random(idx)
+        document_id = self.get_document_id(idx)
+        rand = random.Random(document_id)
         while current_length < self.seq_length:
             example = self.get_one_example(
                 document_id, self.seq_length - current_length
@@ -60,7 +79,7 @@ class C4Dataset(Dataset):
                 result["input_ids"] += [self.sequence_separator_id]
                 result["attention_mask"] += [0]
                 current_length += 1
-                document_id = rand.randint(0, len(self.dataset) - 1)
+                document_id = self.get_document_id(rand.randint(0, len(self) - 1))
         return result
 
     def get_one_example(self, idx, length):
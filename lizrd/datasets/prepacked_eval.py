@@ -0,0 +1,126 @@
+import json
+import os
+from typing import Callable, Iterator
+
+import numpy as np
+import torch
+
+from lizrd.datasets.processed_batch import (
+    ProcessedBERTBatch,
+    ProcessedBatch,
+    ProcessedGPTBatch,
+)
+from lizrd.text.data import LLMBatch
+
+BATCH_CLASSES = {
+    batch_class.__name__: batch_class
+    for batch_class in [ProcessedGPTBatch, ProcessedBERTBatch, LLMBatch]
+}
+METADATA_FILE = "metadata.json"
+
+
+def get_storage_dtype(array: np.ndarray) -> np.dtype:
+    """int64 ids and masks are stored as int32 when they fit, they are cast back when loaded."""
+    if array.dtype == np.int64 and (
+        array.size == 0
+        or (
+            array.min() >= np.iinfo(np.int32).min
+            and array.max() <= np.iinfo(np.int32).max
+        )
+    ):
+        return np.dtype(np.int32)
+    return array.dtype
+
+
+def save_eval_set(get_batch: Callable[[], ProcessedBatch], n_batches: int, path: str):
+    """
+    Materializes `n_batches` batches of `get_batch` into one `.npy` file per tensor of the batch,
+    written incrementally through memmaps.
+    """
+    os.makedirs(path, exist_ok=True)
+    batch = get_batch()
+    first_arrays = {name: tensor.cpu().numpy() for name, tensor in batch}
+    metadata = {
+        "batch_class": type(batch).__name__,
+        "n_batches": n_batches,
+        "tensors": {
+            name: {"dtype": str(array.dtype), "shape": list(array.shape)}
+            for name, array in first_arrays.items()
+        },
+    }
+    assert metadata["batch_class"] in BATCH_CLASSES, metadata["batch_class"]
+    files = {
+        name: np.lib.format.open_memmap(
+            os.path.join(path, f"{name}.npy"),
+            mode="w+",
+            dtype=get_storage_dtype(array),
+            shape=(n_batches,) + array.shape,
+        )
+        for name, array in first_arrays.items()
+    }
+
+    for i in range(n_batches):
+        if i > 0:
+            batch = get_batch()
+        for name, tensor in batch:
+            files[name][i] = tensor.cpu().numpy()
+    for file in files.values():
+        file.flush()
+
+    with open(os.path.join(path, METADATA_FILE), "w") as f:
+        json.dump(metadata, f, indent=2)
+
+
+class PrepackedEvalSet:
+    """
+    Serves the batches written by `save_eval_set`, always the same ones in the same order,
+    so eval is only model compute and losses are comparable between runs.
+    With `preload`, the whole set is moved to `device` once.
+    `get_batch` cycles through the set like `ProcessedDatasetWrapper.get_batch`, call `rewind`
+    at the beginning of every eval.
+    """
+
+    def __init__(self, path: str, device: torch.device, preload: bool = True):
+        with open(os.path.join(path, METADATA_FILE)) as f:
+            self.metadata = json.load(f)
+        self.batch_class = BATCH_CLASSES[self.metadata["batch_class"]]
+        self.device = device
+        self.arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in self.metadata["tensors"]
+        }
+        self.batches = (
+            [self._load_batch(i) for i in range(len(self))] if preload else None
+        )
+        self.next_batch = 0
+
+    def __len__(self) -> int:
+        return self.metadata["n_batches"]
+
+    def __iter__(self) -> Iterator[ProcessedBatch]:
+        for i in range(len(self)):
+            yield self._get_batch(i)
+
+    def rewind(self):
+        self.next_batch = 0
+
+    def get_batch(self) -> ProcessedBatch:
+        batch = self._get_batch(self.next_batch)
+        self.next_batch = (self.next_batch + 1) % len(self)
+        return batch
+
+    def _get_batch(self, i: int) -> ProcessedBatch:
+        if self.batches is not None:
+            return self.batches[i]
+        return self._load_batch(i)
+
+    def _load_batch(self, i: int) -> ProcessedBatch:
+        batch = self.batch_class.__new__(self.batch_class)
+        for name, info in self.metadata["tensors"].items():
+            # copy out of the read-only memmap, torch can't wrap non-writable arrays
+            tensor = torch.from_numpy(np.array(self.arrays[name][i], copy=True))
+            dtype = torch.from_numpy(np.zeros(0, dtype=info["dtype"])).dtype
+            setattr(batch, name, tensor.to(self.device).to(dtype))
+        if isinstance(batch, ProcessedBatch):
+            batch.device = self.device
+        return batch
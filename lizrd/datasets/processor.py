@@ -1,9 +1,31 @@
 from dataclasses import dataclass
+import itertools
+from typing import List, Tuple
+
 from attr import define
 import numpy as np
-
-
-from transformers import BertTokenizer, GPT2Tokenizer
+from transformers import BertTokenizerFast, GPT2TokenizerFast
+
+from lizrd.text.tokenizers import get_special_token_id, load_fast_tokenizer
+
+
+def pad_token_lists(
+    token_lists: List[List[int]], length: int, pad_id: int, max_tokens: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Cuts every list to `max_tokens` tokens and pads it with `pad_id` to `length`.
+    Returns the padded `(len(token_lists), length)` array and the number of kept tokens of every list.
+    """
+    lengths = np.array([min(len(tokens), max_tokens) for tokens in token_lists])
+    padded = np.full((len(token_lists), length), pad_id, dtype=np.int64)
+    flat_tokens = np.fromiter(
+        itertools.chain.from_iterable(tokens[:max_tokens] for tokens in token_lists),
+        dtype=np.int64,
+        count=lengths.sum(),
+    )
+    # boolean indexing fills the rows in order, so the flat tokens land at the beginning of their rows
+    padded[np.arange(length) < lengths[:, None]] = flat_tokens
+    return padded, lengths
 
 
 @dataclass
@@ -18,10 +40,10 @@ class GPTSentenceProcessor(object):
         self,
         max_total_length=128,
     ):
-        self.tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
+        self.tokenizer = load_fast_tokenizer("gpt2", GPT2TokenizerFast)
         self.max_total_length = max_total_length
         end_token = "<|endoftext|>"
-        self.end_token_id = self.tokenizer._convert_token_to_id(end_token)
+        self.end_token_id = get_special_token_id(self.tokenizer, end_token)
 
     def process(self, sentence):
         tokens = self.tokenize_text(sentence)
@@ -29,11 +51,28 @@ class GPTSentenceProcessor(object):
         target_tokens = tokens[1:] + [self.end_token_id]
         return ProcessedGPTExample(tokens, non_padded_mask, target_tokens)
 
-    def tokenize_text(self, sentence_text):
-        # note: tokenizer.encode _claims_ to be equivalent. This isn't true.
-        return self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.tokenize(sentence_text)
+    def process_batch(self, sentences: List[str]) -> List[ProcessedGPTExample]:
+        """Same examples as `process` of every sentence, tokenized in one call and padded as arrays."""
+        tokens, lengths = pad_token_lists(
+            tokenize_texts(self.tokenizer, sentences),
+            self.max_total_length,
+            self.end_token_id,
+            max_tokens=self.max_total_length - 1,
+        )
+        # the end token closing every sentence is already there, as it is also the padding
+        non_padded_mask = (np.arange(self.max_total_length) <= lengths[:, None]).astype(
+            np.int64
         )
+        target_tokens = np.concatenate(
+            [tokens[:, 1:], np.full((len(tokens), 1), self.end_token_id)], axis=1
+        )
+        return [
+            ProcessedGPTExample(*example)
+            for example in zip(tokens, non_padded_mask, target_tokens)
+        ]
+
+    def tokenize_text(self, sentence_text):
+        return tokenize_texts(self.tokenizer, [sentence_text])[0]
 
     def pad_tokens(self, sentence_tokens):
         if len(sentence_tokens) > self.max_total_length - 1:
@@ -46,6 +85,12 @@ class GPTSentenceProcessor(object):
         return sentence_tokens, non_padded_mask
 
 
+def tokenize_texts(tokenizer, texts: List[str]) -> List[List[int]]:
+    # without special tokens, these are the ids of `tokenize` + `convert_tokens_to_ids` of the slow HF tokenizers
+    encodings = tokenizer.encode_batch(texts, add_special_tokens=False)
+    return [encoding.ids for encoding in encodings]
+
+
 class ProcessedBERTExample(object):
     def __init__(self, sentence, processor):
         self.tokens = processor.tokenize_text(sentence)
@@ -54,6 +99,14 @@ class ProcessedBERTExample(object):
         self.mask_mask = processor.get_mask_mask(special_token_mask)
         self.masked_tokens = processor.mask_tokens(self.tokens, self.mask_mask)
 
+    @classmethod
+    def from_arrays(cls, tokens, mask_mask, masked_tokens) -> "ProcessedBERTExample":
+        example = cls.__new__(cls)
+        example.tokens = tokens
+        example.mask_mask = mask_mask
+        example.masked_tokens = masked_tokens
+        return example
+
 
 @define
 class MaskingReplacementConfig:
@@ -77,16 +130,17 @@ class BERTSentenceProcessor(object):
         mask_replace_config=None,
         rng=None,
     ):
-        self.tokenizer = BertTokenizer.from_pretrained("bert-base-uncased")
+        self.tokenizer = load_fast_tokenizer("bert-base-uncased", BertTokenizerFast)
         self.max_total_length = max_total_length
         self.mask_token = "[MASK]"
         self.sep_token = "[SEP]"
         self.cls_token = "[CLS]"
         self.pad_token = "[PAD]"
-        self.mask_id = self.tokenizer._convert_token_to_id("[MASK]")
-        self.cls_id = self.tokenizer._convert_token_to_id("[CLS]")
-        self.sep_id = self.tokenizer._convert_token_to_id("[SEP]")
-        self.pad_id = self.tokenizer._convert_token_to_id("[PAD]")
+        self.vocab_size = self.tokenizer.get_vocab_size(with_added_tokens=False)
+        self.mask_id = get_special_token_id(self.tokenizer, "[MASK]")
+        self.cls_id = get_special_token_id(self.tokenizer, "[CLS]")
+        self.sep_id = get_special_token_id(self.tokenizer, "[SEP]")
+        self.pad_id = get_special_token_id(self.tokenizer, "[PAD]")
         self.special_tokens = [
             self.cls_token,
             self.sep_token,
@@ -105,17 +159,34 @@ class BERTSentenceProcessor(object):
     def process(self, sentence):
         return ProcessedBERTExample(sentence, self)
 
-    def tokenize_text(self, sentence_text):
-        # note: tokenizer.encode _claims_ to be equivalent. This isn't true.
-        return self.tokenizer.convert_tokens_to_ids(
-            self.tokenizer.tokenize(sentence_text)
+    def process_batch(self, sentences: List[str]) -> List[ProcessedBERTExample]:
+        """
+        Examples distributed as with `process` of every sentence, tokenized in one call
+        and masked for the whole batch at once. Random draws are made in a different order than in `process`.
+        """
+        tokens, _ = pad_token_lists(
+            tokenize_texts(self.tokenizer, sentences),
+            self.max_total_length,
+            self.pad_id,
+            max_tokens=self.max_total_length,
         )
+        mask_mask = self.get_mask_mask(self.special_token_mask(tokens))
+        masked_tokens = self.mask_tokens(tokens, mask_mask)
+        return [
+            ProcessedBERTExample.from_arrays(*example)
+            for example in zip(tokens, mask_mask, masked_tokens)
+        ]
+
+    def tokenize_text(self, sentence_text):
+        return tokenize_texts(self.tokenizer, [sentence_text])[0]
 
     def special_token_mask(self, sentence_tokens):
         return np.isin(sentence_tokens, self.special_token_ids)
 
     def get_mask_mask(self, special_token_mask):
-        mask_mask = self.rng.binomial(1, self.mask_percent, len(special_token_mask))
+        mask_mask = self.rng.binomial(
+            1, self.mask_percent, np.shape(special_token_mask)
+        )
         mask_mask = mask_mask.astype(bool)
         mask_mask = np.where(special_token_mask, 0, mask_mask)
         return mask_mask
@@ -124,7 +195,7 @@ class BERTSentenceProcessor(object):
         # first 999 tokens are special tokens when using transformers.BertTokenizer.from_pretrained("bert-base-uncased")
         special_tokens = 999
         return (
-            self.rng.choice(self.tokenizer.vocab_size - special_tokens, tokens_count)
+            self.rng.choice(self.vocab_size - special_tokens, tokens_count)
             + special_tokens
         )
 
@@ -136,12 +207,13 @@ class BERTSentenceProcessor(object):
                 self.mask_replace_config.replace_with_random,
                 self.mask_replace_config.replace_with_original,
             ],
-            size=len(sentence_tokens),
-        ).nonzero()[1]
+            size=np.shape(sentence_tokens),
+        ).argmax(axis=-1)
         token_replacement = (
             (how_to_mask == 0) * self.mask_id
-            + (how_to_mask == 1) * self.get_valid_random_tokens(len(sentence_tokens))
-            + (how_to_mask == 2) * sentence_tokens
+            + (how_to_mask == 1)
+            * self.get_valid_random_tokens(np.shape(sentence_tokens))
+            + (how_to_mask == 2) * np.asarray(sentence_tokens)
         )
         return np.where(mask_mask, token_replacement, sentence_tokens)
 
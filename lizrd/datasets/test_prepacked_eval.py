@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+import numpy as np
+import torch
+
+from lizrd.datasets.prepacked_eval import PrepackedEvalSet, save_eval_set
+from lizrd.datasets.processed_batch import ProcessedGPTBatch
+from lizrd.datasets.processor import ProcessedGPTExample
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.packers import GPTPacker
+from lizrd.text.data import LLMBatch
+from lizrd.text.datasets import ListDataset
+from lizrd.text.test_utils import make_documents
+from lizrd.text.bench import DummyGPTTokenizer
+
+
+def make_gpt_batch(rng: np.random.Generator) -> ProcessedGPTBatch:
+    examples = []
+    for _ in range(4):
+        tokens = rng.integers(50_000, size=17).tolist()
+        examples.append(ProcessedGPTExample(tokens[:-1], [1] * 16, tokens[1:]))
+    return ProcessedGPTBatch(examples)
+
+
+class TestPrepackedEvalSet(GeneralTestCase):
+    def assertBatchesEqual(self, batch, expected):
+        self.assertIs(type(batch), type(expected))
+        expected_tensors = dict(expected)
+        self.assertSetEqual(set(dict(batch)), set(expected_tensors))
+        for name, tensor in batch:
+            self.assertEqual(tensor.dtype, expected_tensors[name].dtype)
+            self.assertTensorEqual(tensor, expected_tensors[name])
+
+    def test_legacy_batches_roundtrip(self):
+        rng = np.random.default_rng(0)
+        batches = [make_gpt_batch(rng) for _ in range(3)]
+        with tempfile.TemporaryDirectory() as path:
+            save_eval_set(iter(batches).__next__, len(batches), path)
+            # ids are stored in int32
+            self.assertEqual(np.load(os.path.join(path, "tokens.npy")).dtype, np.int32)
+            for preload in [True, False]:
+                eval_set = PrepackedEvalSet(path, torch.device("cpu"), preload)
+                self.assertEqual(len(eval_set), 3)
+                for batch, expected in zip(eval_set, batches):
+                    self.assertBatchesEqual(batch, expected)
+
+    def test_batches_repeat_after_rewind(self):
+        packer = GPTPacker(
+            16, ListDataset(make_documents(20)), DummyGPTTokenizer, seed=0
+        )
+        with tempfile.TemporaryDirectory() as path:
+            save_eval_set(
+                lambda: LLMBatch([packer.get_sample() for _ in range(4)]), 5, path
+            )
+            eval_set = PrepackedEvalSet(path, torch.device("cpu"))
+            first_eval = [eval_set.get_batch() for _ in range(3)]
+            eval_set.rewind()
+            for batch, expected in zip(
+                [eval_set.get_batch() for _ in range(3)], first_eval
+            ):
+                self.assertBatchesEqual(batch, expected)
+            # the set is cycled when an eval asks for more batches than were saved
+            for _ in range(2):
+                eval_set.get_batch()
+            self.assertBatchesEqual(eval_set.get_batch(), first_eval[0])
@@ -0,0 +1,122 @@
+import numpy as np
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import BertTokenizer, GPT2Tokenizer
+
+from lizrd.datasets.processor import (
+    BERTSentenceProcessor,
+    GPTSentenceProcessor,
+    MaskingReplacementConfig,
+    pad_token_lists,
+)
+from lizrd.support.test_utils import GeneralTestCase, heavy_test
+
+SPECIAL_TOKENS = ["[CLS]", "[SEP]", "[PAD]", "[MASK]", "<|endoftext|>"]
+WORDS = [f"w{i}" for i in range(2000)]
+
+
+def make_word_tokenizer() -> Tokenizer:
+    vocab = {token: i for i, token in enumerate(SPECIAL_TOKENS + WORDS)}
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[PAD]"))
+    tokenizer.pre_tokenizer = Whitespace()
+    return tokenizer
+
+
+def make_sentences(n_sentences: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    return [
+        " ".join(rng.choice(WORDS, size=rng.integers(1, 40)))
+        for _ in range(n_sentences)
+    ]
+
+
+def make_gpt_processor(max_total_length: int) -> GPTSentenceProcessor:
+    processor = GPTSentenceProcessor.__new__(GPTSentenceProcessor)
+    processor.tokenizer = make_word_tokenizer()
+    processor.max_total_length = max_total_length
+    processor.end_token_id = processor.tokenizer.token_to_id("<|endoftext|>")
+    return processor
+
+
+def make_bert_processor(max_total_length: int, seed: int) -> BERTSentenceProcessor:
+    processor = BERTSentenceProcessor.__new__(BERTSentenceProcessor)
+    processor.tokenizer = make_word_tokenizer()
+    processor.vocab_size = processor.tokenizer.get_vocab_size()
+    processor.max_total_length = max_total_length
+    processor.mask_id, processor.cls_id, processor.sep_id, processor.pad_id = [
+        processor.tokenizer.token_to_id(token)
+        for token in ["[MASK]", "[CLS]", "[SEP]", "[PAD]"]
+    ]
+    processor.special_token_ids = [
+        processor.cls_id,
+        processor.sep_id,
+        processor.pad_id,
+        processor.mask_id,
+    ]
+    processor.mask_percent = 0.15
+    processor.mask_replace_config = MaskingReplacementConfig()
+    processor.rng = np.random.default_rng(seed)
+    return processor
+
+
+class TestBatchedProcessing(GeneralTestCase):
+    def test_pad_token_lists(self):
+        padded, lengths = pad_token_lists([[1, 2, 3], [], [4, 5]], 4, 0, max_tokens=2)
+        self.assertTrue(
+            np.array_equal(padded, [[1, 2, 0, 0], [0, 0, 0, 0], [4, 5, 0, 0]])
+        )
+        self.assertTrue(np.array_equal(lengths, [2, 0, 2]))
+
+    def test_gpt_batch_matches_single(self):
+        processor = make_gpt_processor(max_total_length=24)
+        sentences = make_sentences(50)
+        for batched, single in zip(
+            processor.process_batch(sentences),
+            [processor.process(sentence) for sentence in sentences],
+        ):
+            self.assertListEqual(batched.tokens.tolist(), single.tokens)
+            self.assertListEqual(batched.target_tokens.tolist(), single.target_tokens)
+            self.assertListEqual(
+                batched.non_padded_mask.tolist(), single.non_padded_mask
+            )
+
+    def test_bert_batch_masking(self):
+        processor = make_bert_processor(max_total_length=24, seed=0)
+        sentences = make_sentences(500)
+        examples = processor.process_batch(sentences)
+        tokens = np.stack([example.tokens for example in examples])
+        mask_mask = np.stack([example.mask_mask for example in examples]).astype(bool)
+        masked_tokens = np.stack([example.masked_tokens for example in examples])
+
+        for sentence, example in zip(sentences, examples):
+            self.assertListEqual(
+                example.tokens.tolist(),
+                processor.pad_tokens(processor.tokenize_text(sentence)),
+            )
+        is_special = np.isin(tokens, processor.special_token_ids)
+        self.assertFalse((mask_mask & is_special).any())
+        self.assertTrue(np.array_equal(masked_tokens[~mask_mask], tokens[~mask_mask]))
+        self.assertAlmostEqual(mask_mask[~is_special].mean(), 0.15, delta=0.02)
+        replaced_with_mask = masked_tokens[mask_mask] == processor.mask_id
+        self.assertAlmostEqual(replaced_with_mask.mean(), 0.8, delta=0.05)
+
+    @heavy_test
+    def test_ids_match_slow_tokenizers(self):
+        texts = [
+            "Hello world!",
+            "Some longer text, with punctuation: 1, 2, 3.",
+            "Accents à la française, UPPER case and <|endoftext|> tokens.",
+        ]
+        for processor, slow_tokenizer in [
+            (GPTSentenceProcessor(), GPT2Tokenizer.from_pretrained("gpt2")),
+            (
+                BERTSentenceProcessor(),
+                BertTokenizer.from_pretrained("bert-base-uncased"),
+            ),
+        ]:
+            for text in texts:
+                self.assertListEqual(
+                    processor.tokenize_text(text),
+                    slow_tokenizer.convert_tokens_to_ids(slow_tokenizer.tokenize(text)),
+                )
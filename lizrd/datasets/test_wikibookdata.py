@@ -24,7 +24,8 @@ class TestWikibookdata(GeneralTestCase):
 
     @heavy_test
     def test_consistency(self):
-        ds = get_processed_dataset(32, 128, 0.15, "cpu", 2, 1)
+        # the saved batch was processed sentence by sentence, batched processing draws masks in a different order
+        ds = get_processed_dataset(32, 128, 0.15, "cpu", 2, 1, batched_processing=False)
         batch = ds.get_batch()
         # compare batch with saved batch
         with open("lizrd/datasets/test_batch.pkl", "rb") as f:
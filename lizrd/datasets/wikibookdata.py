@@ -81,6 +81,14 @@ class WikiBookDataset:
         batch = [self.get_example() for _ in range(batch_size)]
         return batch
 
+    def get_examples_until_refill(self):
+        """All examples that `get_example` would return until the buffer is refilled, in the same order."""
+        if len(self.examples_buffer) <= self.buffer_refill_from:
+            self._refill_buffer()
+        examples = self.examples_buffer[self.buffer_refill_from :][::-1]
+        del self.examples_buffer[self.buffer_refill_from :]
+        return examples
+
     def _refill_buffer(self):
         while len(self.examples_buffer) <= self.buffer_refill_to:
             self._add_examples(self._get_random_document())
@@ -115,18 +123,30 @@ class WikiBookDataset:
 
 
 class ProcessedDataset:
-    def __init__(self, dataset, processor):
+    """
+    With `batched`, all sentences of a refill of the dataset buffer are processed at once,
+    which is much faster than processing them one by one.
+    """
+
+    def __init__(self, dataset, processor, batched: bool = True):
         assert isinstance(dataset, WikiBookDataset)
         self.dataset = dataset
         assert isinstance(processor, BERTSentenceProcessor) or isinstance(
             processor, GPTSentenceProcessor
         )
         self.processor = processor
+        self.batched = batched
+        self.processed_buffer = []
 
     def get_example(self):
-        example = self.dataset.get_example()
-        processed_example = self.processor.process(example)
-        return processed_example
+        if not self.batched:
+            example = self.dataset.get_example()
+            processed_example = self.processor.process(example)
+            return processed_example
+        if len(self.processed_buffer) == 0:
+            examples = self.dataset.get_examples_until_refill()
+            self.processed_buffer = self.processor.process_batch(examples)[::-1]
+        return self.processed_buffer.pop()
 
 
 class ParallelCompatibleDataset(IterableDataset):
@@ -169,6 +189,8 @@ class ProcessedDatasetWrapper:
         model_type: str = "bert",
         dataset_type: Literal["wikibook", "c4"] = "wikibook",
         dataset_split: str = "train",
+        rank: int = 0,
+        world_size: int = 1,
     ):
         self.device = device
         self.model_type = model_type
@@ -190,7 +212,9 @@ class ProcessedDatasetWrapper:
                 pdataset, batch_size=batch_size, seed=seed
             )
         elif dataset_type == "c4":
-            pdataset = C4Dataset(seq_length, batch_size, dataset_split)
+            pdataset = C4Dataset(
+                seq_length, batch_size, dataset_split, rank=rank, world_size=world_size
+            )
         else:
             raise ValueError(f"Unknown dataset type: {self.dataset_type}")
 
@@ -219,6 +243,9 @@ def get_processed_dataset(
     dataset_type: Literal["wikibook", "c4"] = "wikibook",
     use_dummy_dataset: bool = False,
     dataset_split: str = "train",
+    rank: int = 0,
+    world_size: int = 1,
+    batched_processing: bool = True,
 ) -> wikibookdata.ProcessedDatasetWrapper:
     if dataset_type == "wikibook":
         raw_dataset = wikibookdata.WikiBookDataset(use_dummy_dataset=use_dummy_dataset)
@@ -232,7 +259,9 @@ def get_processed_dataset(
                 max_total_length=max_total_length,
             )
 
-        dataset = wikibookdata.ProcessedDataset(raw_dataset, processor)
+        dataset = wikibookdata.ProcessedDataset(
+            raw_dataset, processor, batched=batched_processing
+        )
     else:
         dataset = None
 
@@ -246,6 +275,8 @@ def get_processed_dataset(
         dataset_type=dataset_type,
         dataset_split=dataset_split,
         seq_length=max_total_length,
+        rank=rank,
+        world_size=world_size,
     )
 
     if cache_dir := os.getenv("HF_DATASETS_CACHE"):
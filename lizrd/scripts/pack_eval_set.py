@@ -0,0 +1,69 @@
+"""
+Materialize a fixed evaluation set once, to be served by `PrepackedEvalSet` instead of tokenizing and packing at every eval.
+
+Example:
+    python -m lizrd.scripts.pack_eval_set --model_type gpt --dataset_type c4 --split validation --n_batches 100 --output_dir /data/c4_gpt_eval
+"""
+import argparse
+
+import torch
+
+from lizrd.datasets import wikibookdata
+from lizrd.datasets.prepacked_eval import save_eval_set
+from research import datasets
+
+
+def get_batch_source(args):
+    """`legacy` batches are the ones used by `lizrd.train.train_utils`, `text` the ones of `research.conditional`."""
+    if args.pipeline == "legacy":
+        return wikibookdata.get_processed_dataset(
+            batch_size=args.batch_size,
+            max_total_length=args.cutoff,
+            mask_percent=args.mask_percent,
+            device=torch.device("cpu"),
+            num_workers=args.num_workers,
+            seed=args.seed,
+            model_type=args.model_type,
+            dataset_type=args.dataset_type,
+            use_dummy_dataset=args.use_dummy_dataset,
+            dataset_split=args.split,
+        )
+    elif args.pipeline == "text":
+        return datasets.get_processed_dataset(
+            batch_size=args.batch_size,
+            sequence_length=args.cutoff,
+            device=torch.device("cpu"),
+            num_workers=args.num_workers,
+            seed=args.seed,
+            model_type=args.model_type,
+            dataset_type=args.dataset_type,
+            use_dummy_dataset=args.use_dummy_dataset,
+            dataset_split=args.split,
+        )
+    else:
+        raise ValueError(f"Unknown pipeline: {args.pipeline}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--pipeline", choices=["legacy", "text"], default="legacy")
+    parser.add_argument("--model_type", choices=["gpt", "bert"], required=True)
+    parser.add_argument("--dataset_type", choices=["wikibook", "c4"], required=True)
+    parser.add_argument("--split", type=str, default="eval")
+    parser.add_argument("--batch_size", type=int, default=64)
+    parser.add_argument("--cutoff", type=int, default=128)
+    parser.add_argument("--mask_percent", type=float, default=0.15)
+    parser.add_argument("--seed", type=int, default=1984)
+    parser.add_argument("--n_batches", type=int, default=100)
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument("--use_dummy_dataset", action="store_true")
+    parser.add_argument("--output_dir", type=str, required=True)
+    args = parser.parse_args()
+
+    batch_source = get_batch_source(args)
+    save_eval_set(batch_source.get_batch, args.n_batches, args.output_dir)
+    print(f"Saved {args.n_batches} batches to {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
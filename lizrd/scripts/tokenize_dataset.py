@@ -0,0 +1,90 @@
+"""
+Tokenize a dataset once and store it as flat token shards, to be used with `--dataset_type pretokenized`.
+
+Example:
+    python -m lizrd.scripts.tokenize_dataset --dataset_type c4 --model_type gpt --split train --output_dir /data/c4_gpt/train
+    python -m lizrd.scripts.tokenize_dataset --dataset_type c4 --model_type gpt --split eval --output_dir /data/c4_gpt/eval
+
+With shards of every split in a subdirectory named after it, `--dataset_path /data/c4_gpt` serves both splits.
+"""
+import argparse
+from typing import Optional
+
+from lizrd.text import datasets, tokenizers
+from lizrd.text.token_shards import DEFAULT_SHARD_SIZE_TOKENS, write_token_shards
+
+
+def get_dataset(
+    dataset_type: str,
+    split: str,
+    use_dummy_dataset: bool,
+    dataset_path: Optional[str] = None,
+):
+    if dataset_type == "wikibook":
+        return datasets.WikiBookDataset(
+            use_dummy_dataset=use_dummy_dataset, split=split
+        )
+    elif dataset_type == "c4":
+        return datasets.C4Dataset(split=split)
+    elif dataset_type == "local":
+        assert dataset_path is not None, "local dataset requires --dataset_path"
+        return datasets.LocalCorpusDataset(dataset_path, split=split)
+    else:
+        raise ValueError(f"Unknown dataset type: {dataset_type}")
+
+
+def get_tokenizer_and_separator(model_type: str):
+    if model_type == "gpt":
+        tokenizer = tokenizers.GPTTokenizer()
+        return tokenizer, tokenizer.eot_id
+    elif model_type == "bert":
+        tokenizer = tokenizers.BertTokenizer()
+        return tokenizer, tokenizer.sequence_separator_id
+    else:
+        raise ValueError(f"Unknown model type: {model_type}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--dataset_type", choices=["wikibook", "c4", "local"], required=True
+    )
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="directory with .arrow, .jsonl or .parquet files, for --dataset_type local",
+    )
+    parser.add_argument("--model_type", choices=["gpt", "bert"], required=True)
+    parser.add_argument("--split", type=str, default="train")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument(
+        "--shard_size_tokens", type=int, default=DEFAULT_SHARD_SIZE_TOKENS
+    )
+    parser.add_argument("--max_documents", type=int, default=None)
+    parser.add_argument("--use_dummy_dataset", action="store_true")
+    args = parser.parse_args()
+
+    dataset = get_dataset(
+        args.dataset_type, args.split, args.use_dummy_dataset, args.dataset_path
+    )
+    tokenizer, separator_id = get_tokenizer_and_separator(args.model_type)
+
+    metadata = write_token_shards(
+        dataset.iterate_documents(),
+        tokenizer,
+        args.output_dir,
+        separator_id=separator_id,
+        tokenizer_name=args.model_type,
+        shard_size_tokens=args.shard_size_tokens,
+        max_documents=args.max_documents,
+        split=args.split,
+    )
+    print(
+        f"Wrote {metadata['total_documents']} documents, {metadata['total_tokens']} tokens "
+        f"in {len(metadata['shards'])} shards to {args.output_dir}"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,39 @@
+import contextlib
+
 import einops
 from lizrd.core import nn
 
 DISABLE_CHECKS = False
+# classes patched by `check`, with their checked and unchecked forwards
+CHECKED_CLASSES = {}
+
+
+def set_checks_enabled(enabled: bool):
+    """
+    Switches shape checks at runtime, also for already constructed models.
+    Disabled, decorated classes get their original `forward` back, so they run without any extra Python frames,
+    and `Check` modules only pass the input to the wrapped layer, keeping the module tree and state dict keys.
+    """
+    global DISABLE_CHECKS
+    DISABLE_CHECKS = not enabled
+    for module_class, (checked_forward, unchecked_forward) in CHECKED_CLASSES.items():
+        module_class.forward = checked_forward if enabled else unchecked_forward
+    Check.forward = Check.checked_forward if enabled else Check.unchecked_forward
+
+
+def checks_enabled() -> bool:
+    return not DISABLE_CHECKS
+
+
+@contextlib.contextmanager
+def checks_disabled():
+    """Shape checks are off only inside the block, e.g. around compiled code, where they would only add guards."""
+    was_enabled = checks_enabled()
+    set_checks_enabled(False)
+    try:
+        yield
+    finally:
+        set_checks_enabled(was_enabled)
 
 
 def assert_shape(pattern, tensor, **kwargs):
@@ -54,13 +86,18 @@ class Check(nn.Module):
             return None
         self._check_and_add_all(y.shape, self.out_sig, past)
 
-    def forward(self, x):
+    def checked_forward(self, x):
         past = self.get_past()
         self.before_layer(x, past)
         y = self.layer(x)
         self.after_layer(y, past)
         return y
 
+    def unchecked_forward(self, x):
+        return self.layer(x)
+
+    forward = checked_forward
+
 
 def check(signature, **kwargs_shape):
     def noop_decorator(class_or_fun):
@@ -73,22 +110,27 @@ def check(signature, **kwargs_shape):
             return function_decorator(class_or_fun)
 
     def class_decorator(module_class):
-        old_forward = module_class.forward
+        # a decorated subclass without its own forward inherits the checked forward of its parent
+        old_forward = getattr(
+            module_class.forward, "unchecked_forward", module_class.forward
+        )
         old_init = module_class.__init__
 
         def new_init(self, *args, **kwargs):
             old_init(self, *args, **kwargs)
             self._shape_checker = Check(signature, layer=None, **kwargs_shape)
 
-        def new_forward(self, x):
+        def new_forward(self, x, **kwargs):
             past = self._shape_checker.get_past()
             self._shape_checker.before_layer(x, past)
-            y = old_forward(self, x)
+            y = old_forward(self, x, **kwargs)
             self._shape_checker.after_layer(y, past)
             return y
 
+        new_forward.unchecked_forward = old_forward
         module_class.__init__ = new_init
         module_class.forward = new_forward
+        CHECKED_CLASSES[module_class] = (new_forward, old_forward)
         return module_class
 
     def function_decorator(function):
@@ -1,12 +1,22 @@
+from typing import List, Optional
+
 import torch
 
+from lizrd.core import llm
+from lizrd.core.misc import propagate_forward_pass_cache
+
 
 def decode_single_example(
     model: torch.nn.Module,
     max_sequence_length: int,
     input_tokens_ids: torch.Tensor,
     end_token_id: int,
+    use_kv_cache: bool = False,
 ) -> torch.Tensor:
+    if use_kv_cache:
+        return decode_with_kv_cache(
+            model, max_sequence_length, input_tokens_ids, end_token_id
+        )
     output_tokens_ids = torch.nn.functional.pad(
         input_tokens_ids, (0, max_sequence_length - len(input_tokens_ids))
     )
@@ -21,3 +31,143 @@ def decode_single_example(
             if output_length == max_sequence_length or next_token_id == end_token_id:
                 break
     return output_tokens_ids[:output_length]
+
+
+def decode_with_kv_cache(
+    model: torch.nn.Module,
+    max_sequence_length: int,
+    input_tokens_ids: torch.Tensor,
+    end_token_id: int,
+) -> torch.Tensor:
+    """
+    Greedy decoding like `decode_single_example`, but the prompt is processed once and then the model
+    runs on one new token per step, attending to keys and values cached by `llm.CausalAttention`.
+    Only exact for models whose other layers process every token independently,
+    e.g. not for MoE layers grouping tokens of the sequence.
+    """
+    if getattr(model, "forward_pass_cache", None) is None:
+        propagate_forward_pass_cache(model)
+    kv_cache = llm.KVCache()
+    model.forward_pass_cache["kv_cache"] = kv_cache
+    output_tokens_ids = [input_tokens_ids]
+    output_length = len(input_tokens_ids)
+    new_tokens_ids = input_tokens_ids
+    model.eval()
+    try:
+        with torch.no_grad():
+            while True:
+                predictions = model(new_tokens_ids)
+                kv_cache.advance(len(new_tokens_ids))
+                new_tokens_ids = torch.argmax(predictions[-1:], dim=-1)
+                output_tokens_ids.append(new_tokens_ids)
+                output_length += 1
+                if (
+                    output_length == max_sequence_length
+                    or new_tokens_ids.item() == end_token_id
+                ):
+                    break
+    finally:
+        model.forward_pass_cache.pop("kv_cache", None)
+    return torch.cat(output_tokens_ids)
+
+
+def sample_next_tokens(
+    logits: torch.Tensor,
+    temperature: float = 0.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+    generator: Optional[torch.Generator] = None,
+) -> torch.Tensor:
+    """
+    Picks the next token for every row of `(batch, vocab)` logits.
+    Greedy with `temperature` 0, otherwise samples from the `top_k` most likely tokens
+    and the smallest set of tokens with probability at least `top_p`.
+    """
+    if temperature == 0.0:
+        return torch.argmax(logits, dim=-1)
+    logits = logits.float() / temperature
+    if top_k is not None:
+        kth_largest = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values
+        logits = logits.masked_fill(logits < kth_largest[:, -1:], float("-inf"))
+    if top_p is not None:
+        sorted_logits, sorted_indices = torch.sort(logits, dim=-1, descending=True)
+        sorted_probs = torch.softmax(sorted_logits, dim=-1)
+        # a token is removed if the more likely ones already reach top_p, so the most likely one always stays
+        is_removed = torch.cumsum(sorted_probs, dim=-1) - sorted_probs >= top_p
+        logits = logits.scatter(
+            -1, sorted_indices, sorted_logits.masked_fill(is_removed, float("-inf"))
+        )
+    probs = torch.softmax(logits, dim=-1)
+    return torch.multinomial(probs, 1, generator=generator).squeeze(-1)
+
+
+def generate(
+    model: torch.nn.Module,
+    prompts: List[torch.Tensor],
+    max_sequence_length: int,
+    end_token_id: int,
+    max_new_tokens: Optional[int] = None,
+    temperature: float = 0.0,
+    top_k: Optional[int] = None,
+    top_p: Optional[float] = None,
+    generator: Optional[torch.Generator] = None,
+    use_kv_cache: bool = True,
+    padding_token_id: int = 0,
+) -> List[torch.Tensor]:
+    """
+    Continues all prompts at once. Prompts are left-padded with `padding_token_id` into one batch, every sequence stops
+    on its own at `end_token_id`, and the padded window is at most `max_sequence_length` tokens long.
+    Returns the prompts followed by their generated tokens, including the end token if it was generated.
+    Without `use_kv_cache` the whole window is processed at every step, for models that are not exact
+    with `decode_with_kv_cache`; padding is masked out in both modes.
+    """
+    device = prompts[0].device
+    prompt_lengths = torch.tensor([len(prompt) for prompt in prompts], device=device)
+    window_length = int(prompt_lengths.max())
+    assert window_length < max_sequence_length, "no room left for new tokens"
+    padding_lengths = window_length - prompt_lengths
+    tokens = torch.full(
+        (len(prompts), window_length),
+        padding_token_id,
+        dtype=torch.long,
+        device=device,
+    )
+    for i, prompt in enumerate(prompts):
+        tokens[i, padding_lengths[i] :] = prompt
+    n_new_tokens = max_sequence_length - window_length
+    if max_new_tokens is not None:
+        n_new_tokens = min(n_new_tokens, max_new_tokens)
+
+    if getattr(model, "forward_pass_cache", None) is None:
+        propagate_forward_pass_cache(model)
+    model.eval()
+    is_finished = torch.zeros(len(prompts), dtype=torch.bool, device=device)
+    generated_lengths = torch.zeros_like(prompt_lengths)
+    kv_cache = llm.KVCache(padding_lengths)
+    new_tokens = tokens
+    try:
+        with torch.no_grad():
+            for _ in range(n_new_tokens):
+                if not use_kv_cache:
+                    kv_cache = llm.KVCache(padding_lengths)
+                    new_tokens = tokens
+                model.forward_pass_cache["kv_cache"] = kv_cache
+                predictions = model(new_tokens)
+                kv_cache.advance(new_tokens.shape[-1])
+                next_tokens = sample_next_tokens(
+                    predictions[:, -1], temperature, top_k, top_p, generator
+                )
+                # finished sequences keep running with padding, their tokens are cut off at the end
+                next_tokens = next_tokens.masked_fill(is_finished, padding_token_id)
+                generated_lengths += ~is_finished
+                is_finished |= next_tokens == end_token_id
+                tokens = torch.cat([tokens, next_tokens[:, None]], dim=1)
+                new_tokens = next_tokens[:, None]
+                if is_finished.all():
+                    break
+    finally:
+        model.forward_pass_cache.pop("kv_cache", None)
+    return [
+        tokens[i, padding_lengths[i] : window_length + generated_lengths[i]]
+        for i in range(len(prompts))
+    ]
@@ -0,0 +1,51 @@
+import torch
+
+from lizrd.core import nn
+from lizrd.core.test_llm import make_gpt
+from lizrd.support import ash
+from lizrd.support.test_utils import GeneralTestCase
+
+
+@ash.check("... d -> ... d")
+class DropLastFeature(nn.Module):
+    def forward(self, x):
+        return x[..., :-1]
+
+
+@ash.check("... d -> ... d")
+def DropLastFeatureWrapped():
+    return DropLastFeature()
+
+
+class TestRuntimeSwitch(GeneralTestCase):
+    def tearDown(self):
+        ash.set_checks_enabled(True)
+
+    def test_disabled_checks_do_not_raise(self):
+        x = torch.zeros(2, 4)
+        with self.assertRaises(AssertionError):
+            DropLastFeature()(x)
+        ash.set_checks_enabled(False)
+        self.assertShape(DropLastFeature()(x), (2, 3))
+        ash.set_checks_enabled(True)
+        with self.assertRaises(AssertionError):
+            DropLastFeature()(x)
+
+    def test_unchecked_forward_is_restored(self):
+        checked_forward = DropLastFeature.forward
+        layer = DropLastFeatureWrapped()
+        ash.set_checks_enabled(False)
+        self.assertIs(DropLastFeature.forward, checked_forward.unchecked_forward)
+        self.assertShape(layer(torch.zeros(2, 4)), (2, 3))
+        ash.set_checks_enabled(True)
+        self.assertIs(DropLastFeature.forward, checked_forward)
+
+    def test_same_output_of_constructed_model(self):
+        torch.manual_seed(0)
+        model = make_gpt(vocab_size=50, max_length=8)
+        tokens = torch.randint(50, (2, 8))
+        expected = model(tokens)
+        keys = list(model.state_dict())
+        ash.set_checks_enabled(False)
+        self.assertTensorAlmostEqual(model(tokens), expected)
+        self.assertListEqual(list(model.state_dict()), keys)
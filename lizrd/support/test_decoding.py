@@ -0,0 +1,102 @@
+import torch
+
+from lizrd.core.test_llm import make_gpt
+from lizrd.support.decoding import (
+    decode_single_example,
+    generate,
+    sample_next_tokens,
+)
+from lizrd.support.test_utils import GeneralTestCase
+
+
+class TestDecoding(GeneralTestCase):
+    def test_kv_cache_decoding_matches_full_window(self):
+        torch.manual_seed(0)
+        vocab_size, max_length = 107, 24
+        model = make_gpt(vocab_size, max_length)
+        for prompt_length in [1, 5]:
+            prompt = torch.randint(0, vocab_size, (prompt_length,))
+            outputs = [
+                decode_single_example(
+                    model, max_length, prompt.clone(), -1, use_kv_cache=use_kv_cache
+                )
+                for use_kv_cache in [False, True]
+            ]
+            self.assertEqual(len(outputs[0]), max_length)
+            self.assertTensorEqual(outputs[1], outputs[0])
+            self.assertNotIn("kv_cache", model.forward_pass_cache)
+
+    def test_stops_at_end_token(self):
+        model = make_gpt(10, 16)
+        prompt = torch.tensor([1, 2, 3])
+        first_token = decode_single_example(model, 16, prompt, -1, use_kv_cache=True)[3]
+        output = decode_single_example(
+            model, 16, prompt, first_token.item(), use_kv_cache=True
+        )
+        self.assertTensorEqual(output, torch.cat([prompt, first_token[None]]))
+
+
+class TestGenerate(GeneralTestCase):
+    def test_batched_greedy_matches_single(self):
+        torch.manual_seed(1)
+        vocab_size, max_length = 107, 20
+        model = make_gpt(vocab_size, max_length)
+        prompts = [torch.randint(0, vocab_size, (length,)) for length in [1, 6, 3]]
+        for use_kv_cache in [True, False]:
+            outputs = generate(
+                model, prompts, max_length, -1, use_kv_cache=use_kv_cache
+            )
+            for prompt, output in zip(prompts, outputs):
+                # the batch window is as long as the longest prompt, so shorter prompts get fewer new tokens
+                expected = decode_single_example(
+                    model, max_length - 6 + len(prompt), prompt.clone(), -1
+                )
+                self.assertTensorEqual(output, expected)
+
+    def test_sdpa_matches_einsum_with_padding(self):
+        torch.manual_seed(3)
+        vocab_size, max_length = 107, 20
+        einsum_model = make_gpt(vocab_size, max_length, attention_backend="einsum")
+        sdpa_model = make_gpt(vocab_size, max_length, attention_backend="sdpa")
+        sdpa_model.load_state_dict(einsum_model.state_dict())
+        prompts = [torch.randint(0, vocab_size, (length,)) for length in [2, 7, 4]]
+        for use_kv_cache in [True, False]:
+            for output, expected in zip(
+                generate(
+                    sdpa_model, prompts, max_length, -1, use_kv_cache=use_kv_cache
+                ),
+                generate(
+                    einsum_model, prompts, max_length, -1, use_kv_cache=use_kv_cache
+                ),
+            ):
+                self.assertTensorEqual(output, expected)
+
+    def test_sequences_stop_separately(self):
+        torch.manual_seed(2)
+        model = make_gpt(50, 16)
+        prompts = [torch.tensor([1, 2, 3]), torch.tensor([4, 5])]
+        first_outputs = generate(model, prompts, 16, -1, max_new_tokens=1)
+        end_token_id = first_outputs[0][-1].item()
+        outputs = generate(model, prompts, 16, end_token_id)
+        self.assertTensorEqual(outputs[0], first_outputs[0])
+        # alone, the shorter prompt would have one more token of room in the window
+        other_output = generate(model, prompts[1:], 15, end_token_id)[0]
+        self.assertTensorEqual(outputs[1], other_output)
+
+    def test_sampling(self):
+        generator = torch.Generator().manual_seed(0)
+        logits = torch.randn(1000, 30, generator=generator)
+        greedy = torch.argmax(logits, dim=-1)
+        self.assertTensorEqual(sample_next_tokens(logits), greedy)
+        for kwargs in [dict(top_k=1), dict(top_p=1e-6)]:
+            sampled = sample_next_tokens(
+                logits, temperature=1.0, generator=generator, **kwargs
+            )
+            self.assertTensorEqual(sampled, greedy)
+
+        sampled = sample_next_tokens(
+            logits, temperature=1.0, top_k=5, generator=generator
+        )
+        top_5 = torch.topk(logits, 5, dim=-1).indices
+        self.assertTrue((top_5 == sampled[:, None]).any(dim=-1).all())
+        self.assertGreater(len(set(sampled.tolist())), 5)
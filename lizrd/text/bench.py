@@ -0,0 +1,275 @@
+"""
+Throughput benchmark of the data pipeline, to choose `--num_workers` and `--batch_size` for a machine
+and to catch regressions of the packers.
+
+Example:
+    python -m lizrd.text.bench --model_type gpt --sequence_length 512 --num_workers 0,2,4,8 --batch_sizes 64,256
+
+Prints a JSON report with tokens per second for every (num_workers, batch_size) pair
+and seconds per sample spent in every stage of packing, measured in the main process.
+The report is the only output on stdout, logs of the data pipeline go to stderr.
+With `--output` it is written to a file instead.
+"""
+import argparse
+import contextlib
+import json
+import sys
+import time
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+
+from lizrd.support import profile
+from lizrd.text.data import LLMBatch
+from lizrd.text.datasets import ListDataset
+from lizrd.text.packers import AbstractPacker, BERTPacker
+from lizrd.text.tokenizers import BertTokenizer, GPTTokenizer
+from research.datasets import get_packer, wrap_packer
+
+STAGES = ["fetch", "tokenize", "mask", "get_sample", "collate"]
+
+
+def word_to_id(word: str, vocab_size: int, first_id: int) -> int:
+    return first_id + sum(ord(c) for c in word) % (vocab_size - first_id)
+
+
+class DummyGPTTokenizer(GPTTokenizer):
+    """Whitespace tokenizer with GPT special ids, does not need the HF hub. For benchmarks and tests."""
+
+    def __init__(self):
+        self.eot_id = self.VOCAB_SIZE - 1
+
+    def text_to_ids(self, text: str) -> List[int]:
+        return [word_to_id(word, self.VOCAB_SIZE - 1, 0) for word in text.split()]
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return [self.text_to_ids(text) for text in texts]
+
+
+class DummyBertTokenizer(BertTokenizer):
+    """Whitespace tokenizer with BERT special ids, does not need the HF hub. For benchmarks and tests."""
+
+    def __init__(self):
+        self.mask_id = 103
+        self.sequence_separator_id = 102
+
+    def text_to_ids(self, text: str) -> List[int]:
+        return [word_to_id(word, self.VOCAB_SIZE, 999) for word in text.split()]
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return [self.text_to_ids(text) for text in texts]
+
+
+def make_synthetic_corpus(
+    n_documents: int, mean_words: int = 300, vocab_size: int = 20_000, seed: int = 0
+) -> List[str]:
+    rng = np.random.default_rng(seed)
+    lengths = rng.geometric(1 / mean_words, size=n_documents)
+    return [
+        " ".join(f"w{word}" for word in rng.integers(vocab_size, size=length))
+        for length in lengths
+    ]
+
+
+def load_corpus(path: str) -> List[str]:
+    """One document per line, or a `.jsonl` file with a `text` field."""
+    with open(path) as f:
+        if path.endswith(".jsonl"):
+            return [json.loads(line)["text"] for line in f]
+        return [line.rstrip("\n") for line in f if line.strip()]
+
+
+def timed(name: str, function: Callable) -> Callable:
+    def wrapper(*args, **kwargs):
+        with profile.Timer(name):
+            return function(*args, **kwargs)
+
+    return wrapper
+
+
+def measure_stages(packer: AbstractPacker, batch_size: int, n_batches: int) -> dict:
+    """Seconds per sample of every stage, the packer runs in this process with its methods wrapped in timers."""
+    profile.reset_times()
+    # fetching is sampling document keys and reading the documents by key
+    packer.dataset.get_document_keys = timed("fetch", packer.dataset.get_document_keys)
+    packer.dataset.get_document_by_key = timed(
+        "fetch", packer.dataset.get_document_by_key
+    )
+    packer.tokenizer.texts_to_ids = timed("tokenize", packer.tokenizer.texts_to_ids)
+    if isinstance(packer, BERTPacker):
+        packer._mask_window = timed("mask", packer._mask_window)
+    get_sample = timed("get_sample", packer.get_sample)
+    collate = timed("collate", LLMBatch)
+
+    for _ in range(n_batches):
+        collate([get_sample() for _ in range(batch_size)])
+
+    n_samples = n_batches * batch_size
+    seconds = {
+        stage: sum(profile.GLOBAL_TIMERS.get(stage, [])) / n_samples for stage in STAGES
+    }
+    # what is left of get_sample after fetching, tokenizing and masking is cutting the window
+    seconds["pack"] = seconds["get_sample"] - sum(
+        seconds[stage] for stage in ["fetch", "tokenize", "mask"]
+    )
+    return seconds
+
+
+def measure_throughput(
+    make_packer: Callable[[], AbstractPacker],
+    batch_size: int,
+    num_workers: int,
+    n_batches: int,
+    warmup: int,
+    shared_memory_batches: bool,
+) -> dict:
+    packer = make_packer()
+    wrapper = wrap_packer(
+        packer,
+        batch_size=batch_size,
+        device=torch.device("cpu"),
+        num_workers=num_workers,
+        seed=0,
+        shared_memory_batches=shared_memory_batches,
+    )
+    for _ in range(warmup):
+        wrapper.get_batch()
+    start = time.time()
+    for _ in range(n_batches):
+        wrapper.get_batch()
+    elapsed = time.time() - start
+    return {
+        "num_workers": num_workers,
+        "batch_size": batch_size,
+        "batches_per_second": n_batches / elapsed,
+        "tokens_per_second": n_batches * batch_size * packer.sequence_length / elapsed,
+    }
+
+
+def run_benchmark(
+    model_type: str,
+    sequence_length: int,
+    num_workers_list: List[int],
+    batch_sizes: List[int],
+    n_batches: int,
+    warmup: int,
+    corpus: Optional[str] = None,
+    n_documents: int = 10_000,
+    dummy_tokenizer: bool = False,
+    streaming_packer: bool = False,
+    shared_memory_batches: bool = False,
+    tokenization_batch_size: int = 64,
+) -> dict:
+    documents = (
+        load_corpus(corpus)
+        if corpus is not None
+        else make_synthetic_corpus(n_documents)
+    )
+    tokenizer_maker = None
+    if dummy_tokenizer:
+        tokenizer_maker = (
+            DummyGPTTokenizer if model_type == "gpt" else DummyBertTokenizer
+        )
+
+    def make_packer():
+        return get_packer(
+            model_type,
+            ListDataset(documents),
+            sequence_length,
+            streaming_packer=streaming_packer,
+            tokenization_batch_size=tokenization_batch_size,
+            tokenizer_maker=tokenizer_maker,
+        )
+
+    return {
+        "config": {
+            "model_type": model_type,
+            "sequence_length": sequence_length,
+            "corpus": corpus if corpus is not None else "synthetic",
+            "n_documents": len(documents),
+            "dummy_tokenizer": dummy_tokenizer,
+            "streaming_packer": streaming_packer,
+            "shared_memory_batches": shared_memory_batches,
+            "tokenization_batch_size": tokenization_batch_size,
+            "n_batches": n_batches,
+        },
+        "stage_seconds_per_sample": measure_stages(
+            make_packer(), max(batch_sizes), n_batches
+        ),
+        "throughput": [
+            measure_throughput(
+                make_packer,
+                batch_size,
+                num_workers,
+                n_batches,
+                warmup,
+                shared_memory_batches,
+            )
+            for num_workers in num_workers_list
+            for batch_size in batch_sizes
+        ],
+    }
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(x) for x in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model_type", choices=["gpt", "bert"], default="gpt")
+    parser.add_argument("--sequence_length", type=int, default=512)
+    parser.add_argument("--num_workers", type=parse_int_list, default=[0, 2, 4])
+    parser.add_argument("--batch_sizes", type=parse_int_list, default=[32, 128])
+    parser.add_argument("--n_batches", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument(
+        "--corpus",
+        type=str,
+        default=None,
+        help="text file with a document per line or a .jsonl file, synthetic documents if not given",
+    )
+    parser.add_argument("--n_documents", type=int, default=10_000)
+    parser.add_argument(
+        "--dummy_tokenizer",
+        action="store_true",
+        help="whitespace tokenizer instead of the HF one, doesn't need the hub",
+    )
+    parser.add_argument("--streaming_packer", action="store_true")
+    parser.add_argument("--shared_memory_batches", action="store_true")
+    parser.add_argument("--tokenization_batch_size", type=int, default=64)
+    parser.add_argument(
+        "--output",
+        type=str,
+        default=None,
+        help="file to write the JSON report to, printed to stdout if not given",
+    )
+    args = parser.parse_args()
+
+    # workers inherit the redirected stdout, so their logs don't mix with the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = run_benchmark(
+            args.model_type,
+            args.sequence_length,
+            args.num_workers,
+            args.batch_sizes,
+            args.n_batches,
+            args.warmup,
+            corpus=args.corpus,
+            n_documents=args.n_documents,
+            dummy_tokenizer=args.dummy_tokenizer,
+            streaming_packer=args.streaming_packer,
+            shared_memory_batches=args.shared_memory_batches,
+            tokenization_batch_size=args.tokenization_batch_size,
+        )
+    report_json = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(report_json)
+    else:
+        print(report_json)
+
+
+if __name__ == "__main__":
+    main()
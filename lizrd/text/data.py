@@ -1,17 +1,44 @@
-from typing import List
+from typing import List, Optional
 
 import numpy as np
 import torch
 from attr import dataclass
 
+TOKEN_DTYPE = np.int32
+LOSS_MASK_DTYPE = np.uint8
+DOCUMENT_ID_DTYPE = np.int32
+
+
+def get_document_ids_from_separators(
+    tokens: np.ndarray, separator_id: int
+) -> np.ndarray:
+    """
+    Index of the document every token belongs to, counted from the start of the window.
+    A separator belongs to the document it closes.
+    """
+    is_separator = np.asarray(tokens) == separator_id
+    return (np.cumsum(is_separator) - is_separator).astype(DOCUMENT_ID_DTYPE)
+
 
 @dataclass
 class LLMExample(object):
-    input_ids: List[int]
-    target_ids: List[int]
-    should_calculate_loss: List[
-        int
-    ]  # e.g. in BERT loss is not calculated over non-masked tokens
+    input_ids: np.ndarray
+    target_ids: np.ndarray
+    should_calculate_loss: np.ndarray  # e.g. in BERT loss is not calculated over non-masked tokens
+    # documents packed into the window, the whole window is a single document if not given
+    document_ids: Optional[np.ndarray] = None
+
+    def __attrs_post_init__(self):
+        # compact arrays make examples cheap to collate and to pickle between dataloader workers
+        self.input_ids = np.asarray(self.input_ids, dtype=TOKEN_DTYPE)
+        self.target_ids = np.asarray(self.target_ids, dtype=TOKEN_DTYPE)
+        self.should_calculate_loss = np.asarray(
+            self.should_calculate_loss, dtype=LOSS_MASK_DTYPE
+        )
+        if self.document_ids is None:
+            self.document_ids = np.zeros(len(self.input_ids), dtype=DOCUMENT_ID_DTYPE)
+        else:
+            self.document_ids = np.asarray(self.document_ids, dtype=DOCUMENT_ID_DTYPE)
 
 
 class LLMBatch:
@@ -23,15 +50,42 @@ class LLMBatch:
         self.should_calculate_loss = self._make_tensor(
             [example.should_calculate_loss for example in examples]
         )
+        self.document_ids = self._make_tensor(
+            [example.document_ids for example in examples]
+        )
 
         assert self.input_ids.shape == self.target_ids.shape
         assert self.input_ids.shape == self.should_calculate_loss.shape
+        assert self.input_ids.shape == self.document_ids.shape
+
+    @classmethod
+    def from_tensors(
+        cls,
+        input_ids: torch.Tensor,
+        target_ids: torch.Tensor,
+        should_calculate_loss: torch.Tensor,
+        document_ids: torch.Tensor,
+    ) -> "LLMBatch":
+        """Wraps already collated tensors without copying them."""
+        assert (
+            input_ids.shape
+            == target_ids.shape
+            == should_calculate_loss.shape
+            == document_ids.shape
+        )
+        batch = cls.__new__(cls)
+        batch.input_ids = input_ids
+        batch.target_ids = target_ids
+        batch.should_calculate_loss = should_calculate_loss
+        batch.document_ids = document_ids
+        return batch
 
     def pin_memory(self):
         """Pin memory for faster transfer to GPU as described in https://pytorch.org/docs/stable/data.html#memory-pinning"""
         self.input_ids = self.input_ids.pin_memory()
         self.target_ids = self.target_ids.pin_memory()
         self.should_calculate_loss = self.should_calculate_loss.pin_memory()
+        self.document_ids = self.document_ids.pin_memory()
         return self
 
     def __iter__(self):
@@ -50,15 +104,20 @@ class LLMBatch:
             self.input_ids.device
             == self.target_ids.device
             == self.should_calculate_loss.device
+            == self.document_ids.device
         )
         return self.input_ids.device
 
-    def to(self, device) -> "LLMBatch":
-        self.input_ids = self.input_ids.to(device)
-        self.target_ids = self.target_ids.to(device)
-        self.should_calculate_loss = self.should_calculate_loss.to(device)
+    def to(self, device, non_blocking: bool = False) -> "LLMBatch":
+        self.input_ids = self.input_ids.to(device, non_blocking=non_blocking)
+        self.target_ids = self.target_ids.to(device, non_blocking=non_blocking)
+        self.should_calculate_loss = self.should_calculate_loss.to(
+            device, non_blocking=non_blocking
+        )
+        self.document_ids = self.document_ids.to(device, non_blocking=non_blocking)
         return self
 
-    def _make_tensor(self, list_of_token_lists: List[List[int]]) -> torch.Tensor:
-        matrix = np.array(list_of_token_lists)
-        return torch.from_numpy(matrix)
+    def _make_tensor(self, arrays: List[np.ndarray]) -> torch.Tensor:
+        # a single copy into a freshly allocated array; the array can't be reused between batches,
+        # because the DataLoader moves its storage to shared memory that the trainer keeps reading
+        return torch.from_numpy(np.stack(arrays))
@@ -1,15 +1,48 @@
 from abc import abstractmethod
+from collections import OrderedDict
+import hashlib
+import json
+import os
 import random
-from typing import Optional
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 
 from datasets import load_dataset
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lizrd.text.token_shards import get_split_shards_dir, load_shards_metadata
+
+
+def get_shard_size(n_documents: int, shard_id: int, n_shards: int) -> int:
+    """Number of documents `i < n_documents` with `i % n_shards == shard_id`."""
+    return max(0, (n_documents - shard_id + n_shards - 1) // n_shards)
 
 
 class AbstractDataset:
     def __init__(self, seed: Optional[int] = None):
+        self.shard_id = 0
+        self.n_shards = 1
         self.set_rng(seed)
 
+    def set_shard(self, shard_id: int, n_shards: int):
+        """
+        Restrict sampling to the documents with `document_id % n_shards == shard_id`.
+        Every (rank, dataloader worker) pair gets its own shard, so no two of them ever read the same document.
+        """
+        assert 0 <= shard_id < n_shards, f"Invalid shard {shard_id} of {n_shards}"
+        self.shard_id = shard_id
+        self.n_shards = n_shards
+
+    def sample_document_id(self, n_documents: int) -> int:
+        """Random id in `range(n_documents)` belonging to the shard of this dataset."""
+        shard_size = get_shard_size(n_documents, self.shard_id, self.n_shards)
+        assert shard_size > 0, (
+            f"Shard {self.shard_id} of {self.n_shards} is empty, "
+            f"there are only {n_documents} documents"
+        )
+        return self.shard_id + int(self.np_rng.integers(shard_size)) * self.n_shards
+
     def set_rng(self, seed: Optional[int] = None):
         np_rng = np.random.default_rng(seed)
         py_rng = random.Random(seed)
@@ -17,11 +50,112 @@ class AbstractDataset:
         self.np_rng = np_rng
         self.py_rng = py_rng
 
+    def state_dict(self) -> dict:
+        return {
+            "np_rng": self.np_rng.bit_generator.state,
+            "py_rng": self.py_rng.getstate(),
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        self.np_rng.bit_generator.state = state_dict["np_rng"]
+        self.py_rng.setstate(state_dict["py_rng"])
+
     @abstractmethod
+    def get_document_key(self):
+        """
+        Samples a document and returns a small key of it, e.g. its index, that `get_document_by_key` reads it with.
+        Packers keep the keys of pending documents in their states instead of texts or tokens.
+        """
+        raise NotImplementedError()
+
+    def get_document_by_key(self, key) -> str:
+        raise NotImplementedError()
+
     def get_document(self) -> str:
+        return self.get_document_by_key(self.get_document_key())
+
+    def get_document_keys(self, n_documents: int) -> list:
+        return [self.get_document_key() for _ in range(n_documents)]
+
+    def get_documents(self, n_documents: int) -> List[str]:
+        return [
+            self.get_document_by_key(key) for key in self.get_document_keys(n_documents)
+        ]
+
+    def count_tokens(self, document_lengths: List[int]):
+        """Called by packers with the token counts of the documents of the last `get_document_keys` call."""
+
+    def iterate_documents(self) -> Iterator[str]:
+        """Iterate over all documents of the split in a fixed order, e.g. for offline tokenization."""
         raise NotImplementedError()
 
 
+class ListDataset(AbstractDataset):
+    """In-memory dataset of a fixed list of documents."""
+
+    def __init__(self, documents: List[str], seed: Optional[int] = None):
+        super().__init__(seed=seed)
+        self.documents = documents
+
+    def get_document_key(self) -> int:
+        return self.sample_document_id(len(self.documents))
+
+    def get_document_by_key(self, key: int) -> str:
+        return self.documents[key]
+
+    def iterate_documents(self) -> Iterator[str]:
+        return iter(self.documents)
+
+
+def belongs_to_split(
+    document_ids: np.ndarray, split: str, eval_percentage: int = 5
+) -> np.ndarray:
+    """Vectorized `hash(document_id) % 100` split rule, `hash` is the identity for document ids."""
+    if split == "train":
+        return document_ids % 100 >= eval_percentage
+    elif split == "eval":
+        return document_ids % 100 < eval_percentage
+    else:
+        raise ValueError("split must be either 'train' or 'eval'")
+
+
+def get_split_index_cache_dir() -> str:
+    return os.path.join(
+        os.getenv(
+            "HF_DATASETS_CACHE",
+            os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "datasets"),
+        ),
+        "split_indices",
+    )
+
+
+def get_split_index(
+    dataset_name: str,
+    n_documents: int,
+    split: str,
+    eval_percentage: int = 5,
+    cache_dir: Optional[str] = None,
+) -> np.ndarray:
+    """
+    Returns the sorted ids of documents belonging to the split.
+    The index is computed once and cached to disk, then every process memory-maps the same file.
+    """
+    cache_dir = cache_dir if cache_dir is not None else get_split_index_cache_dir()
+    path = os.path.join(
+        cache_dir, f"{dataset_name}_{n_documents}_{split}_{eval_percentage}.npy"
+    )
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        document_ids = np.arange(n_documents, dtype=np.int64)
+        split_ids = document_ids[belongs_to_split(document_ids, split, eval_percentage)]
+        dtype = np.uint32 if n_documents < 2**32 else np.uint64
+        # write to a temporary file first, so that concurrent processes never read a partial index
+        tmp_path = f"{path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, split_ids.astype(dtype))
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
 class WikiBookDataset(AbstractDataset):
     def __init__(
         self,
@@ -44,36 +178,40 @@ class WikiBookDataset(AbstractDataset):
 
         self.bookcorpus_chance = len(self.dataset_book) / len(self.dataset_wiki)
 
-    def get_document(self) -> str:
+        self.wiki_split_ids = get_split_index(
+            f"wikipedia_{'simple' if use_dummy_dataset else 'en'}",
+            len(self.dataset_wiki),
+            split,
+        )
+        self.book_split_ids = get_split_index(
+            "bookcorpus" if not use_dummy_dataset else "wikipedia_simple",
+            len(self.dataset_book),
+            split,
+        )
+
+    def get_document_key(self) -> Tuple[int, int]:
+        """`(0, id)` of a bookcorpus document or `(1, id)` of a wikipedia one."""
         selector = self.py_rng.random()
         if selector < self.bookcorpus_chance:
-            return self._get_random_book_example()
+            split_ids = self.book_split_ids
+            source = 0
         else:
-            return self._get_random_wiki_example()
+            split_ids = self.wiki_split_ids
+            source = 1
+        return source, int(split_ids[self.sample_document_id(len(split_ids))])
 
-    def _belongs_to_split(self, document_id: int) -> bool:
-        eval_percentage = 5
+    def get_document_by_key(self, key: Tuple[int, int]) -> str:
+        source, doc_id = key
+        dataset = self.dataset_book if source == 0 else self.dataset_wiki
+        return dataset[doc_id]["text"]
 
-        if self.split == "train":
-            return hash(document_id) % 100 >= eval_percentage
-        elif self.split == "eval":
-            return hash(document_id) % 100 < eval_percentage
-        else:
-            raise ValueError("split must be either 'train' or 'eval'")
-
-    def _get_random_book_example(self) -> str:
-        doc_id = None
-        while doc_id is None or not self._belongs_to_split(doc_id):
-            doc_id = self.py_rng.randint(0, len(self.dataset_book) - 1)
-        document = self.dataset_book[doc_id]
-        return document["text"]
-
-    def _get_random_wiki_example(self) -> str:
-        doc_id = None
-        while doc_id is None or not self._belongs_to_split(doc_id):
-            doc_id = self.py_rng.randint(0, len(self.dataset_book) - 1)
-        document = self.dataset_wiki[doc_id]
-        return document["text"]
+    def iterate_documents(self) -> Iterator[str]:
+        for dataset, split_ids in [
+            (self.dataset_wiki, self.wiki_split_ids),
+            (self.dataset_book, self.book_split_ids),
+        ]:
+            for doc_id in split_ids:
+                yield dataset[int(doc_id)]["text"]
 
 
 class C4Dataset(AbstractDataset):
@@ -83,5 +221,479 @@ class C4Dataset(AbstractDataset):
         super().__init__(seed=seed)
         self.dataset = load_dataset("c4", "en", split=split)
 
-    def get_document(self) -> str:
-        return self.dataset[self.py_rng.randint(0, len(self.dataset) - 1)]["text"]
+    def get_document_key(self) -> int:
+        return self.sample_document_id(len(self.dataset))
+
+    def get_document_by_key(self, key: int) -> str:
+        return self.dataset[key]["text"]
+
+    def iterate_documents(self) -> Iterator[str]:
+        for document in self.dataset:
+            yield document["text"]
+
+
+LOCAL_CORPUS_EXTENSIONS = (".arrow", ".jsonl", ".parquet")
+
+
+def get_local_corpus_index_cache_dir() -> str:
+    return os.path.join(
+        os.path.dirname(get_split_index_cache_dir()), "local_corpus_indices"
+    )
+
+
+def get_local_corpus_hash(path: str) -> str:
+    return hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:12]
+
+
+def list_local_corpus_files(path: str) -> List[str]:
+    return sorted(
+        name for name in os.listdir(path) if name.endswith(LOCAL_CORPUS_EXTENSIONS)
+    )
+
+
+def read_arrow_table(path: str) -> pa.Table:
+    """Memory-maps an arrow file, both the file format and the stream format of `datasets` caches are accepted."""
+    source = pa.memory_map(path)
+    try:
+        return pa.ipc.open_file(source).read_all()
+    except pa.ArrowInvalid:
+        source.seek(0)
+        return pa.ipc.open_stream(source).read_all()
+
+
+def index_jsonl_lines(path: str, chunk_size: int = 2**26) -> np.ndarray:
+    """Byte offsets `(start, end)` of the non-empty lines of a `.jsonl` file, read in chunks of `chunk_size` bytes."""
+    line_ends = [np.zeros(0, dtype=np.int64)]
+    position = 0
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == ord("\n"))
+            line_ends.append(newlines.astype(np.int64) + position + 1)
+            position += len(chunk)
+    line_ends = np.concatenate(line_ends)
+    if len(line_ends) == 0 or line_ends[-1] != position:
+        line_ends = np.append(line_ends, position)
+    line_starts = np.concatenate([[0], line_ends[:-1]])
+    # empty lines are not documents
+    non_empty = line_ends - line_starts > 1
+    return np.stack([line_starts[non_empty], line_ends[non_empty]], axis=1)
+
+
+class JsonlShard:
+    """Random access to the lines of a `.jsonl` file through a memory map and the line offsets of the index."""
+
+    def __init__(self, path: str, text_field: str, line_offsets: np.ndarray):
+        self.text_field = text_field
+        self.data = (
+            np.memmap(path, dtype=np.uint8, mode="r")
+            if os.path.getsize(path) > 0
+            else np.zeros(0, dtype=np.uint8)
+        )
+        self.line_offsets = line_offsets
+
+    def __len__(self) -> int:
+        return len(self.line_offsets)
+
+    def get_text(self, index: int) -> str:
+        start, end = self.line_offsets[index]
+        return json.loads(self.data[start:end].tobytes())[self.text_field]
+
+
+class ArrowShard:
+    def __init__(self, table: pa.Table, text_field: str):
+        self.texts = table.column(text_field)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def get_text(self, index: int) -> str:
+        return self.texts[index].as_py()
+
+
+class ParquetShard:
+    """
+    Decodes only the row group holding the requested document, the last decoded one is kept,
+    so reading documents in order decodes every row group once.
+    """
+
+    def __init__(self, path: str, text_field: str, row_group_sizes: List[int]):
+        self.file = pq.ParquetFile(path, memory_map=True)
+        self.text_field = text_field
+        self.row_group_starts = np.concatenate([[0], np.cumsum(row_group_sizes)])
+        self._row_group_num: Optional[int] = None
+        self._texts = None
+
+    def __len__(self) -> int:
+        return int(self.row_group_starts[-1])
+
+    def get_text(self, index: int) -> str:
+        row_group_num = (
+            int(np.searchsorted(self.row_group_starts, index, side="right")) - 1
+        )
+        if row_group_num != self._row_group_num:
+            self._texts = self.file.read_row_group(
+                row_group_num, columns=[self.text_field]
+            ).column(self.text_field)
+            self._row_group_num = row_group_num
+        return self._texts[index - int(self.row_group_starts[row_group_num])].as_py()
+
+
+def get_line_offsets_path(index_dir: str, name: str) -> str:
+    return os.path.join(index_dir, f"{name}.lines.npy")
+
+
+def index_local_shard(path: str, text_field: str, index_dir: str) -> dict:
+    """
+    Document count of a shard and what is needed to read a single document without scanning it:
+    line offsets of a `.jsonl` file, saved next to the index, and row group sizes of a `.parquet` file.
+    `.arrow` files are memory-mapped, they need nothing.
+    """
+    stat = os.stat(path)
+    info = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    if path.endswith(".jsonl"):
+        line_offsets = index_jsonl_lines(path)
+        offsets_path = get_line_offsets_path(index_dir, os.path.basename(path))
+        tmp_path = f"{offsets_path}.{os.getpid()}.tmp.npy"
+        np.save(tmp_path, line_offsets)
+        os.replace(tmp_path, offsets_path)
+        info["n_documents"] = len(line_offsets)
+    elif path.endswith(".parquet"):
+        metadata = pq.read_metadata(path)
+        info["row_group_sizes"] = [
+            metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)
+        ]
+        info["n_documents"] = metadata.num_rows
+    elif path.endswith(".arrow"):
+        info["n_documents"] = len(read_arrow_table(path))
+    else:
+        raise ValueError(f"Unsupported shard format: {path}")
+    return info
+
+
+def open_local_shard(path: str, text_field: str, info: dict, index_dir: str):
+    if path.endswith(".jsonl"):
+        line_offsets = np.load(
+            get_line_offsets_path(index_dir, os.path.basename(path)), mmap_mode="r"
+        )
+        return JsonlShard(path, text_field, line_offsets)
+    elif path.endswith(".arrow"):
+        return ArrowShard(read_arrow_table(path), text_field)
+    elif path.endswith(".parquet"):
+        return ParquetShard(path, text_field, info["row_group_sizes"])
+    else:
+        raise ValueError(f"Unsupported shard format: {path}")
+
+
+def load_local_corpus_index(
+    path: str, text_field: str, index_dir: str
+) -> Dict[str, dict]:
+    """
+    Index of every shard of the directory, see `index_local_shard`. It is built once and stored in `index_dir`,
+    not next to the shards, which may be read-only. Shards changed since are indexed again.
+    """
+    index_path = os.path.join(index_dir, "index.json")
+    cached = {}
+    if os.path.exists(index_path):
+        with open(index_path) as f:
+            index = json.load(f)
+        if index["text_field"] == text_field:
+            cached = index["shards"]
+
+    os.makedirs(index_dir, exist_ok=True)
+    shards = {}
+    for name in list_local_corpus_files(path):
+        stat = os.stat(os.path.join(path, name))
+        info = cached.get(name)
+        if (
+            info is None
+            or info["size"] != stat.st_size
+            or info["mtime_ns"] != stat.st_mtime_ns
+        ):
+            info = index_local_shard(os.path.join(path, name), text_field, index_dir)
+        shards[name] = info
+    if shards != cached:
+        # write to a temporary file first, so that concurrent processes never read a partial index
+        tmp_path = f"{index_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"text_field": text_field, "shards": shards}, f, indent=2)
+        os.replace(tmp_path, index_path)
+    return shards
+
+
+class LocalCorpusDataset(AbstractDataset):
+    """
+    Dataset of raw texts stored as a local directory of `.arrow`, `.jsonl` or `.parquet` shards,
+    e.g. files saved by `datasets` or downloaded once from the hub. Nothing is loaded at construction:
+    a shard is opened only when a document is sampled from it and at most `max_open_shards`
+    recently used shards are kept open, so it works offline and new workers start in seconds.
+    Opening a shard reads only its offsets from the index in `cache_dir` and a document reads only its line
+    or, for `.parquet`, its row group, so write parquet shards with small row groups.
+    `split` selects the documents with the same rule as the other datasets, `None` uses all of them.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        seed: Optional[int] = None,
+        split: Optional[str] = "train",
+        text_field: str = "text",
+        max_open_shards: int = 4,
+        cache_dir: Optional[str] = None,
+    ):
+        super().__init__(seed=seed)
+        assert max_open_shards > 0
+        self.path = path
+        self.text_field = text_field
+        self.max_open_shards = max_open_shards
+        path_hash = get_local_corpus_hash(path)
+        self.index_dir = os.path.join(
+            cache_dir if cache_dir is not None else get_local_corpus_index_cache_dir(),
+            f"local_{path_hash}",
+        )
+        self.shards = load_local_corpus_index(path, text_field, self.index_dir)
+        assert (
+            len(self.shards) > 0
+        ), f"No {LOCAL_CORPUS_EXTENSIONS} files found in {path}"
+        self.shard_files = list(self.shards)
+        # global id of the first document of every shard, and the total count at the end
+        self.shard_starts = np.concatenate(
+            [[0], np.cumsum([info["n_documents"] for info in self.shards.values()])]
+        )
+        n_documents = int(self.shard_starts[-1])
+        if split is None:
+            self.split_ids = np.arange(n_documents)
+        else:
+            self.split_ids = get_split_index(f"local_{path_hash}", n_documents, split)
+        self._open_shards: OrderedDict = OrderedDict()
+
+    def __getstate__(self):
+        # shards are reopened in every process instead of being pickled by value
+        state = self.__dict__.copy()
+        state["_open_shards"] = OrderedDict()
+        return state
+
+    def get_document_key(self) -> int:
+        return int(self.split_ids[self.sample_document_id(len(self.split_ids))])
+
+    def get_document_by_key(self, key: int) -> str:
+        return self._get_text(key)
+
+    def iterate_documents(self) -> Iterator[str]:
+        for doc_id in self.split_ids:
+            yield self._get_text(int(doc_id))
+
+    def _get_text(self, doc_id: int) -> str:
+        shard_num = int(np.searchsorted(self.shard_starts, doc_id, side="right")) - 1
+        return self._get_shard(shard_num).get_text(
+            doc_id - int(self.shard_starts[shard_num])
+        )
+
+    def _get_shard(self, shard_num: int):
+        if shard_num in self._open_shards:
+            self._open_shards.move_to_end(shard_num)
+        else:
+            if len(self._open_shards) >= self.max_open_shards:
+                self._open_shards.popitem(last=False)
+            name = self.shard_files[shard_num]
+            self._open_shards[shard_num] = open_local_shard(
+                os.path.join(self.path, name),
+                self.text_field,
+                self.shards[name],
+                self.index_dir,
+            )
+        return self._open_shards[shard_num]
+
+
+class PretokenizedDataset(AbstractDataset):
+    """
+    Dataset backed by flat token shards written by `lizrd.scripts.tokenize_dataset`.
+    Shards are memory-mapped lazily, so copies of the dataset in DataLoader workers share the page cache
+    and nothing is tokenized at training time.
+    Every document in a shard is already followed by `separator_id`.
+    With `split`, shards are taken from the `<path>/<split>` subdirectory if there is one, and must hold that split.
+    """
+
+    def __init__(
+        self, path: str, seed: Optional[int] = None, split: Optional[str] = None
+    ):
+        super().__init__(seed=seed)
+        if split is not None:
+            path = get_split_shards_dir(path, split)
+        self.path = path
+        self.metadata = load_shards_metadata(path)
+        # shards written before the split was recorded are train shards, the default of `tokenize_dataset`
+        shards_split = self.metadata.get("split") or "train"
+        if split is not None and shards_split != split:
+            raise ValueError(
+                f"Shards in {path} hold the {shards_split} split, not {split}. "
+                f"Tokenize it with `--split {split}` into {os.path.join(path, split)}"
+            )
+        self.separator_id: int = self.metadata["separator_id"]
+        self.tokenizer_name: str = self.metadata["tokenizer"]
+        self.shard_token_counts = np.array(
+            [shard["n_tokens"] for shard in self.metadata["shards"]], dtype=np.int64
+        )
+        assert len(self.shard_token_counts) > 0, f"No token shards found in {path}"
+        self._shards: Optional[List[np.memmap]] = None
+        self._offsets: Optional[List[np.ndarray]] = None
+
+    def __getstate__(self):
+        # memmaps are reopened in every process instead of being pickled by value
+        state = self.__dict__.copy()
+        state["_shards"] = None
+        state["_offsets"] = None
+        return state
+
+    @property
+    def shards(self) -> List[np.memmap]:
+        if self._shards is None:
+            dtype = np.dtype(self.metadata["dtype"])
+            self._shards = [
+                np.memmap(os.path.join(self.path, shard["tokens"]), dtype, mode="r")
+                for shard in self.metadata["shards"]
+            ]
+        return self._shards
+
+    @property
+    def offsets(self) -> List[np.ndarray]:
+        if self._offsets is None:
+            self._offsets = [
+                np.load(os.path.join(self.path, shard["index"]), mmap_mode="r")
+                for shard in self.metadata["shards"]
+            ]
+        return self._offsets
+
+    def get_document_by_key(self, key: Tuple[int, int]) -> str:
+        raise NotImplementedError(
+            "PretokenizedDataset stores token ids only, use get_document_ids or get_window"
+        )
+
+    def get_document_key(self) -> Tuple[int, int]:
+        """`(shard, document in the shard)` of a random document."""
+        shard_id = int(self._sample_shard())
+        return shard_id, self.sample_document_id(len(self.offsets[shard_id]) - 1)
+
+    def get_document_ids_by_key(self, key: Tuple[int, int]) -> np.ndarray:
+        """Returns the document together with its trailing separator."""
+        shard_id, doc_id = key
+        offsets = self.offsets[shard_id]
+        return self.shards[shard_id][offsets[doc_id] : offsets[doc_id + 1]]
+
+    def get_document_ids(self) -> np.ndarray:
+        return self.get_document_ids_by_key(self.get_document_key())
+
+    def get_window(self, length: int) -> np.ndarray:
+        """
+        Returns a view of `length` consecutive tokens starting at a random position of a random shard.
+        With `set_shard`, every file is cut into `n_shards` contiguous token ranges and windows
+        never cross the range of this dataset's shard.
+        """
+        shard_id = self._sample_shard(min_tokens=length)
+        begin, end = self._get_token_range(self.shard_token_counts[shard_id])
+        start = self.np_rng.integers(begin, end - length + 1)
+        return self.shards[shard_id][start : start + length]
+
+    def _get_token_range(self, n_tokens: int):
+        begin = n_tokens * self.shard_id // self.n_shards
+        end = n_tokens * (self.shard_id + 1) // self.n_shards
+        return begin, end
+
+    def _sample_shard(self, min_tokens: int = 1) -> int:
+        begin, end = self._get_token_range(self.shard_token_counts)
+        available_tokens = end - begin
+        weights = np.where(available_tokens >= min_tokens, available_tokens, 0)
+        if weights.sum() == 0:
+            raise ValueError(
+                f"No shard in {self.path} holds at least {min_tokens} tokens"
+            )
+        return self.np_rng.choice(len(weights), p=weights / weights.sum())
+
+
+class MixtureDataset(AbstractDataset):
+    """
+    Samples documents from several datasets with given weights.
+    Documents go through a shuffle buffer of `shuffle_buffer_size` documents, so sources are interleaved
+    without holding any of them in memory. The buffer holds `(source, key)` keys only, texts are read when
+    a document leaves it, so the state stays small.
+    `source_token_counts` counts the tokens a packer got from every source, see `count_tokens`.
+    """
+
+    def __init__(
+        self,
+        datasets: List[AbstractDataset],
+        weights: List[float],
+        names: Optional[List[str]] = None,
+        seed: Optional[int] = None,
+        shuffle_buffer_size: int = 128,
+    ):
+        assert len(datasets) == len(weights) > 0
+        assert all(weight >= 0 for weight in weights) and sum(weights) > 0
+        self.datasets = datasets
+        self.weights = np.asarray(weights, dtype=np.float64) / sum(weights)
+        self.names = (
+            names
+            if names is not None
+            else [f"source_{i}" for i in range(len(datasets))]
+        )
+        assert len(self.names) == len(datasets)
+        self.shuffle_buffer_size = shuffle_buffer_size
+        super().__init__(seed=seed)
+
+    def set_rng(self, seed: Optional[int] = None):
+        super().set_rng(seed)
+        source_seeds = (
+            np.random.SeedSequence(seed).generate_state(len(self.datasets))
+            if seed is not None
+            else [None] * len(self.datasets)
+        )
+        for dataset, source_seed in zip(self.datasets, source_seeds):
+            dataset.set_rng(None if source_seed is None else int(source_seed))
+        self.buffer: List[Tuple[int, Any]] = []
+        self.last_sources: List[int] = []
+        self.source_token_counts = np.zeros(len(self.datasets), dtype=np.int64)
+
+    def set_shard(self, shard_id: int, n_shards: int):
+        super().set_shard(shard_id, n_shards)
+        for dataset in self.datasets:
+            dataset.set_shard(shard_id, n_shards)
+
+    def state_dict(self) -> dict:
+        return {
+            **super().state_dict(),
+            "datasets": [dataset.state_dict() for dataset in self.datasets],
+            "buffer": list(self.buffer),
+            "last_sources": list(self.last_sources),
+            "source_token_counts": self.source_token_counts.copy(),
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        super().load_state_dict(state_dict)
+        for dataset, dataset_state in zip(self.datasets, state_dict["datasets"]):
+            dataset.load_state_dict(dataset_state)
+        self.buffer = list(state_dict["buffer"])
+        self.last_sources = list(state_dict["last_sources"])
+        self.source_token_counts = state_dict["source_token_counts"].copy()
+
+    def get_document_key(self) -> Tuple[int, Any]:
+        return self.get_document_keys(1)[0]
+
+    def get_document_keys(self, n_documents: int) -> List[Tuple[int, Any]]:
+        keys = [self._get_shuffled_key() for _ in range(n_documents)]
+        self.last_sources = [source for source, _ in keys]
+        return keys
+
+    def get_document_by_key(self, key: Tuple[int, Any]) -> str:
+        source, source_key = key
+        return self.datasets[source].get_document_by_key(source_key)
+
+    def count_tokens(self, document_lengths: List[int]):
+        assert len(document_lengths) == len(self.last_sources)
+        np.add.at(self.source_token_counts, self.last_sources, document_lengths)
+
+    def _get_shuffled_key(self) -> Tuple[int, Any]:
+        while len(self.buffer) < self.shuffle_buffer_size:
+            source = int(self.np_rng.choice(len(self.datasets), p=self.weights))
+            self.buffer.append((source, self.datasets[source].get_document_key()))
+        index = self.py_rng.randrange(len(self.buffer))
+        self.buffer[index], self.buffer[-1] = self.buffer[-1], self.buffer[index]
+        return self.buffer.pop()
@@ -1,22 +1,21 @@
 from abc import ABC, abstractmethod
-import itertools
 import random
-from typing import Callable, Iterator, List, Optional, Tuple
+import time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 from attr import define
 
 import numpy as np
 from torch.utils.data import IterableDataset
 
-from lizrd.text.datasets import AbstractDataset
-from lizrd.text.data import LLMExample as LLMExample
+from lizrd.text.datasets import AbstractDataset, PretokenizedDataset
+from lizrd.text.data import (
+    TOKEN_DTYPE,
+    LLMExample as LLMExample,
+    get_document_ids_from_separators,
+)
 from lizrd.text.tokenizers import AbstractTokenizer, BertTokenizer
 
 
-def take_circular(iterable, start, stop):
-    cycle = itertools.cycle(iterable)
-    return itertools.islice(cycle, start, stop)
-
-
 class AbstractPacker(ABC, IterableDataset):
     def __init__(
         self,
@@ -24,12 +23,23 @@ class AbstractPacker(ABC, IterableDataset):
         dataset: AbstractDataset,
         tokenizer_maker: Callable[[], AbstractTokenizer],
         seed: Optional[int] = None,
+        tokenization_batch_size: int = 64,
     ):
+        """
+        Documents are fetched and tokenized in batches of `tokenization_batch_size`,
+        so that the fast tokenizer can encode them in parallel.
+        """
         super().__init__()
         self._tokenizer = None
         self.dataset = dataset
         self.tokenizer_maker = tokenizer_maker
         self.sequence_length = sequence_length
+        self.tokenization_batch_size = tokenization_batch_size
+        # set in DataLoader workers, used to resume every worker from its own state
+        self.worker_id = 0
+        self.resume_worker_states: Dict[int, Tuple[int, Optional[dict]]] = {}
+        # seconds spent starting up this worker, sent once with its next batch, see `get_data_state`
+        self.startup_times: Dict[str, float] = {}
         self.set_rng(seed)
 
     def set_rng(self, seed: Optional[int] = None):
@@ -38,12 +48,40 @@ class AbstractPacker(ABC, IterableDataset):
 
         self.np_rng = np_rng
         self.py_rng = py_rng
+        # documents fetched and tokenized but not used yet, last to be used first
+        self.tokenized_documents: List[List[int]] = []
+        self.document_keys: list = []
+        self.samples_count = 0
 
         self.dataset.set_rng(seed)
 
     def __iter__(self) -> Iterator[LLMExample]:
         while True:
-            yield self.get_sample()
+            sample = self.get_sample()
+            self.samples_count += 1
+            yield sample
+
+    def state_dict(self) -> dict:
+        """
+        Everything needed to continue the stream of samples exactly where it stopped, without replaying it.
+        Pending documents are stored as their dataset keys, so the state is small enough to attach to every batch,
+        `load_state_dict` reads and tokenizes them again.
+        """
+        return {
+            "np_rng": self.np_rng.bit_generator.state,
+            "py_rng": self.py_rng.getstate(),
+            "document_keys": list(self.document_keys),
+            "samples_count": self.samples_count,
+            "dataset": self.dataset.state_dict(),
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        self.np_rng.bit_generator.state = state_dict["np_rng"]
+        self.py_rng.setstate(state_dict["py_rng"])
+        self.document_keys = list(state_dict["document_keys"])
+        self.tokenized_documents = self.tokenize_documents(self.document_keys)
+        self.samples_count = state_dict["samples_count"]
+        self.dataset.load_state_dict(state_dict["dataset"])
 
     @abstractmethod
     def get_sample(self) -> LLMExample:
@@ -52,9 +90,31 @@ class AbstractPacker(ABC, IterableDataset):
     @property
     def tokenizer(self) -> AbstractTokenizer:
         if self._tokenizer is None:
+            start = time.time()
             self._tokenizer = self.tokenizer_maker()
+            self.startup_times["tokenizer_load"] = time.time() - start
         return self._tokenizer
 
+    def get_tokenized_document(self) -> List[int]:
+        return self.get_keyed_document()[1]
+
+    def get_keyed_document(self) -> Tuple[Any, List[int]]:
+        """The next document with its dataset key."""
+        if len(self.tokenized_documents) == 0:
+            keys = self.dataset.get_document_keys(self.tokenization_batch_size)
+            self.tokenized_documents = self.tokenize_documents(keys)
+            self.dataset.count_tokens([len(ids) for ids in self.tokenized_documents])
+            # keep the order of the dataset
+            self.tokenized_documents.reverse()
+            self.document_keys = keys[::-1]
+        return self.document_keys.pop(), self.tokenized_documents.pop()
+
+    def tokenize_documents(self, keys: list) -> List[List[int]]:
+        if len(keys) == 0:
+            return []
+        documents = [self.dataset.get_document_by_key(key) for key in keys]
+        return self.tokenizer.texts_to_ids(documents)
+
 
 @define
 class MaskingReplacementConfig:
@@ -81,12 +141,14 @@ class BERTPacker(
         tokenizer_maker: Callable[[], AbstractTokenizer],
         mask_replace_config: MaskingReplacementConfig = MaskingReplacementConfig(),
         seed: Optional[int] = None,
+        tokenization_batch_size: int = 64,
     ):
         super().__init__(
             sequence_length,
             dataset,
             tokenizer_maker,
             seed=seed,
+            tokenization_batch_size=tokenization_batch_size,
         )
         self.mask_replace_config = mask_replace_config
 
@@ -94,71 +156,84 @@ class BERTPacker(
         """
         Sample examples from the dataset until we reach the desired sequence length.
         """
+        if isinstance(self.dataset, PretokenizedDataset):
+            return self._get_pretokenized_sample()
+
         target_ids: List[int] = []
-        input_ids: List[int] = []
-        calculate_loss: List[int] = []
         document_lengths: List[int] = []
 
         sep_id = self.tokenizer.sequence_separator_id
         assert sep_id is not None
 
         while True:
-            document = self.dataset.get_document()
-            tokens = self.tokenizer.text_to_ids(document)
-            masked_input, is_mask = self._mask_text(tokens)
-
+            tokens = self.get_tokenized_document()
             target_ids.extend(tokens + [sep_id])
-            input_ids.extend(masked_input + [sep_id])
-            calculate_loss.extend(is_mask + [0])
 
             document_lengths.append(len(tokens) + 1)
             if (sum(document_lengths) - max(document_lengths)) > self.sequence_length:
                 break
 
         sample_start = self.py_rng.randint(0, len(target_ids) - 1)
-        sample_end = sample_start + self.sequence_length
+        target_ids = np.take(
+            np.asarray(target_ids, dtype=TOKEN_DTYPE),
+            np.arange(sample_start, sample_start + self.sequence_length),
+            mode="wrap",
+        )
+        input_ids, calculate_loss = self._mask_window(target_ids, sep_id)
+        document_ids = get_document_ids_from_separators(target_ids, sep_id)
 
-        target_ids = list(take_circular(target_ids, sample_start, sample_end))
-        input_ids = list(take_circular(input_ids, sample_start, sample_end))
-        calculate_loss = list(take_circular(calculate_loss, sample_start, sample_end))
+        return LLMExample(input_ids, target_ids, calculate_loss, document_ids)
 
-        return LLMExample(input_ids, target_ids, calculate_loss)
+    def _get_pretokenized_sample(self) -> LLMExample:
+        """
+        Take a window straight from the token shards, separators are already in place.
+        """
+        target_ids = self.dataset.get_window(self.sequence_length)
+        input_ids, calculate_loss = self._mask_window(
+            target_ids, self.dataset.separator_id
+        )
+        document_ids = get_document_ids_from_separators(
+            target_ids, self.dataset.separator_id
+        )
+
+        return LLMExample(input_ids, target_ids, calculate_loss, document_ids)
 
-    def _mask_text(self, tokens: List[int]) -> Tuple[List[int], List[int]]:
+    def _mask_window(
+        self, tokens: np.ndarray, sep_id: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Mask the whole window in one pass, using a single RNG call. Separators are never masked.
+        Returns the masked input and the mask of tokens the loss is calculated on.
+        """
         mask_id = self.tokenizer.mask_id
         assert mask_id is not None
+        assert isinstance(self.tokenizer, BertTokenizer)
+        config = self.mask_replace_config
 
-        is_mask = self.np_rng.binomial(
-            1, self.mask_replace_config.mask_percentage, len(tokens)
+        mask_draw, how_to_mask_draw, random_token_draw = self.np_rng.random(
+            (3, len(tokens))
         )
-        how_to_mask = self.np_rng.multinomial(
-            1,
-            [
-                self.mask_replace_config.replace_with_mask,
-                self.mask_replace_config.replace_with_random,
-                self.mask_replace_config.replace_with_original,
-            ],
-            size=len(tokens),
-        ).nonzero()[1]
-        replacements = (
-            (how_to_mask == 0) * mask_id
-            + (how_to_mask == 1) * self._get_valid_random_tokens(len(tokens))
-            + (how_to_mask == 2) * tokens
+        is_mask = (mask_draw < config.mask_percentage) & (tokens != sep_id)
+        replace_with_mask = how_to_mask_draw < config.replace_with_mask
+        replace_with_random = ~replace_with_mask & (
+            how_to_mask_draw < config.replace_with_mask + config.replace_with_random
         )
 
-        input_tokens = np.where(is_mask.astype(bool), replacements, tokens)
+        input_ids = np.where(is_mask & replace_with_mask, mask_id, tokens)
+        input_ids = np.where(
+            is_mask & replace_with_random,
+            self._get_valid_random_tokens(random_token_draw),
+            input_ids,
+        )
 
-        return input_tokens.tolist(), is_mask.tolist()
+        return input_ids, is_mask
 
-    def _get_valid_random_tokens(self, tokens_count):
-        assert isinstance(self.tokenizer, BertTokenizer)
+    def _get_valid_random_tokens(self, uniform_draw: np.ndarray) -> np.ndarray:
         NUMBER_OF_SPECIAL_TOKENS = 999
-        return (
-            self.np_rng.choice(
-                self.tokenizer.VOCAB_SIZE - NUMBER_OF_SPECIAL_TOKENS, tokens_count
-            )
-            + NUMBER_OF_SPECIAL_TOKENS
-        )
+        n_valid_tokens = self.tokenizer.VOCAB_SIZE - NUMBER_OF_SPECIAL_TOKENS
+        return (uniform_draw * n_valid_tokens).astype(
+            TOKEN_DTYPE
+        ) + NUMBER_OF_SPECIAL_TOKENS
 
 
 class GPTPacker(
@@ -170,28 +245,31 @@ class GPTPacker(
         dataset: AbstractDataset,
         tokenizer_maker: Callable[[], AbstractTokenizer],
         seed: Optional[int] = None,
+        tokenization_batch_size: int = 64,
     ):
         super().__init__(
             sequence_length,
             dataset,
             tokenizer_maker,
             seed=seed,
+            tokenization_batch_size=tokenization_batch_size,
         )
 
     def get_sample(self) -> LLMExample:
         """
         Sample examples from the dataset until we reach the desired sequence length.
         """
+        if isinstance(self.dataset, PretokenizedDataset):
+            return self._get_pretokenized_sample()
+
         eot_id = self.tokenizer.eot_id
         assert eot_id is not None
 
         buffer: List[int] = []
-        calculate_loss: List[int] = []
         document_lengths: List[int] = []
 
         while True:
-            document = self.dataset.get_document()
-            tokens = self.tokenizer.text_to_ids(document)
+            tokens = self.get_tokenized_document()
             buffer.extend(tokens + [eot_id])
 
             document_lengths.append(len(tokens) + 1)
@@ -199,10 +277,152 @@ class GPTPacker(
                 break
 
         sample_start = self.py_rng.randint(0, len(buffer) - 1)
-        sample_end = sample_start + self.sequence_length
+        window = np.take(
+            np.asarray(buffer, dtype=TOKEN_DTYPE),
+            np.arange(sample_start, sample_start + self.sequence_length + 1),
+            mode="wrap",
+        )
+
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones_like(target_ids)
+        document_ids = get_document_ids_from_separators(input_ids, eot_id)
+
+        return LLMExample(input_ids, target_ids, calculate_loss, document_ids)
 
-        input_ids = list(take_circular(buffer, sample_start, sample_end))
-        target_ids = list(take_circular(buffer, sample_start + 1, sample_end + 1))
-        calculate_loss = [1] * len(target_ids)
+    def _get_pretokenized_sample(self) -> LLMExample:
+        """
+        Take a window straight from the token shards, no tokenizer is needed.
+        """
+        window = self.dataset.get_window(self.sequence_length + 1)
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones_like(target_ids)
+        document_ids = get_document_ids_from_separators(
+            input_ids, self.dataset.separator_id
+        )
 
-        return LLMExample(input_ids, target_ids, calculate_loss)
+        return LLMExample(input_ids, target_ids, calculate_loss, document_ids)
+
+
+class StreamingGPTPacker(
+    GPTPacker,
+):
+    def __init__(
+        self,
+        sequence_length: int,
+        dataset: AbstractDataset,
+        tokenizer_maker: Callable[[], AbstractTokenizer],
+        seed: Optional[int] = None,
+        tokenization_batch_size: int = 64,
+        document_buffer_size: int = 64,
+    ):
+        """
+        Unlike GPTPacker, every tokenized document is used: the token buffer is kept between calls
+        and consecutive windows are emitted from it.
+        Documents are shuffled through a buffer of `document_buffer_size` tokenized documents.
+        Both buffers are stored in the state as keys of their documents.
+        """
+        self.document_buffer_size = document_buffer_size
+        super().__init__(
+            sequence_length,
+            dataset,
+            tokenizer_maker,
+            seed=seed,
+            tokenization_batch_size=tokenization_batch_size,
+        )
+
+    def set_rng(self, seed: Optional[int] = None):
+        super().set_rng(seed)
+        self.document_buffer: List[Tuple[Any, List[int]]] = []
+        self.token_buffer: List[int] = []
+        # `token_buffer` is the concatenation of these documents without the first `token_buffer_offset` tokens
+        self.token_buffer_documents: List[Tuple[Any, int]] = []
+        self.token_buffer_offset = 0
+
+    def state_dict(self) -> dict:
+        state_dict = super().state_dict()
+        state_dict["document_buffer"] = [key for key, _ in self.document_buffer]
+        state_dict["token_buffer"] = {
+            "document_keys": [key for key, _ in self.token_buffer_documents],
+            "offset": self.token_buffer_offset,
+        }
+        return state_dict
+
+    def load_state_dict(self, state_dict: dict):
+        super().load_state_dict(state_dict)
+        buffer_keys = state_dict["document_buffer"]
+        stream_keys = state_dict["token_buffer"]["document_keys"]
+        # a single tokenizer call for both buffers
+        documents = self._get_documents_tokens(buffer_keys + stream_keys)
+        self.document_buffer = list(zip(buffer_keys, documents[: len(buffer_keys)]))
+        stream_documents = documents[len(buffer_keys) :]
+        self.token_buffer_documents = [
+            (key, len(tokens)) for key, tokens in zip(stream_keys, stream_documents)
+        ]
+        self.token_buffer_offset = state_dict["token_buffer"]["offset"]
+        self.token_buffer = [token for tokens in stream_documents for token in tokens][
+            self.token_buffer_offset :
+        ]
+
+    def get_sample(self) -> LLMExample:
+        """
+        Emit the next window of the token stream, refilling the stream from the document buffer when needed.
+        """
+        while len(self.token_buffer) < self.sequence_length + 1:
+            key, tokens = self._get_shuffled_document()
+            self.token_buffer.extend(tokens)
+            self.token_buffer_documents.append((key, len(tokens)))
+
+        window = np.asarray(
+            self.token_buffer[: self.sequence_length + 1], dtype=TOKEN_DTYPE
+        )
+        input_ids = window[:-1]
+        target_ids = window[1:]
+        calculate_loss = np.ones_like(target_ids)
+        document_ids = get_document_ids_from_separators(
+            input_ids, self._get_separator_id()
+        )
+        # the last target token is the first input token of the next window
+        del self.token_buffer[: self.sequence_length]
+        self.token_buffer_offset += self.sequence_length
+        while (
+            len(self.token_buffer_documents) > 0
+            and self.token_buffer_offset >= self.token_buffer_documents[0][1]
+        ):
+            self.token_buffer_offset -= self.token_buffer_documents.pop(0)[1]
+
+        return LLMExample(input_ids, target_ids, calculate_loss, document_ids)
+
+    def _get_shuffled_document(self) -> Tuple[Any, List[int]]:
+        while len(self.document_buffer) < self.document_buffer_size:
+            self.document_buffer.append(self._get_document_tokens())
+        index = self.py_rng.randrange(len(self.document_buffer))
+        self.document_buffer[index], self.document_buffer[-1] = (
+            self.document_buffer[-1],
+            self.document_buffer[index],
+        )
+        return self.document_buffer.pop()
+
+    def _get_document_tokens(self) -> Tuple[Any, List[int]]:
+        """The next document with its dataset key, followed by the separator."""
+        if isinstance(self.dataset, PretokenizedDataset):
+            key = self.dataset.get_document_key()
+            return key, self.dataset.get_document_ids_by_key(key).tolist()
+        key, tokens = self.get_keyed_document()
+        return key, tokens + [self._get_separator_id()]
+
+    def _get_documents_tokens(self, keys: list) -> List[List[int]]:
+        if isinstance(self.dataset, PretokenizedDataset):
+            return [self.dataset.get_document_ids_by_key(key).tolist() for key in keys]
+        return [
+            tokens + [self._get_separator_id()]
+            for tokens in self.tokenize_documents(keys)
+        ]
+
+    def _get_separator_id(self) -> int:
+        if isinstance(self.dataset, PretokenizedDataset):
+            return self.dataset.separator_id
+        eot_id = self.tokenizer.eot_id
+        assert eot_id is not None
+        return eot_id
@@ -0,0 +1,50 @@
+import contextlib
+import io
+import json
+from unittest import mock
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.bench import STAGES, main, run_benchmark
+
+
+class TestBench(GeneralTestCase):
+    def test_report(self):
+        report = run_benchmark(
+            "bert",
+            sequence_length=32,
+            num_workers_list=[0],
+            batch_sizes=[2, 4],
+            n_batches=3,
+            warmup=1,
+            n_documents=50,
+            dummy_tokenizer=True,
+        )
+        json.dumps(report)
+        self.assertEqual(len(report["throughput"]), 2)
+        self.assertTrue(all(r["tokens_per_second"] > 0 for r in report["throughput"]))
+        for stage in STAGES:
+            self.assertGreater(report["stage_seconds_per_sample"][stage], 0)
+
+    def test_stdout_is_only_the_report(self):
+        def logging_run_benchmark(*args, **kwargs):
+            print("a log line of the data pipeline")
+            return run_benchmark(*args, **kwargs)
+
+        argv = [
+            "bench",
+            "--dummy_tokenizer",
+            "--num_workers",
+            "0",
+            "--batch_sizes",
+            "2",
+        ]
+        argv += ["--n_batches", "2", "--n_documents", "50", "--sequence_length", "32"]
+        stdout = io.StringIO()
+        with mock.patch("sys.argv", argv), mock.patch(
+            "lizrd.text.bench.run_benchmark", logging_run_benchmark
+        ), contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+            io.StringIO()
+        ):
+            main()
+        report = json.loads(stdout.getvalue())
+        self.assertEqual(len(report["throughput"]), 1)
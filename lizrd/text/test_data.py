@@ -0,0 +1,29 @@
+import pickle
+
+import numpy as np
+import torch
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.data import LLMBatch, LLMExample
+
+
+class TestLLMBatch(GeneralTestCase):
+    def test_collate(self):
+        examples = [
+            LLMExample([i, i + 1, i + 2], [i + 1, i + 2, i + 3], [1, 0, 1])
+            for i in range(4)
+        ]
+        batch = LLMBatch(examples)
+        self.assertShape(batch.input_ids, (4, 3))
+        self.assertEqual(batch.input_ids.dtype, torch.int32)
+        self.assertEqual(batch.should_calculate_loss.dtype, torch.uint8)
+        self.assertTensorEqual(batch.input_ids[2], torch.tensor([2, 3, 4]).int())
+        self.assertEqual(batch.should_calculate_loss.sum().item(), 8)
+        self.assertTensorEqual(batch.document_ids, torch.zeros(4, 3).int())
+
+    def test_example_is_compact(self):
+        length = 1024
+        example = LLMExample(list(range(length)), list(range(length)), [1] * length)
+        self.assertIsInstance(example.input_ids, np.ndarray)
+        # 4 bytes for every token id, target id and document id, 1 for the loss mask
+        self.assertLess(len(pickle.dumps(example)), 14 * length)
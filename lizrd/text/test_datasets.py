@@ -0,0 +1,168 @@
+import json
+import os
+import pickle
+import tempfile
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.datasets import (
+    ListDataset,
+    LocalCorpusDataset,
+    MixtureDataset,
+    get_split_index,
+    index_jsonl_lines,
+)
+from lizrd.text.packers import GPTPacker
+from lizrd.text.test_utils import make_documents
+from lizrd.text.bench import DummyGPTTokenizer
+
+
+class TestSplitIndex(GeneralTestCase):
+    def test_splits_are_disjoint_and_cached(self):
+        n_documents = 1234
+        with tempfile.TemporaryDirectory() as cache_dir:
+            train = get_split_index("dummy", n_documents, "train", cache_dir=cache_dir)
+            evaluation = get_split_index(
+                "dummy", n_documents, "eval", cache_dir=cache_dir
+            )
+            self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+            self.assertEqual(len(train) + len(evaluation), n_documents)
+            self.assertEqual(len(np.intersect1d(train, evaluation)), 0)
+            self.assertTrue(all(hash(int(i)) % 100 >= 5 for i in train))
+            self.assertTrue(all(hash(int(i)) % 100 < 5 for i in evaluation))
+
+            cached = get_split_index("dummy", n_documents, "train", cache_dir=cache_dir)
+            self.assertTrue(np.array_equal(train, cached))
+
+
+class TestSharding(GeneralTestCase):
+    def test_shards_are_disjoint(self):
+        documents = make_documents(103)
+        world_size, num_workers = 2, 3
+        n_shards = world_size * num_workers
+        sampled = []
+        for rank in range(world_size):
+            for worker_id in range(num_workers):
+                dataset = ListDataset(documents, seed=0)
+                dataset.set_shard(rank * num_workers + worker_id, n_shards)
+                sampled.append({dataset.get_document() for _ in range(500)})
+
+        for i, shard in enumerate(sampled):
+            for other in sampled[i + 1 :]:
+                self.assertEqual(len(shard & other), 0)
+        self.assertSetEqual(set.union(*sampled), set(documents))
+
+
+class TestMixtureDataset(GeneralTestCase):
+    def _make_mixture(self, seed=0):
+        sources = [
+            ListDataset([f"first {i}" for i in range(100)]),
+            ListDataset([f"second {i} {i}" for i in range(100)]),
+        ]
+        return MixtureDataset(sources, [3.0, 1.0], names=["first", "second"], seed=seed)
+
+    def test_weights_and_token_counts(self):
+        mixture = self._make_mixture()
+        documents = mixture.get_documents(4000)
+        from_first = np.mean([d.startswith("first") for d in documents])
+        self.assertAlmostEqual(from_first, 0.75, delta=0.03)
+        self.assertLessEqual(len(mixture.buffer), mixture.shuffle_buffer_size)
+
+        packer = GPTPacker(16, mixture, DummyGPTTokenizer, seed=0)
+        for _ in range(500):
+            packer.get_sample()
+        first, second = mixture.source_token_counts
+        # documents of the second source are 3 tokens long, of the first 2
+        self.assertAlmostEqual(first / second, 3 * 2 / 3, delta=0.2)
+
+    def test_state_dict(self):
+        mixture = self._make_mixture()
+        mixture.get_documents(10)
+        state = mixture.state_dict()
+        expected = mixture.get_documents(300)
+
+        resumed = self._make_mixture(seed=1)
+        resumed.load_state_dict(state)
+        self.assertListEqual(resumed.get_documents(300), expected)
+
+
+def write_local_corpus(path: str, documents: list):
+    """Writes the documents as four shards, one in every supported format."""
+    parts = np.array_split(np.array(documents, dtype=object), 4)
+    with open(os.path.join(path, "part_0.jsonl"), "w") as f:
+        for document in parts[0]:
+            f.write(json.dumps({"text": document, "id": 0}) + "\n")
+    pq.write_table(
+        pa.table({"text": list(parts[1])}),
+        os.path.join(path, "part_1.parquet"),
+        row_group_size=3,
+    )
+    table = pa.table({"text": list(parts[2])})
+    with pa.ipc.new_file(os.path.join(path, "part_2.arrow"), table.schema) as writer:
+        writer.write_table(table)
+    table = pa.table({"text": list(parts[3])})
+    # the format of `datasets` caches
+    with pa.ipc.new_stream(os.path.join(path, "part_3.arrow"), table.schema) as writer:
+        writer.write_table(table)
+
+
+class TestLocalCorpusDataset(GeneralTestCase):
+    def test_all_formats_are_read(self):
+        documents = make_documents(40)
+        with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as cache_dir:
+            write_local_corpus(path, documents)
+            dataset = LocalCorpusDataset(
+                path, seed=0, split=None, max_open_shards=2, cache_dir=cache_dir
+            )
+            self.assertListEqual(list(dataset.iterate_documents()), documents)
+            self.assertLessEqual(len(dataset._open_shards), 2)
+
+            sampled = dataset.get_documents(100)
+            self.assertTrue(all(document in documents for document in sampled))
+
+    def test_shards_are_opened_lazily(self):
+        documents = make_documents(40)
+        with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as cache_dir:
+            write_local_corpus(path, documents)
+            files = sorted(os.listdir(path))
+            LocalCorpusDataset(path, split=None, cache_dir=cache_dir)
+            # the index is stored once in the cache, the data directory may be read-only
+            self.assertListEqual(sorted(os.listdir(path)), files)
+            (index_dir,) = os.listdir(cache_dir)
+            self.assertListEqual(
+                sorted(os.listdir(os.path.join(cache_dir, index_dir))),
+                ["index.json", "part_0.jsonl.lines.npy"],
+            )
+
+            dataset = LocalCorpusDataset(path, seed=1, split=None, cache_dir=cache_dir)
+            self.assertEqual(len(dataset._open_shards), 0)
+            dataset.get_document()
+            self.assertEqual(len(dataset._open_shards), 1)
+            copy = pickle.loads(pickle.dumps(dataset))
+            self.assertEqual(len(copy._open_shards), 0)
+            self.assertEqual(copy.get_document(), dataset.get_document())
+
+    def test_changed_shards_are_indexed_again(self):
+        with tempfile.TemporaryDirectory() as path, tempfile.TemporaryDirectory() as cache_dir:
+            write_local_corpus(path, make_documents(40))
+            LocalCorpusDataset(path, split=None, cache_dir=cache_dir)
+            documents = make_documents(50)
+            write_local_corpus(path, documents)
+            dataset = LocalCorpusDataset(path, split=None, cache_dir=cache_dir)
+            self.assertListEqual(list(dataset.iterate_documents()), documents)
+
+    def test_jsonl_lines_are_indexed_in_chunks(self):
+        with tempfile.TemporaryDirectory() as path:
+            file_path = os.path.join(path, "part.jsonl")
+            with open(file_path, "w") as f:
+                f.write('{"text": "a"}\n\n{"text": "bc"}\n{"text": "d"}')
+            expected = index_jsonl_lines(file_path)
+            self.assertListEqual(expected.tolist(), [[0, 14], [15, 30], [30, 43]])
+            for chunk_size in [1, 5, 14, 15]:
+                self.assertListEqual(
+                    index_jsonl_lines(file_path, chunk_size).tolist(), expected.tolist()
+                )
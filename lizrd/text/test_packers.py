@@ -0,0 +1,120 @@
+from typing import List
+
+from lizrd.support.test_utils import GeneralTestCase, heavy_test
+import numpy as np
+
+from lizrd.text.datasets import ListDataset
+from lizrd.text.packers import BERTPacker, GPTPacker, StreamingGPTPacker
+from lizrd.text.test_utils import make_documents
+from lizrd.text.bench import DummyBertTokenizer, DummyGPTTokenizer
+from lizrd.text.tokenizers import BertTokenizer, GPTTokenizer
+
+
+class CountingGPTTokenizer(DummyGPTTokenizer):
+    def __init__(self):
+        super().__init__()
+        self.batch_sizes = []
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        self.batch_sizes.append(len(texts))
+        return super().texts_to_ids(texts)
+
+
+class TestStreamingGPTPacker(GeneralTestCase):
+    def test_windows_are_consecutive(self):
+        sequence_length = 32
+        packer = StreamingGPTPacker(
+            sequence_length,
+            ListDataset(make_documents(50)),
+            DummyGPTTokenizer,
+            seed=0,
+            document_buffer_size=8,
+        )
+        previous = None
+        for _ in range(20):
+            example = packer.get_sample()
+            self.assertEqual(len(example.input_ids), sequence_length)
+            self.assertListEqual(
+                list(example.input_ids[1:]), list(example.target_ids[:-1])
+            )
+            if previous is not None:
+                self.assertEqual(example.input_ids[0], previous.target_ids[-1])
+            previous = example
+
+    def test_document_ids(self):
+        packer = StreamingGPTPacker(
+            16, ListDataset(make_documents(30)), DummyGPTTokenizer, seed=2
+        )
+        eot_id = packer.tokenizer.eot_id
+        for _ in range(20):
+            example = packer.get_sample()
+            # a new document starts right after every separator
+            starts = np.diff(example.document_ids)
+            self.assertTrue(np.all(starts == (example.input_ids[:-1] == eot_id)))
+            self.assertEqual(example.document_ids[0], 0)
+
+    def test_documents_are_not_cut(self):
+        sequence_length = 16
+        tokenizer = DummyGPTTokenizer()
+        documents = make_documents(30)
+        tokenized_documents = [tokenizer.text_to_ids(d) for d in documents]
+        packer = StreamingGPTPacker(
+            sequence_length,
+            ListDataset(documents),
+            DummyGPTTokenizer,
+            seed=1,
+            document_buffer_size=4,
+        )
+        stream = []
+        for _ in range(50):
+            stream.extend(packer.get_sample().input_ids)
+
+        eot_positions = [i for i, t in enumerate(stream) if t == tokenizer.eot_id]
+        self.assertGreater(len(eot_positions), 2)
+        for begin, end in zip(eot_positions, eot_positions[1:]):
+            self.assertIn(stream[begin + 1 : end], tokenized_documents)
+
+
+class TestBERTPacker(GeneralTestCase):
+    def test_masking(self):
+        tokenizer = DummyBertTokenizer()
+        packer = BERTPacker(
+            4096, ListDataset(make_documents(100)), DummyBertTokenizer, seed=0
+        )
+        example = packer.get_sample()
+        is_mask = example.should_calculate_loss.astype(bool)
+        is_separator = example.target_ids == tokenizer.sequence_separator_id
+
+        self.assertEqual(len(example.input_ids), 4096)
+        self.assertTrue(is_separator.any())
+        self.assertFalse((is_mask & is_separator).any())
+        self.assertTrue(
+            np.array_equal(example.input_ids[~is_mask], example.target_ids[~is_mask])
+        )
+        self.assertAlmostEqual(is_mask.mean(), 0.15, delta=0.03)
+        replaced_with_mask = example.input_ids[is_mask] == tokenizer.mask_id
+        self.assertAlmostEqual(replaced_with_mask.mean(), 0.8, delta=0.08)
+
+
+class TestBatchedTokenization(GeneralTestCase):
+    def test_documents_are_tokenized_in_batches(self):
+        packer = GPTPacker(
+            64,
+            ListDataset(make_documents(50)),
+            CountingGPTTokenizer,
+            seed=0,
+            tokenization_batch_size=16,
+        )
+        for _ in range(10):
+            packer.get_sample()
+        self.assertGreater(len(packer.tokenizer.batch_sizes), 0)
+        self.assertTrue(all(size == 16 for size in packer.tokenizer.batch_sizes))
+
+    @heavy_test
+    def test_batch_encoding_matches_single(self):
+        texts = ["Hello world!", "", "Some longer text, with punctuation: 1, 2, 3."]
+        for tokenizer in [GPTTokenizer(), BertTokenizer()]:
+            self.assertListEqual(
+                tokenizer.texts_to_ids(texts),
+                [tokenizer.text_to_ids(text) for text in texts],
+            )
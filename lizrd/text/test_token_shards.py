@@ -0,0 +1,95 @@
+import os
+import tempfile
+
+import numpy as np
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.datasets import ListDataset, PretokenizedDataset
+from lizrd.text.packers import BERTPacker, GPTPacker
+from lizrd.text.test_utils import make_documents
+from lizrd.text.bench import DummyBertTokenizer, DummyGPTTokenizer
+from lizrd.text.token_shards import load_shards_metadata, write_token_shards
+
+
+class TestTokenShards(GeneralTestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.documents = make_documents(200)
+        self.tokenizer = DummyGPTTokenizer()
+        write_token_shards(
+            ListDataset(self.documents).iterate_documents(),
+            self.tokenizer,
+            self.tmp_dir.name,
+            separator_id=self.tokenizer.eot_id,
+            tokenizer_name="gpt",
+            shard_size_tokens=1000,
+        )
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_roundtrip(self):
+        metadata = load_shards_metadata(self.tmp_dir.name)
+        self.assertGreater(len(metadata["shards"]), 1)
+        self.assertEqual(metadata["total_documents"], len(self.documents))
+        self.assertEqual(metadata["dtype"], "uint16")
+
+        dataset = PretokenizedDataset(self.tmp_dir.name)
+        all_tokens = np.concatenate([np.asarray(shard) for shard in dataset.shards])
+        expected = []
+        for document in self.documents:
+            expected += self.tokenizer.text_to_ids(document) + [self.tokenizer.eot_id]
+        self.assertListEqual(all_tokens.tolist(), expected)
+
+        document = dataset.get_document_ids()
+        self.assertEqual(document[-1], self.tokenizer.eot_id)
+        self.assertNotIn(self.tokenizer.eot_id, document[:-1].tolist())
+
+    def test_gpt_packer(self):
+        dataset = PretokenizedDataset(self.tmp_dir.name)
+        packer = GPTPacker(64, dataset, DummyGPTTokenizer, seed=0)
+        example = packer.get_sample()
+        self.assertEqual(len(example.input_ids), 64)
+        self.assertListEqual(list(example.input_ids[1:]), list(example.target_ids[:-1]))
+
+    def test_bert_packer(self):
+        tokenizer = DummyBertTokenizer()
+        write_token_shards(
+            iter(self.documents),
+            tokenizer,
+            self.tmp_dir.name,
+            separator_id=tokenizer.sequence_separator_id,
+            tokenizer_name="bert",
+        )
+        dataset = PretokenizedDataset(self.tmp_dir.name)
+        packer = BERTPacker(64, dataset, DummyBertTokenizer, seed=0)
+        example = packer.get_sample()
+        is_separator = example.target_ids == tokenizer.sequence_separator_id
+        self.assertEqual(len(example.input_ids), 64)
+        self.assertTrue(np.all(example.should_calculate_loss[is_separator] == 0))
+        self.assertTrue(
+            np.all(example.input_ids[is_separator] == tokenizer.sequence_separator_id)
+        )
+
+    def test_splits(self):
+        # shards written without a split are train shards
+        PretokenizedDataset(self.tmp_dir.name, split="train")
+        with self.assertRaises(ValueError):
+            PretokenizedDataset(self.tmp_dir.name, split="eval")
+
+        eval_documents = make_documents(20)
+        write_token_shards(
+            iter(eval_documents),
+            self.tokenizer,
+            os.path.join(self.tmp_dir.name, "eval"),
+            separator_id=self.tokenizer.eot_id,
+            tokenizer_name="gpt",
+            split="eval",
+        )
+        dataset = PretokenizedDataset(self.tmp_dir.name, split="eval")
+        self.assertEqual(dataset.path, os.path.join(self.tmp_dir.name, "eval"))
+        self.assertEqual(dataset.metadata["total_documents"], len(eval_documents))
+        self.assertEqual(
+            PretokenizedDataset(self.tmp_dir.name, split="train").path,
+            self.tmp_dir.name,
+        )
@@ -0,0 +1,50 @@
+import os
+import tempfile
+
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import BertTokenizerFast, GPT2TokenizerFast
+
+from lizrd.support.test_utils import GeneralTestCase, heavy_test
+from lizrd.text.tokenizers import BertTokenizer, GPTTokenizer, load_fast_tokenizer
+
+
+class WordLevelHubTokenizer:
+    """Stands in for a hub tokenizer class, counts how many times it was loaded."""
+
+    loads = 0
+
+    def __init__(self):
+        vocab = {"[UNK]": 0, "hello": 1, "world": 2}
+        self.backend_tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+        self.backend_tokenizer.pre_tokenizer = Whitespace()
+
+    @classmethod
+    def from_pretrained(cls, name):
+        cls.loads += 1
+        return cls()
+
+
+class TestTokenizerCache(GeneralTestCase):
+    def test_serialized_once(self):
+        with tempfile.TemporaryDirectory() as cache_dir:
+            for _ in range(3):
+                tokenizer = load_fast_tokenizer(
+                    "words", WordLevelHubTokenizer, cache_dir=cache_dir
+                )
+                self.assertListEqual(tokenizer.encode("hello big world").ids, [1, 0, 2])
+            self.assertEqual(WordLevelHubTokenizer.loads, 1)
+            self.assertListEqual(os.listdir(cache_dir), ["words.json"])
+
+    @heavy_test
+    def test_ids_match_hub_tokenizer(self):
+        texts = ["Hello world!", "", "Some longer text, with punctuation: 1, 2, 3."]
+        for tokenizer, hub_tokenizer in [
+            (GPTTokenizer(), GPT2TokenizerFast.from_pretrained("gpt2")),
+            (BertTokenizer(), BertTokenizerFast.from_pretrained("bert-base-uncased")),
+        ]:
+            for text in texts:
+                self.assertListEqual(
+                    tokenizer.text_to_ids(text), hub_tokenizer.encode(text)
+                )
@@ -0,0 +1,8 @@
+def make_documents(n_documents: int, min_words: int = 5, max_words: int = 50):
+    return [
+        " ".join(
+            f"w{doc_id}_{i}"
+            for i in range(min_words + doc_id % (max_words - min_words))
+        )
+        for doc_id in range(n_documents)
+    ]
@@ -0,0 +1,142 @@
+import json
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+
+from lizrd.text.tokenizers import AbstractTokenizer
+
+METADATA_FILENAME = "metadata.json"
+DEFAULT_SHARD_SIZE_TOKENS = 2**28
+
+
+def shard_token_dtype(vocab_size: int) -> np.dtype:
+    return np.dtype(np.uint16) if vocab_size <= 2**16 else np.dtype(np.uint32)
+
+
+def shard_tokens_filename(shard_num: int) -> str:
+    return f"shard_{shard_num:05d}.bin"
+
+
+def shard_index_filename(shard_num: int) -> str:
+    return f"shard_{shard_num:05d}.idx.npy"
+
+
+class TokenShardWriter:
+    """
+    Writes tokenized documents as flat token shards.
+    Every document is followed by `separator_id`, so a shard is a ready-to-pack stream of tokens.
+    Each shard `shard_XXXXX.bin` has a companion `shard_XXXXX.idx.npy` with document offsets
+    (`n_documents + 1` int64 values), and the whole directory is described by `metadata.json`,
+    including the `split` the documents come from.
+    """
+
+    def __init__(
+        self,
+        output_dir: str,
+        vocab_size: int,
+        separator_id: int,
+        tokenizer_name: str,
+        shard_size_tokens: int = DEFAULT_SHARD_SIZE_TOKENS,
+        split: Optional[str] = None,
+    ):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.vocab_size = vocab_size
+        self.separator_id = separator_id
+        self.tokenizer_name = tokenizer_name
+        self.shard_size_tokens = shard_size_tokens
+        self.split = split
+        self.dtype = shard_token_dtype(vocab_size)
+
+        self.shards: List[dict] = []
+        self._buffer: List[np.ndarray] = []
+        self._buffer_lengths: List[int] = []
+        self._buffer_tokens = 0
+
+    def add_document(self, token_ids: List[int]):
+        tokens = np.empty(len(token_ids) + 1, dtype=self.dtype)
+        tokens[:-1] = token_ids
+        tokens[-1] = self.separator_id
+        self._buffer.append(tokens)
+        self._buffer_lengths.append(len(tokens))
+        self._buffer_tokens += len(tokens)
+        if self._buffer_tokens >= self.shard_size_tokens:
+            self._flush()
+
+    def close(self) -> dict:
+        self._flush()
+        metadata = {
+            "tokenizer": self.tokenizer_name,
+            "split": self.split,
+            "vocab_size": self.vocab_size,
+            "separator_id": self.separator_id,
+            "dtype": self.dtype.name,
+            "shards": self.shards,
+            "total_tokens": sum(shard["n_tokens"] for shard in self.shards),
+            "total_documents": sum(shard["n_documents"] for shard in self.shards),
+        }
+        with open(os.path.join(self.output_dir, METADATA_FILENAME), "w") as f:
+            json.dump(metadata, f, indent=2)
+        return metadata
+
+    def _flush(self):
+        if self._buffer_tokens == 0:
+            return
+        shard_num = len(self.shards)
+        tokens = np.concatenate(self._buffer)
+        offsets = np.zeros(len(self._buffer_lengths) + 1, dtype=np.int64)
+        np.cumsum(self._buffer_lengths, out=offsets[1:])
+
+        tokens.tofile(os.path.join(self.output_dir, shard_tokens_filename(shard_num)))
+        np.save(os.path.join(self.output_dir, shard_index_filename(shard_num)), offsets)
+        self.shards.append(
+            {
+                "tokens": shard_tokens_filename(shard_num),
+                "index": shard_index_filename(shard_num),
+                "n_tokens": int(len(tokens)),
+                "n_documents": len(self._buffer_lengths),
+            }
+        )
+
+        self._buffer = []
+        self._buffer_lengths = []
+        self._buffer_tokens = 0
+
+
+def write_token_shards(
+    documents: Iterable[str],
+    tokenizer: AbstractTokenizer,
+    output_dir: str,
+    separator_id: int,
+    tokenizer_name: str,
+    shard_size_tokens: int = DEFAULT_SHARD_SIZE_TOKENS,
+    max_documents: Optional[int] = None,
+    split: Optional[str] = None,
+) -> dict:
+    writer = TokenShardWriter(
+        output_dir,
+        vocab_size=tokenizer.VOCAB_SIZE,
+        separator_id=separator_id,
+        tokenizer_name=tokenizer_name,
+        shard_size_tokens=shard_size_tokens,
+        split=split,
+    )
+    for i, document in enumerate(documents):
+        if max_documents is not None and i >= max_documents:
+            break
+        writer.add_document(tokenizer.text_to_ids(document))
+    return writer.close()
+
+
+def get_split_shards_dir(path: str, split: str) -> str:
+    """Shards of every split can be kept in subdirectories named after the split, e.g. `<path>/eval`."""
+    split_path = os.path.join(path, split)
+    if os.path.exists(os.path.join(split_path, METADATA_FILENAME)):
+        return split_path
+    return path
+
+
+def load_shards_metadata(path: str) -> dict:
+    with open(os.path.join(path, METADATA_FILENAME)) as f:
+        return json.load(f)
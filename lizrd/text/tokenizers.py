@@ -1,6 +1,9 @@
 from abc import ABC, abstractmethod
-from typing import List, Optional
-from transformers import BertTokenizerFast, GPT2TokenizerFast
+import os
+from typing import List, Optional, Type
+
+from tokenizers import Tokenizer
+from transformers import BertTokenizerFast, GPT2TokenizerFast, PreTrainedTokenizerFast
 
 
 class AbstractTokenizer(ABC):
@@ -13,38 +16,74 @@ class AbstractTokenizer(ABC):
     def text_to_ids(self, text: str) -> List[int]:
         raise NotImplementedError()
 
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        return [self.text_to_ids(text) for text in texts]
+
+
+def get_tokenizer_cache_dir() -> str:
+    return os.path.join(
+        os.getenv(
+            "HF_DATASETS_CACHE",
+            os.path.join(os.path.expanduser("~"), ".cache", "huggingface", "datasets"),
+        ),
+        "tokenizers",
+    )
+
 
-def disable_tokenizer_warnings(hf_tokenizer):
-    # set model max length to high number to disable warnings
-    # we handle sequence length ourselves
-    hf_tokenizer.model_max_length = 100_000
+def load_fast_tokenizer(
+    name: str,
+    hf_tokenizer_class: Type[PreTrainedTokenizerFast],
+    cache_dir: Optional[str] = None,
+) -> Tokenizer:
+    """
+    Loads the Rust tokenizer from a single `tokenizer.json`, which is serialized from the HF hub tokenizer once
+    and then shared by all processes. This skips `from_pretrained`, which looks up the hub cache
+    and parses vocab and merges files again in every dataloader worker.
+    """
+    cache_dir = cache_dir if cache_dir is not None else get_tokenizer_cache_dir()
+    path = os.path.join(cache_dir, f"{name}.json")
+    if not os.path.exists(path):
+        os.makedirs(cache_dir, exist_ok=True)
+        hf_tokenizer = hf_tokenizer_class.from_pretrained(name)
+        # write to a temporary file first, so that concurrent processes never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        hf_tokenizer.backend_tokenizer.save(tmp_path)
+        os.replace(tmp_path, path)
+    return Tokenizer.from_file(path)
+
+
+def get_special_token_id(tokenizer: Tokenizer, token: str) -> int:
+    token_id = tokenizer.token_to_id(token)
+    assert isinstance(token_id, int), f"{token} is not in the vocabulary"
+    return token_id
 
 
 class BertTokenizer(AbstractTokenizer):
     VOCAB_SIZE = 30522
 
     def __init__(self):
-        self.tokenizer = BertTokenizerFast.from_pretrained("bert-base-uncased")
-        disable_tokenizer_warnings(self.tokenizer)
-        self.mask_id = self.tokenizer.convert_tokens_to_ids("[MASK]")
-        assert isinstance(self.mask_id, int)
-        self.sequence_separator_id = self.tokenizer.convert_tokens_to_ids("[SEP]")
-        assert isinstance(self.sequence_separator_id, int)
+        self.tokenizer = load_fast_tokenizer("bert-base-uncased", BertTokenizerFast)
+        self.mask_id = get_special_token_id(self.tokenizer, "[MASK]")
+        self.sequence_separator_id = get_special_token_id(self.tokenizer, "[SEP]")
 
     def text_to_ids(self, text: str) -> List[int]:
-        # TODO: encode or tokenize + convert_tokens_to_ids?
-        return self.tokenizer.encode(text)
+        return self.tokenizer.encode(text).ids
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        # one call to the fast tokenizer encodes the whole batch in parallel, ids are the same as with encode
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts)]
 
 
 class GPTTokenizer(AbstractTokenizer):
     VOCAB_SIZE = 50257
 
     def __init__(self):
-        self.tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-        disable_tokenizer_warnings(self.tokenizer)
-        self.eot_id = self.tokenizer.convert_tokens_to_ids("<|endoftext|>")
-        assert isinstance(self.eot_id, int)
+        self.tokenizer = load_fast_tokenizer("gpt2", GPT2TokenizerFast)
+        self.eot_id = get_special_token_id(self.tokenizer, "<|endoftext|>")
 
     def text_to_ids(self, text: str) -> List[int]:
-        # TODO: encode or tokenize + convert_tokens_to_ids?
-        return self.tokenizer.encode(text)
+        return self.tokenizer.encode(text).ids
+
+    def texts_to_ids(self, texts: List[str]) -> List[List[int]]:
+        # one call to the fast tokenizer encodes the whole batch in parallel, ids are the same as with encode
+        return [encoding.ids for encoding in self.tokenizer.encode_batch(texts)]
@@ -1,7 +1,8 @@
 import copy
 from collections import defaultdict
-from typing import Callable, Optional
+from typing import Callable, Optional, Union
 import os
+import warnings
 
 import numpy as np
 import plotly.express as px
@@ -13,7 +14,9 @@ from torch.utils.tensorboard import SummaryWriter
 from lizrd.core import llm
 from lizrd.core.misc import are_state_dicts_the_same
 from lizrd.datasets import wikibookdata
+from lizrd.datasets.prepacked_eval import PrepackedEvalSet
 import lizrd.datasets.processed_batch
+from lizrd.support import ash
 from lizrd.support.logging import AbstractLogger
 from lizrd.support.logging import get_current_logger
 from lizrd.support.loss import (
@@ -36,6 +39,9 @@ def get_model(
     gradient_checkpointing: bool = False,
     model_fragmentation: Optional[list[int]] = None,
     residual_fn: Callable[[], torch.nn.Module] = None,
+    torch_compile: bool = False,
+    checkpointing_policy: str = "all",
+    checkpoint_every_k_blocks: int = 1,
 ):
     if model_fragmentation is None or device == torch.device("cpu"):
         first_gpu = device
@@ -59,21 +65,82 @@ def get_model(
         device,
         model_fragmentation=model_fragmentation,
         residual_fn=residual_fn,
+        checkpointing_policy=checkpointing_policy,
+        checkpoint_every_k_blocks=checkpoint_every_k_blocks,
     )
 
     head = llm.PredictionHead(dm, vocab_size).to(last_gpu)
 
     model = llm.LLM(embedding_layer, encoder_tower, head)
 
+    if torch_compile:
+        compile_model(model)
+
+    return model
+
+
+def compile_model(model: llm.LLM, **compile_kwargs) -> llm.LLM:
+    """
+    Compiles the embedding, every transformer block and the head of `model` in place, so parameter names
+    stay the same and the loss functions applying the head themselves also run compiled code.
+    Every region falls back to eager code on its own if it fails to compile, see `compile_with_fallback`.
+    """
+    if not hasattr(torch, "compile"):
+        print(
+            "torch.compile is not available in this version of torch, the model runs eagerly"
+        )
+        return model
+    regions = [
+        model.encoder.embedding_layer,
+        *model.encoder.encoder.blocks,
+        model.head,
+    ]
+    for region in regions:
+        compile_with_fallback(region, **compile_kwargs)
     return model
 
 
+def compile_with_fallback(region: torch.nn.Module, **compile_kwargs):
+    """
+    Replaces the `forward` of `region` with a compiled one. Compilation happens at the first call,
+    if it fails, a warning is logged and `region` runs its eager `forward` from then on.
+    Shape checks are switched off only inside the compiled code, where they would only add guards,
+    the eager fallback and other models keep them.
+    """
+
+    def class_forward(*args, **kwargs):
+        # looked up at every call, so it is the unchecked forward inside `ash.checks_disabled`
+        return type(region).forward(region, *args, **kwargs)
+
+    compiled_forward = torch.compile(class_forward, **compile_kwargs)
+    compiled_once = False
+
+    def forward(*args, **kwargs):
+        nonlocal compiled_once
+        if compiled_once:
+            with ash.checks_disabled():
+                return compiled_forward(*args, **kwargs)
+        try:
+            with ash.checks_disabled():
+                output = compiled_forward(*args, **kwargs)
+        except Exception as error:
+            warnings.warn(
+                f"Compiling {type(region).__name__} failed, it runs eagerly: {error}"
+            )
+            del region.forward
+            return region.forward(*args, **kwargs)
+        compiled_once = True
+        return output
+
+    region.forward = forward
+
+
 @define(slots=False)
 class Trainer:
     model: torch.nn.Module
     optimizer: torch.optim.Optimizer
     pdataset: wikibookdata.ProcessedDatasetWrapper
-    pdataset_eval: wikibookdata.ProcessedDatasetWrapper
+    pdataset_eval: Union[wikibookdata.ProcessedDatasetWrapper, PrepackedEvalSet]
     batch_size: int
     vocab_size: int
     mask_percent: float
@@ -346,6 +413,9 @@ class Trainer:
         log_values: bool = True,
     ):
         self.model.eval()
+        if isinstance(self.pdataset_eval, PrepackedEvalSet):
+            # every eval is computed on the same batches
+            self.pdataset_eval.rewind()
 
         if self.model_type == "bert":
             with torch.no_grad():
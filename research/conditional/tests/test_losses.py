@@ -0,0 +1,100 @@
+import copy
+
+import numpy as np
+import torch
+from torch.nn.parallel import DistributedDataParallel
+
+from lizrd.core.test_llm import make_gpt
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.data import LLMBatch, LLMExample
+from research.conditional.utils.model_utils import (
+    calculate_llm_loss,
+    masked_positions_llm_loss,
+    vocab_chunked_llm_loss,
+)
+
+
+def make_batch(vocab_size, seql, batch_size, mask_percent, seed=0):
+    rng = np.random.default_rng(seed)
+    examples = []
+    for _ in range(batch_size):
+        tokens = rng.integers(vocab_size, size=seql + 1)
+        examples.append(
+            LLMExample(tokens[:-1], tokens[1:], rng.random(seql) < mask_percent)
+        )
+    return LLMBatch(examples)
+
+
+class TestLossVariants(GeneralTestCase):
+    def assertMatchesFullLoss(self, loss_function, mask_percent):
+        torch.manual_seed(0)
+        vocab_size, seql = 101, 12
+        model = make_gpt(vocab_size, seql)
+        batch = make_batch(vocab_size, seql, 4, mask_percent)
+
+        results = []
+        for function in [loss_function, calculate_llm_loss]:
+            model.zero_grad()
+            loss, aux_info = function(batch, model, False, vocab_size)
+            loss.backward()
+            grads = [p.grad.clone() for p in model.parameters()]
+            results.append((loss, aux_info, grads))
+
+        (loss, aux_info, grads), (
+            expected_loss,
+            expected_aux_info,
+            expected_grads,
+        ) = results
+        self.assertAlmostEqual(loss.item(), expected_loss.item(), places=5)
+        self.assertEqual(
+            aux_info["correct_tokens"], expected_aux_info["correct_tokens"]
+        )
+        self.assertEqual(
+            aux_info["total_masked_tokens"], expected_aux_info["total_masked_tokens"]
+        )
+        for grad, expected_grad in zip(grads, expected_grads):
+            self.assertTensorAlmostEqual(grad, expected_grad)
+
+    def test_vocab_chunked(self):
+        self.assertMatchesFullLoss(
+            lambda *args: vocab_chunked_llm_loss(*args, vocab_chunk_size=16), 0.5
+        )
+
+    def test_masked_positions(self):
+        self.assertMatchesFullLoss(masked_positions_llm_loss, 0.15)
+
+    def test_masked_positions_vocab_chunked(self):
+        self.assertMatchesFullLoss(
+            lambda *args: masked_positions_llm_loss(*args, vocab_chunk_size=16), 0.15
+        )
+
+
+class TestLossesUnderDDP(GeneralTestCase):
+    def setUp(self):
+        torch.distributed.init_process_group(
+            "gloo", init_method="tcp://127.0.0.1:29512", rank=0, world_size=1
+        )
+
+    def tearDown(self):
+        torch.distributed.destroy_process_group()
+
+    def test_head_applied_outside_of_forward(self):
+        vocab_size, seql = 101, 12
+        for loss_function in [
+            masked_positions_llm_loss,
+            lambda *args: vocab_chunked_llm_loss(*args, vocab_chunk_size=16),
+        ]:
+            torch.manual_seed(0)
+            model = make_gpt(vocab_size, seql)
+            ddp_model = DistributedDataParallel(copy.deepcopy(model))
+            # a second step fails if DDP didn't finish reducing the gradients of the first
+            for seed in range(2):
+                batch = make_batch(vocab_size, seql, 4, 0.15, seed=seed)
+                for m in [model, ddp_model]:
+                    m.zero_grad()
+                    loss, _ = loss_function(batch, m, False, vocab_size)
+                    loss.backward()
+                for param, ddp_param in zip(
+                    model.parameters(), ddp_model.module.parameters()
+                ):
+                    self.assertTensorAlmostEqual(ddp_param.grad, param.grad)
@@ -10,8 +10,11 @@ from torch.distributed import init_process_group, destroy_process_group
 from torch.nn.parallel import DistributedDataParallel as DDP
 
 from lizrd.core import misc
+from lizrd.core.checkpointing import fit_checkpointing_to_memory_budget
+from lizrd.support import ash
 from lizrd.support.logging import get_current_logger, get_logger
 from lizrd.train.train_utils import (
+    compile_model,
     get_model,
 )
 from lizrd.text import tokenizers
@@ -23,6 +26,7 @@ from research.conditional.utils.model_utils import (
     get_ff_layer,
     get_attention_layer,
     get_residual_layer,
+    TOKENWISE_FF_MODES,
 )
 
 
@@ -40,12 +44,16 @@ def log_batch(
     for i in range(min(num_to_log, len(batch.input_ids))):
         get_current_logger().report_text(
             title=f"example_sequence/seq{i}/input_text",
-            value=hf_tokenizer.decode(batch.input_ids[i]),
+            value=hf_tokenizer.decode(
+                batch.input_ids[i].tolist(), skip_special_tokens=False
+            ),
             iteration=0,
         )
         get_current_logger().report_text(
             title=f"example_sequence/seq{i}/target_text",
-            value=hf_tokenizer.decode(batch.target_ids[i]),
+            value=hf_tokenizer.decode(
+                batch.target_ids[i].tolist(), skip_special_tokens=False
+            ),
             iteration=0,
         )
 
@@ -113,12 +121,44 @@ def main(
         gradient_checkpointing=args.gradient_checkpointing,
         model_fragmentation=args.model_parallelism_fragmentation,
         residual_fn=residual_fn,
+        checkpointing_policy=args.checkpointing_policy,
+        checkpoint_every_k_blocks=args.checkpoint_every_k_blocks,
     )
+    if args.disable_shape_checks:
+        ash.set_checks_enabled(False)
 
     # make model data_distributed if necessary
     if rank is not None:
         print(f"Moving model to cuda:{rank}")
         model = model.to(f"cuda:{rank}")
+
+    if args.gradient_checkpointing and args.checkpointing_policy == "auto":
+        assert (
+            args.checkpointing_memory_budget_gb is not None
+        ), "auto checkpointing needs --checkpointing_memory_budget_gb"
+        step_batch_size = (
+            args.batch_size // args.n_gpus if data_distributed else args.batch_size
+        ) // args.gradient_accumulation_steps
+        # measured on a single sequence, a full batch without checkpointing might not fit
+        checkpointed = fit_checkpointing_to_memory_budget(
+            model,
+            example_input=torch.randint(
+                VOCAB_SIZE, (1, args.cutoff), device=next(model.parameters()).device
+            ),
+            memory_budget_bytes=int(args.checkpointing_memory_budget_gb * 2**30),
+            batch_size=step_batch_size,
+            mixed_precision=args.mixed_precision,
+        )
+        print(
+            "Checkpointed sublayers:",
+            [(c.block_number, c.layer_type) for c in checkpointed],
+        )
+
+    # compiled after the measurements of auto checkpointing, which need eager modules
+    if args.compile:
+        compile_model(model)
+
+    if rank is not None:
         model = DDP(model, device_ids=[rank])
 
     optimizer = torch.optim.Adam(
@@ -138,6 +178,14 @@ def main(
         seed=args.data_seed if data_seeds is None else data_seeds[rank],
         model_type=args.model_type,
         dataset_type=args.dataset_type,
+        dataset_path=args.dataset_path,
+        streaming_packer=args.streaming_packer,
+        tokenization_batch_size=args.tokenization_batch_size,
+        prefetch_depth=args.data_prefetch_depth,
+        rank=rank if data_distributed else 0,
+        world_size=args.n_gpus if data_distributed else 1,
+        shared_memory_batches=args.shared_memory_batches,
+        dataset_mixture=args.dataset_mixture,
     )
 
     logger = get_logger(args, model, VOCAB_SIZE)
@@ -174,6 +222,7 @@ def main(
         load_weights_path=args.load_weights_path,
         gradient_clipping=args.grad_clip,
         loss_checkpoint_chungs=args.loss_checkpoint_chungs,
+        loss_vocab_chunk_size=args.loss_vocab_chunk_size,
         gradient_accumulation_steps=args.gradient_accumulation_steps,
         lr_decay=args.lr_decay,
         lr_warmup_steps=args.lr_warmup_steps,
@@ -181,6 +230,7 @@ def main(
         log_gradients_and_weights=args.log_gradients_and_weights,
         max_sequence_length=args.cutoff,
         is_process_logging=is_process_logging,
+        decode_with_kv_cache=args.ff_mode in TOKENWISE_FF_MODES,
     )
     trainer.train(args.n_steps)
 
@@ -1,5 +1,7 @@
 import argparse
 
+from lizrd.core.checkpointing import CHECKPOINTING_POLICIES
+
 
 def introduce_parser_arguments(
     parser: argparse.ArgumentParser,
@@ -36,6 +38,15 @@ def introduce_parser_arguments(
     parser.add_argument("--name", type=str, default="")
     parser.add_argument("--learning_rate", type=float, default=3e-4)
     parser.add_argument("--gradient_checkpointing", action="store_true")
+    parser.add_argument(
+        "--checkpointing_policy",
+        type=str,
+        choices=CHECKPOINTING_POLICIES,
+        default="all",
+        help="which sublayers --gradient_checkpointing recomputes, auto fits activations into --checkpointing_memory_budget_gb",
+    )
+    parser.add_argument("--checkpoint_every_k_blocks", type=int, default=1)
+    parser.add_argument("--checkpointing_memory_budget_gb", type=float, default=None)
     parser.add_argument("--save_weights_path", type=str, default=None)
     parser.add_argument("--save_weights_interval", type=int, default=1000)
     parser.add_argument("--load_weights_path", type=str, default=None)
@@ -45,6 +56,12 @@ def introduce_parser_arguments(
     parser.add_argument("--adam_beta2", type=float, default=0.999)
     parser.add_argument("--no_ff", action="store_true")
     parser.add_argument("--loss_checkpoint_chungs", type=int, default=0)
+    parser.add_argument(
+        "--loss_vocab_chunk_size",
+        type=int,
+        default=0,
+        help="compute the head and the loss over chunks of this many vocabulary entries, never materializing the logits",
+    )
     parser.add_argument("--gradient_accumulation_steps", type=int, default=1)
     parser.add_argument("--auto_find_grad_accumulation", action="store_true")
     parser.add_argument("--lr_decay", type=float, default=None)
@@ -59,6 +76,16 @@ def introduce_parser_arguments(
         help="Whether to use auxiliary loss in loss calculations",
     )
     parser.add_argument("--detect_anomaly", action="store_true")
+    parser.add_argument(
+        "--disable_shape_checks",
+        action="store_true",
+        help="remove the ash shape checks of the model after it is constructed",
+    )
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="compile the embedding, the transformer blocks and the head with torch.compile, shape checks are removed",
+    )
 
     # paremeters for specific experiments
 
@@ -120,9 +147,58 @@ def introduce_parser_arguments(
         help="comma-separated list of integers, that signify the numbers of model blocks that are first on the new device, e.g. 2,4 means that blocks 0,1 will be on GPU 0, blocks 2,3 will be on GPU 1, and the rest will be on GPU 2",
     )
     parser.add_argument("--data_distributed", action="store_true")
+    parser.add_argument(
+        "--streaming_packer",
+        action="store_true",
+        help="for gpt, emit consecutive windows of the token stream instead of one random window per tokenized chunk",
+    )
+    parser.add_argument(
+        "--tokenization_batch_size",
+        type=int,
+        default=64,
+        help="number of documents fetched and tokenized at once by every dataloader worker",
+    )
+    parser.add_argument(
+        "--data_prefetch_depth",
+        type=int,
+        default=2,
+        help="number of batches transferred to the device ahead of time by a background thread, 0 disables prefetching",
+    )
+    parser.add_argument(
+        "--mask_document_boundaries",
+        action="store_true",
+        help="tokens attend only to tokens of the same document packed into the sequence",
+    )
+    parser.add_argument(
+        "--attention_backend",
+        type=str,
+        choices=["einsum", "sdpa"],
+        default="einsum",
+        help="einsum is the reference implementation, sdpa uses torch scaled_dot_product_attention",
+    )
+    parser.add_argument(
+        "--shared_memory_batches",
+        action="store_true",
+        help="dataloader workers write batches into preallocated shared memory instead of sending them through the queue",
+    )
     parser.add_argument("--group_granular_moe_by_batch", action="store_true")
     parser.add_argument("--granular_moe_one_hot_impl", action="store_true")
     parser.add_argument("--dataset_type", type=str, default="wikibook")
+    parser.add_argument(
+        "--dataset_mixture",
+        type=str,
+        default=None,
+        help="sources and weights of the mixture, e.g. wikibook:0.3,c4:0.7, used only if dataset_type is set to mixture",
+    )
+    parser.add_argument(
+        "--dataset_path",
+        type=str,
+        default=None,
+        help="directory with token shards if dataset_type is set to pretokenized, "
+        "created with `python -m lizrd.scripts.tokenize_dataset`, or with a subdirectory of shards for every split. "
+        "With dataset_type set to local, or a local source in dataset_mixture, "
+        "directory with .arrow, .jsonl or .parquet files of raw texts",
+    )
     parser.add_argument(
         "--softmax_ungrouped",
         action="store_true",
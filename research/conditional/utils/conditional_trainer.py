@@ -1,5 +1,4 @@
 import os.path
-import copy
 from types import SimpleNamespace as SN
 import time
 from typing import Callable, Optional, Literal
@@ -7,16 +6,21 @@ from typing import Callable, Optional, Literal
 import torch
 from attr import define
 from lizrd.core.misc import propagate_forward_pass_cache
-from lizrd.support.decoding import decode_single_example
+from lizrd.support.decoding import generate
 from lizrd.support.logging import AbstractLogger
 from lizrd.text.data import LLMBatch
 from research.conditional.moe_layers.continuous_moe import ContinuousMoE
 from research.conditional.utils.layer_manager import LayerManager
 from research.conditional.utils.misc_tools import get_ith_chunk
 from research.conditional.utils.model_utils import make_loss_function
-from research.datasets import DataloaderWrapper
+from research.datasets import (
+    DataloaderWrapper,
+    gather_data_states,
+    is_distributed,
+    load_rank_data_state,
+)
 from lizrd.text.datasets import C4Dataset
-from transformers import GPT2Tokenizer
+from lizrd.text.tokenizers import GPTTokenizer
 
 
 @define(slots=False)
@@ -46,6 +50,7 @@ class ConditionalTrainer:
     load_weights_path: str = None
     gradient_clipping: float = None
     loss_checkpoint_chungs: int = 0
+    loss_vocab_chunk_size: int = 0
     gradient_accumulation_steps: int = 1
     lr_decay: Optional[float] = None
     lr_warmup_steps: int = 0
@@ -53,6 +58,8 @@ class ConditionalTrainer:
     log_gradients_and_weights: bool = False
     loss_log_intervals: tuple[int] = (1, 10, 100, 1000)
     decoding_logging_steps: int = 5_000
+    decode_with_kv_cache: bool = False
+    decoding_tokenizer: Optional[GPTTokenizer] = None
     total_time_trainsteps: float = 0.0
     total_time_decoding: float = 0.0
     total_time_afterstep: float = 0.0
@@ -76,6 +83,8 @@ class ConditionalTrainer:
         self.auxiliary_losses_accumulator = dict()
         self._calculate_loss = make_loss_function(
             loss_checkpoint_chungs=self.loss_checkpoint_chungs,
+            loss_vocab_chunk_size=self.loss_vocab_chunk_size,
+            head_on_masked_positions_only=self.model_type == "bert",
         )
         self.layer_manager = LayerManager(
             self.model, self.logging_interval_light, self.logging_interval_heavy
@@ -98,6 +107,8 @@ class ConditionalTrainer:
                 self.model.load_state_dict(checkpoint["model"], strict=False)
                 self.optimizer.load_state_dict(checkpoint["optimizer"])
                 self.scaler.load_state_dict(checkpoint["scaler"])
+                if "data" in checkpoint:
+                    load_rank_data_state(self.train_dataloader, checkpoint["data"])
             else:
                 print(
                     f"No weights found at {self.load_weights_path}, training from scratch"
@@ -108,10 +119,15 @@ class ConditionalTrainer:
             self.save_weights_path is not None
             and step % self.save_weights_interval == 0
         ):
+            # gathered on every rank, the data stream of every rank is resumed from its own entry
+            data_states = gather_data_states(self.train_dataloader)
+            if is_distributed() and torch.distributed.get_rank() != 0:
+                return
             checkpoint = {
                 "model": self.model.state_dict(),
                 "optimizer": self.optimizer.state_dict(),
                 "scaler": self.scaler.state_dict(),
+                "data": data_states,
             }
             torch.save(checkpoint, self.save_weights_path)
             print(f"Weights saved to {self.save_weights_path} (step {step})")
@@ -178,26 +194,47 @@ class ConditionalTrainer:
                     value=self.total_time_afterstep / total_time,
                     iteration=step,
                 )
+                self.logger.report_scalar(
+                    title="time/data_wait_fraction",
+                    value=self.train_dataloader.data_wait_time / total_time,
+                    iteration=step,
+                )
+                # workers start up again after a resume, not only at step 0
+                startup_times = self.train_dataloader.pop_startup_times()
+                for name, seconds in startup_times.items():
+                    self.logger.report_scalar(
+                        title=f"time/{name}", value=seconds, iteration=step
+                    )
 
     def _decode_samples(self, step):
+        # decoded prompts are single documents, unlike the training batch
+        self.model.forward_pass_cache.pop("document_ids", None)
         examples = [
             "1, 2, 3, 4, 5",
             "Our Father, who art in heaven,",
             "Warsaw -> Poland Paris -> France Berlin ->",
             "Speech at a funeral of a fly: ",
         ]
-        tokenizer = GPT2Tokenizer.from_pretrained("gpt2")
-        for example in examples:
-            tokens = torch.tensor(
-                tokenizer.convert_tokens_to_ids(tokenizer.tokenize(example))
-            ).to(self.train_dataloader.device)
-            output_tokens = decode_single_example(
-                self.model,
-                self.max_sequence_length,
-                tokens,
-                tokenizer._convert_token_to_id("<|endoftext|>"),
+        if self.decoding_tokenizer is None:
+            self.decoding_tokenizer = GPTTokenizer()
+        tokenizer = self.decoding_tokenizer
+        prompts = [
+            torch.tensor(tokenizer.text_to_ids(example)).to(
+                self.train_dataloader.device
+            )
+            for example in examples
+        ]
+        outputs = generate(
+            self.model,
+            prompts,
+            self.max_sequence_length,
+            tokenizer.eot_id,
+            use_kv_cache=self.decode_with_kv_cache,
+        )
+        for example, output_tokens in zip(examples, outputs):
+            decoded_output = tokenizer.tokenizer.decode(
+                output_tokens.tolist(), skip_special_tokens=False
             )
-            decoded_output = tokenizer.decode(output_tokens)
             print(f"{example}: {decoded_output}")
             self.logger.report_text(
                 title=f"decoding_sample/{example}",
@@ -258,14 +295,16 @@ class ConditionalTrainer:
         losses = {}
 
         for i in range(self.gradient_accumulation_steps):
-            batch_copy = copy.deepcopy(processed_batch)
-            for _, tensor in batch_copy:
-                tensor.data = get_ith_chunk(
-                    tensor.data, self.gradient_accumulation_steps, i
-                )
+            # views of the tensors only, the data state attached to the batch is not copied
+            micro_batch = LLMBatch.from_tensors(
+                **{
+                    name: get_ith_chunk(tensor, self.gradient_accumulation_steps, i)
+                    for name, tensor in processed_batch
+                }
+            )
 
             cross_entropy_loss, aux_info = self._calculate_loss(
-                batch=batch_copy,
+                batch=micro_batch,
                 model=self.model,
                 mixed_precision=self.mixed_precision,
                 vocab_size=self.vocab_size,
@@ -302,6 +341,8 @@ class ConditionalTrainer:
             )
         if self.dataset_type == "c4":
             self._log_fraction_dataset_processed(step)
+        if self.dataset_type == "mixture" and step % self.logging_interval_loss == 0:
+            self._log_source_token_counts(step)
         for name, stats in self.loss_accumulators.items():
             if name == "legacy_bert_bugged_loss":
                 bert_legacy_loss = (
@@ -353,6 +394,20 @@ class ConditionalTrainer:
             iteration=step,
         )
 
+    def _log_source_token_counts(self, step):
+        source_token_counts = self.train_dataloader.get_source_token_counts()
+        total = sum(source_token_counts.values())
+        for name, count in source_token_counts.items():
+            self.logger.report_scalar(
+                title=f"data_mixture/{name}_tokens", value=count, iteration=step
+            )
+            if total > 0:
+                self.logger.report_scalar(
+                    title=f"data_mixture/{name}_fraction",
+                    value=count / total,
+                    iteration=step,
+                )
+
     def _log_accuracy(self, aux_info, step):
         self.correct_tokens_accumulator += aux_info["correct_tokens"]
         self.total_tokens_accumulator += aux_info["total_masked_tokens"]
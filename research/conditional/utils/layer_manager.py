@@ -135,7 +135,11 @@ def measure_time(obj: LoggingLayer, instruction_name: str):
     Args:
         obj: The LoggingLayer object that will be used to cache the time.
         instruction_name: The name of the instruction that is being measured.
+    Inside torch.compile nothing is measured, the timers would break the graph and time only the tracing.
     """
+    if torch.compiler.is_compiling():
+        yield
+        return
     if obj.logging_switch and torch.cuda.is_available():
         torch.cuda.synchronize()
     start_time = time.time()
@@ -1,9 +1,11 @@
 from functools import partial
 import torch
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.checkpoint import checkpoint
 
 from lizrd.core import llm
+from lizrd.core.chunked_cross_entropy import chunked_head_cross_entropy
 from lizrd.text.data import LLMBatch
 from lizrd.core.llm import Parallel
 from research.conditional.moe_layers.cont_moe_designs.common_weighted_parameter_matrices import (
@@ -47,13 +49,40 @@ from research.conditional.moe_layers.token_choice import TokenChoiceFF
 from research.conditional.moe_layers.ff_timed import FeedForwardTimed
 
 
-def make_loss_function(loss_checkpoint_chungs: int):
-    if loss_checkpoint_chungs == 0:
+def make_loss_function(
+    loss_checkpoint_chungs: int,
+    loss_vocab_chunk_size: int = 0,
+    head_on_masked_positions_only: bool = False,
+):
+    """
+    With `head_on_masked_positions_only`, e.g. for BERT, the head is applied only where the loss is calculated,
+    unless the loss is checkpointed in chungs.
+    """
+    assert (
+        loss_checkpoint_chungs == 0 or loss_vocab_chunk_size == 0
+    ), "loss_checkpoint_chungs and loss_vocab_chunk_size can't be used together"
+    if head_on_masked_positions_only and loss_checkpoint_chungs == 0:
+        return partial(
+            masked_positions_llm_loss, vocab_chunk_size=loss_vocab_chunk_size
+        )
+    elif loss_vocab_chunk_size > 0:
+        return partial(vocab_chunked_llm_loss, vocab_chunk_size=loss_vocab_chunk_size)
+    elif loss_checkpoint_chungs == 0:
         return calculate_llm_loss
     else:
         return partial(chungized_llm_loss, n_chungs=loss_checkpoint_chungs)
 
 
+def unwrap_model(model: torch.nn.Module) -> torch.nn.Module:
+    return model.module if isinstance(model, DistributedDataParallel) else model
+
+
+def set_document_ids(model: torch.nn.Module, batch: LLMBatch):
+    """Attention layers with `mask_document_boundaries` read the document ids from the forward pass cache."""
+    if getattr(model, "forward_pass_cache", None) is not None:
+        model.forward_pass_cache["document_ids"] = batch.document_ids
+
+
 def chungized_llm_loss(
     batch: LLMBatch,
     model: torch.nn.Module,
@@ -64,6 +93,7 @@ def chungized_llm_loss(
     input_tokens = batch.input_ids
     gt_tokens = batch.target_ids
     mask = batch.should_calculate_loss
+    set_document_ids(model, batch)
 
     def make_custom_forward():
         def custom_forward(*inputs):
@@ -124,6 +154,97 @@ def chungized_llm_loss(
         return total_loss / num_tokens, aux_info
 
 
+def vocab_chunked_llm_loss(
+    batch: LLMBatch,
+    model: torch.nn.Module,
+    mixed_precision: bool,
+    vocab_size: int,
+    vocab_chunk_size: int,
+):
+    """Like `calculate_llm_loss`, but the head and the loss go over the vocabulary in chunks and logits are never materialized."""
+    input_tokens = batch.input_ids
+    gt_tokens = batch.target_ids
+    mask = batch.should_calculate_loss
+    set_document_ids(model, batch)
+
+    with torch.autocast(
+        device_type="cuda", enabled=mixed_precision, dtype=torch.float16
+    ):
+        # through forward, so that DDP sees the encoder; the head's gradients are synced by their hooks
+        encoder_output = model(input_tokens, apply_head=False)
+        token_losses, predictions = chunked_head_cross_entropy(
+            encoder_output, unwrap_model(model).head, gt_tokens, vocab_chunk_size
+        )
+
+    mask = mask.to(token_losses.device)
+    loss = token_losses[mask == 1].mean()
+
+    correct_tokens = predictions == gt_tokens.to(predictions.device).long()
+    correct_tokens = (correct_tokens.long() * mask).sum()
+    total_masked_tokens = mask.sum()
+
+    aux_info = {
+        "correct_tokens": correct_tokens,
+        "total_masked_tokens": total_masked_tokens,
+        "losses": retrieve_additional_losses(model),
+    }
+
+    return loss, aux_info
+
+
+def masked_positions_llm_loss(
+    batch: LLMBatch,
+    model: torch.nn.Module,
+    mixed_precision: bool,
+    vocab_size: int,
+    vocab_chunk_size: int = 0,
+):
+    """
+    Like `calculate_llm_loss`, but the encoder outputs are gathered at positions with `should_calculate_loss`
+    before the head, so for BERT the head runs on ~15% of the tokens. Optionally over vocabulary chunks.
+    """
+    input_tokens = batch.input_ids
+    gt_tokens = batch.target_ids
+    mask = batch.should_calculate_loss
+    set_document_ids(model, batch)
+
+    with torch.autocast(
+        device_type="cuda", enabled=mixed_precision, dtype=torch.float16
+    ):
+        encoder_output = model(input_tokens, apply_head=False)
+        is_masked = mask.to(encoder_output.device) == 1
+        masked_output = encoder_output[is_masked]
+        masked_gt_tokens = gt_tokens.to(encoder_output.device)[is_masked].long()
+        if vocab_chunk_size > 0:
+            mask_loss, predictions = chunked_head_cross_entropy(
+                masked_output,
+                unwrap_model(model).head,
+                masked_gt_tokens,
+                vocab_chunk_size,
+            )
+        else:
+            model_output = unwrap_model(model).head(masked_output)
+
+    if vocab_chunk_size == 0:
+        masked_gt_tokens = masked_gt_tokens.to(model_output.device)
+        mask_loss = F.cross_entropy(
+            model_output.reshape(-1, vocab_size), masked_gt_tokens, reduction="none"
+        )
+        predictions = model_output.argmax(dim=-1)
+    loss = mask_loss.mean()
+
+    correct_tokens = (predictions == masked_gt_tokens.to(predictions.device)).sum()
+    total_masked_tokens = mask.sum()
+
+    aux_info = {
+        "correct_tokens": correct_tokens,
+        "total_masked_tokens": total_masked_tokens,
+        "losses": retrieve_additional_losses(model),
+    }
+
+    return loss, aux_info
+
+
 def calculate_llm_loss(
     batch: LLMBatch,
     model: torch.nn.Module,
@@ -133,6 +254,7 @@ def calculate_llm_loss(
     input_tokens = batch.input_ids
     gt_tokens = batch.target_ids
     mask = batch.should_calculate_loss
+    set_document_ids(model, batch)
 
     with torch.autocast(
         device_type="cuda", enabled=mixed_precision, dtype=torch.float16
@@ -165,13 +287,26 @@ def calculate_llm_loss(
     return loss, aux_info
 
 
+# feedforward layers processing every token on its own, models built with them can decode with a KV cache
+TOKENWISE_FF_MODES = ["vanilla", "vanilla_timed"]
+
+
 def get_attention_layer(args):
     if args.model_type == "gpt":
         attention_layer_fun = lambda: llm.CausalAttention(
-            args.dmodel, args.n_att_heads, args.dhead
+            args.dmodel,
+            args.n_att_heads,
+            args.dhead,
+            mask_document_boundaries=args.mask_document_boundaries,
+            attention_backend=args.attention_backend,
         )
     elif args.model_type == "bert":
-        attention_layer_fun = lambda: llm.Attention(args.dmodel, args.n_att_heads)
+        attention_layer_fun = lambda: llm.Attention(
+            args.dmodel,
+            args.n_att_heads,
+            mask_document_boundaries=args.mask_document_boundaries,
+            attention_backend=args.attention_backend,
+        )
     else:
         raise NotImplementedError(f"Model type {args.model_type} not implemented")
     return attention_layer_fun
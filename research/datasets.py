@@ -1,77 +1,565 @@
 from functools import partial
-from typing import Literal
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Literal, Optional, Tuple
 
+from attr import define
+import numpy as np
 import torch
 from torch.utils.data import DataLoader
 
+from lizrd.core.misc import default
 from lizrd.text import datasets, packers, data, tokenizers
 
+# batches a DataLoader worker prepares ahead, the default `prefetch_factor` of torch
+DATALOADER_PREFETCH_FACTOR = 2
+
+
+class SharedBatchRing:
+    """
+    Preallocated shared-memory slots holding whole batches of shape `(batch_size, sequence_length)`.
+    DataLoader workers write collated batches straight into their slots and send just the slot index,
+    and the main process wraps the slot as tensors without copying.
+    Worker `w` of `num_workers` owns the slots `w, w + num_workers, ...` and writes a slot
+    only after the main process released it, see `DataloaderWrapper`.
+    """
+
+    FIELD_DTYPES = {
+        "input_ids": data.TOKEN_DTYPE,
+        "target_ids": data.TOKEN_DTYPE,
+        "should_calculate_loss": data.LOSS_MASK_DTYPE,
+        "document_ids": data.DOCUMENT_ID_DTYPE,
+    }
+
+    def __init__(
+        self,
+        batch_size: int,
+        sequence_length: int,
+        num_workers: int,
+        slots_per_worker: int,
+    ):
+        self.n_writers = max(num_workers, 1)
+        self.slots_per_worker = slots_per_worker
+        shape = (self.n_writers * slots_per_worker, batch_size, sequence_length)
+        self.tensors = {
+            name: self._make_shared(shape, dtype)
+            for name, dtype in self.FIELD_DTYPES.items()
+        }
+        self.is_busy = torch.zeros(shape[0], dtype=torch.bool).share_memory_()
+        # counted separately in every worker process
+        self.batches_written = 0
+
+    def write(self, examples: List[data.LLMExample], writer_id: int) -> int:
+        slot = writer_id + self.n_writers * (
+            self.batches_written % self.slots_per_worker
+        )
+        while self.is_busy[slot]:
+            time.sleep(1e-4)
+        for name, tensor in self.tensors.items():
+            np.stack([getattr(e, name) for e in examples], out=tensor[slot].numpy())
+        self.is_busy[slot] = True
+        self.batches_written += 1
+        return slot
+
+    def read(self, slot: int) -> data.LLMBatch:
+        return data.LLMBatch.from_tensors(
+            **{name: tensor[slot] for name, tensor in self.tensors.items()}
+        )
+
+    def release(self, slot: int):
+        self.is_busy[slot] = False
+
+    def reset(self):
+        """Only safe when no worker is running."""
+        self.is_busy.zero_()
+        self.batches_written = 0
+
+    @staticmethod
+    def _make_shared(shape: Tuple[int, ...], dtype) -> torch.Tensor:
+        return torch.from_numpy(np.zeros(shape, dtype=dtype)).share_memory_()
+
+
+@define
+class SharedBatchSlot:
+    """What a worker sends instead of a batch when it writes to a `SharedBatchRing`."""
+
+    slot: int
+    data_state: tuple
+
 
 class DataloaderWrapper:
-    def __init__(self, dataloader: DataLoader, device: torch.device):
-        self.generator = iter(dataloader)
-        self.device = device
+    def __init__(
+        self,
+        dataloader: DataLoader,
+        device: torch.device,
+        prefetch_depth: int = 0,
+        ring: Optional[SharedBatchRing] = None,
+    ):
+        """
+        With `prefetch_depth > 0`, a background thread keeps up to `prefetch_depth` batches
+        already transferred to `device`, so that the training step does not wait for the copy.
+        `data_wait_time` counts the seconds spent in `get_batch`, to tell if a run is input-bound.
+        Iteration starts with the first `get_batch`, so `load_state_dict` can be called before it.
+        With `ring`, the dataloader yields `SharedBatchSlot`s, and a batch returned by `get_batch`
+        stays valid only until the next call, when its slot is handed back to the workers.
+        """
+        self.dataloader = dataloader
+        self.device = torch.device(device)
+        if self.device.type == "cuda" and self.device.index is None:
+            # the prefetch thread doesn't share the current device of the main thread
+            self.device = torch.device("cuda", torch.cuda.current_device())
+        self.prefetch_depth = prefetch_depth
+        self.ring = ring
+        self.held_slots: List[Tuple[int, Optional[torch.cuda.Event]]] = []
+        self.data_wait_time = 0.0
+        # seconds from starting the iteration to the first batch, including the start-up of workers
+        # and loading their tokenizers
+        self.startup_time: Optional[float] = None
+        # start-up seconds not returned by `pop_startup_times` yet
+        self.startup_times: Dict[str, float] = {}
+        self.generator = None
+        self.queue: Optional[queue.Queue] = None
+
+        self.batches_count = 0
+        self.worker_states: dict[int, dict] = {}
 
     def get_batch(self) -> data.LLMBatch:
-        return next(self.generator).to(self.device)
+        start = time.time()
+        if self.generator is None:
+            self._start()
+        self._release_held_slots()
+        if self.queue is None:
+            batch, slot = self._unpack(next(self.generator))
+            batch, event = batch.to(self.device), None
+        else:
+            batch, event, slot = self.queue.get()
+            if isinstance(batch, BaseException):
+                raise batch
+            if event is not None:
+                current_stream = torch.cuda.current_stream(self.device)
+                current_stream.wait_event(event)
+                for _, tensor in batch:
+                    # tensors were allocated on the prefetch stream
+                    tensor.record_stream(current_stream)
+        if slot is not None:
+            self.held_slots.append((slot, event))
+        self.data_wait_time += time.time() - start
+        if self.startup_time is None:
+            self.startup_time = time.time() - start
+            self.startup_times["data_startup"] = self.startup_time
+
+        self.batches_count += 1
+        if hasattr(batch, "data_state"):
+            worker_id, worker_state, worker_startup_times = batch.data_state
+            self.worker_states[worker_id] = worker_state
+            for name, seconds in worker_startup_times.items():
+                # workers start up in parallel, the slowest one is what the training waits for
+                self.startup_times[name] = max(
+                    self.startup_times.get(name, 0.0), seconds
+                )
+        return batch
+
+    def pop_startup_times(self) -> Dict[str, float]:
+        """
+        Start-up seconds measured since the last call: `data_startup` of the first batch of an iteration,
+        `data_worker_init` and `tokenizer_load` of the slowest worker.
+        """
+        startup_times, self.startup_times = self.startup_times, {}
+        return startup_times
+
+    def state_dict(self) -> dict:
+        """
+        Packer states of the workers after the last consumed batch, see `get_data_state`.
+        Batches prefetched but not consumed yet are not part of the state.
+        """
+        return {
+            "batches_count": self.batches_count,
+            "num_workers": self._num_workers,
+            "worker_states": dict(self.worker_states),
+        }
+
+    def load_state_dict(self, state_dict: dict):
+        """
+        Continue the stream right after the last batch consumed before `state_dict` was saved.
+        """
+        assert state_dict["num_workers"] == self._num_workers, (
+            f"Data state was saved with {state_dict['num_workers']} workers, "
+            f"can't be resumed with {self._num_workers}"
+        )
+        self._stop()
+        self.batches_count = state_dict["batches_count"]
+        self.worker_states = dict(state_dict["worker_states"])
+
+        packer = self.dataloader.dataset
+        if self._num_workers == 0:
+            if 0 in self.worker_states:
+                packer.load_state_dict(self.worker_states[0])
+        else:
+            # a fresh DataLoader takes the next batch from worker 0, so rotate the workers
+            # to keep the order of batches of the interrupted run
+            next_worker = self.batches_count % self._num_workers
+            original_worker_ids = [
+                (worker_id + next_worker) % self._num_workers
+                for worker_id in range(self._num_workers)
+            ]
+            packer.resume_worker_states = {
+                worker_id: (original_id, self.worker_states.get(original_id))
+                for worker_id, original_id in enumerate(original_worker_ids)
+            }
+
+    def get_source_token_counts(self) -> Dict[str, int]:
+        """
+        Tokens taken from every source of a `MixtureDataset` so far, summed over the workers.
+        Empty for other datasets.
+        """
+        packer = getattr(self.dataloader, "dataset", None)
+        dataset = getattr(packer, "dataset", None)
+        if not isinstance(dataset, datasets.MixtureDataset):
+            return {}
+        counts = sum(
+            (
+                state["dataset"]["source_token_counts"]
+                for state in self.worker_states.values()
+            ),
+            np.zeros(len(dataset.names), dtype=np.int64),
+        )
+        return {name: int(count) for name, count in zip(dataset.names, counts)}
+
+    @property
+    def _num_workers(self) -> int:
+        return getattr(self.dataloader, "num_workers", 0)
 
+    def _unpack(self, item) -> Tuple[data.LLMBatch, Optional[int]]:
+        if not isinstance(item, SharedBatchSlot):
+            return item, None
+        batch = self.ring.read(item.slot)
+        batch.data_state = item.data_state
+        return batch, item.slot
 
-def worker_init_fn(seed, worker_id):
+    def _release_held_slots(self):
+        for slot, event in self.held_slots:
+            if event is not None:
+                # the copy to the device reads the slot asynchronously
+                event.synchronize()
+            self.ring.release(slot)
+        self.held_slots = []
+
+    def _start(self):
+        self.startup_time = None
+        if self.ring is not None:
+            # workers of the previous iterator are gone, their slots are free again
+            self.ring.reset()
+            self.held_slots = []
+        self.generator = iter(self.dataloader)
+        if self.prefetch_depth > 0:
+            self.queue = queue.Queue(maxsize=self.prefetch_depth)
+            self.stop_prefetching = threading.Event()
+            self.prefetch_thread = threading.Thread(target=self._prefetch, daemon=True)
+            self.prefetch_thread.start()
+
+    def _stop(self):
+        if self.queue is not None:
+            self.stop_prefetching.set()
+            while self.prefetch_thread.is_alive():
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self.prefetch_thread.join(timeout=0.01)
+        self.generator = None
+        self.queue = None
+
+    def _prefetch(self):
+        stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        while not self.stop_prefetching.is_set():
+            try:
+                batch, slot = self._unpack(next(self.generator))
+                if stream is None:
+                    self.queue.put((batch.to(self.device), None, slot))
+                else:
+                    with torch.cuda.stream(stream):
+                        batch = batch.to(self.device, non_blocking=True)
+                        event = torch.cuda.Event()
+                        event.record(stream)
+                    self.queue.put((batch, event, slot))
+            except BaseException as e:
+                self.queue.put((e, None, None))
+                return
+
+
+def is_distributed() -> bool:
+    return torch.distributed.is_available() and torch.distributed.is_initialized()
+
+
+def gather_data_states(dataloader: DataloaderWrapper) -> List[dict]:
+    """
+    Data states of all ranks, indexed by rank, every rank streams its own shard.
+    A collective call under `torch.distributed`, every rank has to make it.
+    """
+    state = dataloader.state_dict()
+    if not is_distributed():
+        return [state]
+    states = [None] * torch.distributed.get_world_size()
+    torch.distributed.all_gather_object(states, state)
+    return states
+
+
+def load_rank_data_state(dataloader: DataloaderWrapper, data_states: List[dict]):
+    """Loads the entry of this rank from the result of `gather_data_states`."""
+    rank, world_size = (
+        (torch.distributed.get_rank(), torch.distributed.get_world_size())
+        if is_distributed()
+        else (0, 1)
+    )
+    assert len(data_states) == world_size, (
+        f"Data state was saved with {len(data_states)} ranks, "
+        f"can't be resumed with {world_size}"
+    )
+    dataloader.load_state_dict(data_states[rank])
+
+
+def worker_init_fn(seed, worker_id, rank=0, world_size=1):
+    start = time.time()
     worker_info = torch.utils.data.get_worker_info()
     packer: packers.AbstractPacker = (
         worker_info.dataset
     )  # the dataset copy in this worker process
-    packer.set_rng(seed + worker_id)
+    # after a resume, this worker continues the stream of another worker of the interrupted run
+    original_worker_id, state = packer.resume_worker_states.get(
+        worker_id, (worker_id, None)
+    )
+    packer.set_rng(seed + original_worker_id)
+    packer.worker_id = original_worker_id
+    packer.dataset.set_shard(
+        rank * worker_info.num_workers + original_worker_id,
+        world_size * worker_info.num_workers,
+    )
+    if state is not None:
+        packer.load_state_dict(state)
+    packer.startup_times["data_worker_init"] = time.time() - start
 
 
-def get_processed_dataset(
+def collate_with_state(packer: packers.AbstractPacker, examples) -> data.LLMBatch:
+    """
+    Collate examples and attach the state of the packer that produced them, so that the main process
+    knows where every worker's stream is, see `DataloaderWrapper.state_dict`.
+    """
+    batch = data.LLMBatch(examples)
+    batch.data_state = get_data_state(packer)
+    return batch
+
+
+def collate_into_ring(
+    packer: packers.AbstractPacker, ring: SharedBatchRing, examples
+) -> SharedBatchSlot:
+    worker_info = torch.utils.data.get_worker_info()
+    writer_id = 0 if worker_info is None else worker_info.id
+    slot = ring.write(examples, writer_id)
+    return SharedBatchSlot(slot, get_data_state(packer))
+
+
+def get_data_state(packer: packers.AbstractPacker) -> tuple:
+    """
+    The packer state of the worker, RNG states and keys of pending documents, without any texts or tokens,
+    so it is cheap to send with every batch and a resumed worker loads it without replaying its stream.
+    Start-up times of the worker measured since its previous batch come along.
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    if worker_info is not None:
+        packer = worker_info.dataset
+    startup_times, packer.startup_times = packer.startup_times, {}
+    return packer.worker_id, packer.state_dict(), startup_times
+
+
+def wrap_packer(
+    packer: packers.AbstractPacker,
     batch_size: int,
-    sequence_length: int,
     device: torch.device,
     num_workers: int,
     seed: int,
-    model_type: Literal["bert", "gpt"] = "bert",
-    dataset_type: Literal["wikibook", "c4"] = "wikibook",
-    use_dummy_dataset: bool = False,
-    dataset_split: str = "train",
-):
+    prefetch_depth: int = 0,
+    rank: int = 0,
+    world_size: int = 1,
+    shared_memory_batches: bool = False,
+) -> DataloaderWrapper:
+    """
+    Every (rank, worker) pair samples from a disjoint shard of the dataset,
+    workers set their shard in `worker_init_fn`.
+    With `shared_memory_batches`, workers pass batches through a `SharedBatchRing`.
+    """
+    if num_workers == 0:
+        packer.dataset.set_shard(rank, world_size)
+    ring = None
+    if shared_memory_batches:
+        # a worker runs up to `DATALOADER_PREFETCH_FACTOR` batches ahead, while the main process holds
+        # the batch being trained on, up to `prefetch_depth` prefetched ones and one being prefetched
+        ring = SharedBatchRing(
+            batch_size,
+            packer.sequence_length,
+            num_workers,
+            slots_per_worker=DATALOADER_PREFETCH_FACTOR + prefetch_depth + 2,
+        )
+        collate_fn = partial(collate_into_ring, packer, ring)
+    else:
+        collate_fn = partial(collate_with_state, packer)
+    dataloader = DataLoader(
+        packer,
+        num_workers=num_workers,
+        batch_size=batch_size,
+        collate_fn=collate_fn,
+        worker_init_fn=partial(worker_init_fn, seed, rank=rank, world_size=world_size),
+        shuffle=False,
+        # slots of the ring are not pinned, pinning would copy every batch again
+        pin_memory=not shared_memory_batches,
+    )
+
+    return DataloaderWrapper(
+        dataloader, device, prefetch_depth=prefetch_depth, ring=ring
+    )
+
+
+def get_text_dataset(
+    dataset_type: Literal["wikibook", "c4", "local"],
+    use_dummy_dataset: bool,
+    split: str,
+    dataset_path: Optional[str] = None,
+) -> datasets.AbstractDataset:
     if dataset_type == "wikibook":
-        dataset = datasets.WikiBookDataset(
+        return datasets.WikiBookDataset(
             use_dummy_dataset=use_dummy_dataset,
-            split=dataset_split,
+            split=split,
         )
     elif dataset_type == "c4":
         if use_dummy_dataset:
             print("WARNING: Dummy dataset not supported for C4 dataset")
-        dataset = datasets.C4Dataset(
-            split=dataset_split,
+        return datasets.C4Dataset(
+            split=split,
         )
+    elif dataset_type == "local":
+        assert dataset_path is not None, "local dataset requires dataset_path"
+        return datasets.LocalCorpusDataset(dataset_path, split=split)
     else:
         raise ValueError(f"Unknown dataset type: {dataset_type}")
 
+
+def parse_dataset_mixture(dataset_mixture: str) -> List[Tuple[str, float]]:
+    """Parses a mixture given as `name:weight,name:weight`, e.g. `wikibook:0.3,c4:0.7`."""
+    sources = []
+    for source in dataset_mixture.split(","):
+        name, weight = source.split(":")
+        sources.append((name.strip(), float(weight)))
+    return sources
+
+
+def get_mixture_dataset(
+    dataset_mixture: str,
+    use_dummy_dataset: bool,
+    split: str,
+    dataset_path: Optional[str] = None,
+) -> datasets.MixtureDataset:
+    """A `local` source of the mixture reads the corpus in `dataset_path`."""
+    names, weights = zip(*parse_dataset_mixture(dataset_mixture))
+    return datasets.MixtureDataset(
+        [
+            get_text_dataset(name, use_dummy_dataset, split, dataset_path)
+            for name in names
+        ],
+        list(weights),
+        names=list(names),
+    )
+
+
+def get_packer(
+    model_type: Literal["bert", "gpt"],
+    dataset: datasets.AbstractDataset,
+    sequence_length: int,
+    streaming_packer: bool = False,
+    tokenization_batch_size: int = 64,
+    tokenizer_maker: Optional[Callable[[], tokenizers.AbstractTokenizer]] = None,
+) -> packers.AbstractPacker:
     if model_type == "bert":
         packer = packers.BERTPacker(
             sequence_length=sequence_length,
             dataset=dataset,
-            tokenizer_maker=tokenizers.BertTokenizer,
+            tokenizer_maker=default(tokenizer_maker, tokenizers.BertTokenizer),
+            tokenization_batch_size=tokenization_batch_size,
+        )
+    elif model_type == "gpt" and streaming_packer:
+        packer = packers.StreamingGPTPacker(
+            sequence_length=sequence_length,
+            dataset=dataset,
+            tokenizer_maker=default(tokenizer_maker, tokenizers.GPTTokenizer),
+            tokenization_batch_size=tokenization_batch_size,
         )
     elif model_type == "gpt":
         packer = packers.GPTPacker(
             sequence_length=sequence_length,
             dataset=dataset,
-            tokenizer_maker=tokenizers.GPTTokenizer,
+            tokenizer_maker=default(tokenizer_maker, tokenizers.GPTTokenizer),
+            tokenization_batch_size=tokenization_batch_size,
         )
     else:
         raise ValueError(f"Unknown model type: {model_type}")
+    return packer
 
-    dataloader = DataLoader(
+
+def get_processed_dataset(
+    batch_size: int,
+    sequence_length: int,
+    device: torch.device,
+    num_workers: int,
+    seed: int,
+    model_type: Literal["bert", "gpt"] = "bert",
+    dataset_type: Literal[
+        "wikibook", "c4", "local", "pretokenized", "mixture"
+    ] = "wikibook",
+    use_dummy_dataset: bool = False,
+    dataset_split: str = "train",
+    dataset_path: Optional[str] = None,
+    streaming_packer: bool = False,
+    tokenization_batch_size: int = 64,
+    prefetch_depth: int = 0,
+    rank: int = 0,
+    world_size: int = 1,
+    shared_memory_batches: bool = False,
+    dataset_mixture: Optional[str] = None,
+):
+    if dataset_type in ["wikibook", "c4", "local"]:
+        dataset = get_text_dataset(
+            dataset_type, use_dummy_dataset, dataset_split, dataset_path
+        )
+    elif dataset_type == "pretokenized":
+        assert dataset_path is not None, "pretokenized dataset requires dataset_path"
+        dataset = datasets.PretokenizedDataset(dataset_path, split=dataset_split)
+        if dataset.tokenizer_name != model_type:
+            raise ValueError(
+                f"Shards in {dataset_path} were tokenized for {dataset.tokenizer_name}, not {model_type}"
+            )
+    elif dataset_type == "mixture":
+        assert dataset_mixture is not None, "mixture dataset requires dataset_mixture"
+        dataset = get_mixture_dataset(
+            dataset_mixture, use_dummy_dataset, dataset_split, dataset_path
+        )
+    else:
+        raise ValueError(f"Unknown dataset type: {dataset_type}")
+
+    packer = get_packer(
+        model_type,
+        dataset,
+        sequence_length,
+        streaming_packer=streaming_packer,
+        tokenization_batch_size=tokenization_batch_size,
+    )
+
+    return wrap_packer(
         packer,
-        num_workers=num_workers,
         batch_size=batch_size,
-        collate_fn=data.LLMBatch,
-        worker_init_fn=partial(worker_init_fn, seed),
-        shuffle=False,
-        pin_memory=True,
+        device=device,
+        num_workers=num_workers,
+        seed=seed,
+        prefetch_depth=prefetch_depth,
+        rank=rank,
+        world_size=world_size,
+        shared_memory_batches=shared_memory_batches,
     )
-
-    return DataloaderWrapper(dataloader, device)
@@ -5,6 +5,7 @@ import torch
 
 from lizrd.core import llm, misc
 from lizrd.datasets.wikibookdata import get_processed_dataset
+from lizrd.datasets.prepacked_eval import PrepackedEvalSet
 from lizrd.scripts.grid_utils import get_machine_backend, MachineBackend
 from research.reinitialization.core import linears, linears_loss, linears_plusminus
 from research.reinitialization.core import linears_recycle
@@ -46,6 +47,12 @@ parser.add_argument("--trainer_type", type=str, default="regular")
 parser.add_argument("--tags", nargs="*", type=str, default=None)
 parser.add_argument("--ds_seed", type=int, default=42)
 parser.add_argument("--eval_ds_seed", type=int, default=1984)
+parser.add_argument(
+    "--eval_set_path",
+    type=str,
+    default=None,
+    help="eval set saved by lizrd.scripts.pack_eval_set, used instead of --eval_ds_seed batches",
+)
 parser.add_argument("--retrain_ds_seed", type=int, default=1998)
 
 parser.add_argument("--batch_size", type=str, default=64)
@@ -286,15 +293,18 @@ pdataset = get_processed_dataset(
     seed=args.ds_seed,
     model_type=args.model_type,
 )
-eval_pdataset = get_processed_dataset(
-    batch_size=args.batch_size,
-    max_total_length=args.cutoff,
-    mask_percent=args.mask_percent,
-    device=DEVICE,
-    num_workers=1,
-    seed=args.eval_ds_seed,
-    model_type=args.model_type,
-)
+if args.eval_set_path is not None:
+    eval_pdataset = PrepackedEvalSet(args.eval_set_path, DEVICE)
+else:
+    eval_pdataset = get_processed_dataset(
+        batch_size=args.batch_size,
+        max_total_length=args.cutoff,
+        mask_percent=args.mask_percent,
+        device=DEVICE,
+        num_workers=1,
+        seed=args.eval_ds_seed,
+        model_type=args.model_type,
+    )
 
 if args.model_type == "bert":
     attention_layer_fun = lambda: llm.Attention(
@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data import DataLoader
+
+from lizrd.support.test_utils import GeneralTestCase
+from lizrd.text.data import LLMBatch
+from lizrd.text.packers import GPTPacker, StreamingGPTPacker
+from lizrd.text.datasets import ListDataset
+from lizrd.text.test_utils import make_documents
+from lizrd.text.bench import DummyGPTTokenizer
+from research.datasets import (
+    DataloaderWrapper,
+    gather_data_states,
+    get_mixture_dataset,
+    load_rank_data_state,
+    wrap_packer,
+)
+
+
+def make_dataloader(seed: int) -> DataLoader:
+    packer = GPTPacker(32, ListDataset(make_documents(50)), DummyGPTTokenizer, seed)
+    return DataLoader(packer, batch_size=4, collate_fn=LLMBatch)
+
+
+class TestDataloaderWrapper(GeneralTestCase):
+    def test_prefetching_keeps_order(self):
+        device = torch.device("cpu")
+        synchronous = DataloaderWrapper(make_dataloader(0), device)
+        prefetching = DataloaderWrapper(make_dataloader(0), device, prefetch_depth=3)
+        for _ in range(10):
+            self.assertTensorEqual(
+                synchronous.get_batch().input_ids, prefetching.get_batch().input_ids
+            )
+        self.assertGreater(prefetching.data_wait_time, 0.0)
+
+    def test_errors_are_propagated(self):
+        def failing_dataloader():
+            raise RuntimeError("worker failed")
+            yield
+
+        wrapper = DataloaderWrapper(
+            failing_dataloader(), torch.device("cpu"), prefetch_depth=2
+        )
+        with self.assertRaises(RuntimeError):
+            wrapper.get_batch()
+
+
+class TestResumableDataStream(GeneralTestCase):
+    def _make_wrapper(
+        self, packer_class, num_workers, prefetch_depth=0, shared_memory=False
+    ):
+        packer = packer_class(32, ListDataset(make_documents(50)), DummyGPTTokenizer)
+        return wrap_packer(
+            packer,
+            batch_size=2,
+            device=torch.device("cpu"),
+            num_workers=num_workers,
+            seed=7,
+            prefetch_depth=prefetch_depth,
+            shared_memory_batches=shared_memory,
+        )
+
+    def _check_resume(
+        self, packer_class, num_workers, prefetch_depth=0, shared_memory=False
+    ):
+        original = self._make_wrapper(
+            packer_class, num_workers, prefetch_depth, shared_memory
+        )
+        for _ in range(5):
+            original.get_batch()
+        state = original.state_dict()
+        # batches from shared memory are only valid until the next `get_batch`
+        expected = [original.get_batch().input_ids.clone() for _ in range(4)]
+
+        resumed = self._make_wrapper(
+            packer_class, num_workers, prefetch_depth, shared_memory
+        )
+        resumed.load_state_dict(state)
+        for expected_input_ids in expected:
+            self.assertTensorEqual(resumed.get_batch().input_ids, expected_input_ids)
+
+    def test_resume_does_not_regenerate_samples(self):
+        for packer_class in [GPTPacker, StreamingGPTPacker]:
+            original = self._make_wrapper(packer_class, num_workers=0)
+            for _ in range(5):
+                original.get_batch()
+            state = original.state_dict()
+            # documents are kept as keys, not as texts or tokens
+            document_keys = state["worker_states"][0]["document_keys"]
+            self.assertTrue(all(isinstance(key, int) for key in document_keys))
+            expected = [original.get_batch().input_ids for _ in range(3)]
+
+            resumed = self._make_wrapper(packer_class, num_workers=0)
+            packer = resumed.dataloader.dataset
+            get_sample = packer.get_sample
+            n_samples = [0]
+
+            def counting_get_sample():
+                n_samples[0] += 1
+                return get_sample()
+
+            packer.get_sample = counting_get_sample
+            resumed.load_state_dict(state)
+            self.assertEqual(n_samples[0], 0)
+            for expected_input_ids in expected:
+                self.assertTensorEqual(
+                    resumed.get_batch().input_ids, expected_input_ids
+                )
+            # only the samples of the new batches
+            self.assertEqual(n_samples[0], 3 * 2)
+
+    def test_startup_times_reported_once_per_start(self):
+        wrapper = self._make_wrapper(GPTPacker, num_workers=2)
+        for _ in range(2):
+            wrapper.get_batch()
+        startup_times = wrapper.pop_startup_times()
+        self.assertSetEqual(
+            set(startup_times), {"data_startup", "data_worker_init", "tokenizer_load"}
+        )
+        self.assertTrue(all(seconds >= 0 for seconds in startup_times.values()))
+        wrapper.get_batch()
+        self.assertDictEqual(wrapper.pop_startup_times(), {})
+
+        # resumed workers start up again
+        wrapper.load_state_dict(wrapper.state_dict())
+        for _ in range(2):
+            wrapper.get_batch()
+        self.assertSetEqual(
+            set(wrapper.pop_startup_times()),
+            {"data_startup", "data_worker_init", "tokenizer_load"},
+        )
+
+    def test_resume_in_main_process(self):
+        self._check_resume(GPTPacker, num_workers=0)
+        self._check_resume(StreamingGPTPacker, num_workers=0, prefetch_depth=2)
+
+    def test_resume_with_workers(self):
+        self._check_resume(GPTPacker, num_workers=2)
+        self._check_resume(StreamingGPTPacker, num_workers=3, prefetch_depth=2)
+
+    def test_resume_with_shared_memory(self):
+        self._check_resume(GPTPacker, num_workers=0, shared_memory=True)
+        self._check_resume(
+            StreamingGPTPacker, num_workers=2, prefetch_depth=2, shared_memory=True
+        )
+
+    def test_shared_memory_matches_default_transport(self):
+        for num_workers, prefetch_depth in [(2, 0), (3, 2)]:
+            default = self._make_wrapper(GPTPacker, num_workers, prefetch_depth)
+            shared = self._make_wrapper(
+                GPTPacker, num_workers, prefetch_depth, shared_memory=True
+            )
+            for _ in range(20):
+                expected = default.get_batch()
+                batch = shared.get_batch()
+                for name, tensor in expected:
+                    self.assertTensorEqual(getattr(batch, name), tensor)
+
+    def test_resume_after_iteration_started(self):
+        wrapper = self._make_wrapper(StreamingGPTPacker, num_workers=2)
+        for _ in range(3):
+            wrapper.get_batch()
+        state = wrapper.state_dict()
+        expected = wrapper.get_batch().input_ids
+        for _ in range(3):
+            wrapper.get_batch()
+        wrapper.load_state_dict(state)
+        self.assertTensorEqual(wrapper.get_batch().input_ids, expected)
+
+
+def make_rank_wrapper(rank: int, world_size: int) -> DataloaderWrapper:
+    packer = StreamingGPTPacker(32, ListDataset(make_documents(50)), DummyGPTTokenizer)
+    return wrap_packer(
+        packer,
+        batch_size=2,
+        device=torch.device("cpu"),
+        num_workers=0,
+        seed=7,
+        rank=rank,
+        world_size=world_size,
+    )
+
+
+def resume_on_rank(rank: int, world_size: int, port: int):
+    torch.distributed.init_process_group(
+        "gloo",
+        init_method=f"tcp://127.0.0.1:{port}",
+        rank=rank,
+        world_size=world_size,
+    )
+    try:
+        original = make_rank_wrapper(rank, world_size)
+        for _ in range(3):
+            original.get_batch()
+        data_states = gather_data_states(original)
+        expected = [original.get_batch().input_ids for _ in range(3)]
+        # the ranks stream different shards, so their states differ
+        assert len(data_states) == world_size
+        assert (
+            data_states[0]["worker_states"][0]["token_buffer"]["document_keys"]
+            != data_states[1]["worker_states"][0]["token_buffer"]["document_keys"]
+        )
+
+        resumed = make_rank_wrapper(rank, world_size)
+        load_rank_data_state(resumed, data_states)
+        for expected_input_ids in expected:
+            assert torch.equal(resumed.get_batch().input_ids, expected_input_ids)
+    finally:
+        torch.distributed.destroy_process_group()
+
+
+class TestRankSharding(GeneralTestCase):
+    def test_every_rank_resumes_its_own_stream(self):
+        world_size = 2
+        mp.spawn(resume_on_rank, args=(world_size, 29513), nprocs=world_size)
+
+    def test_ranks_read_disjoint_documents(self):
+        # every document is a single word, so it's a single distinct token
+        documents = ["a" * length for length in range(1, 121)]
+        tokenizer = DummyGPTTokenizer()
+        world_size = 2
+        tokens_per_rank = []
+        for rank in range(world_size):
+            packer = GPTPacker(32, ListDataset(documents), DummyGPTTokenizer)
+            wrapper = wrap_packer(
+                packer,
+                batch_size=4,
+                device=torch.device("cpu"),
+                num_workers=2,
+                seed=7,
+                rank=rank,
+                world_size=world_size,
+            )
+            tokens = set()
+            for _ in range(10):
+                tokens.update(wrapper.get_batch().input_ids.flatten().tolist())
+            tokens.discard(tokenizer.eot_id)
+            tokens_per_rank.append(tokens)
+
+        self.assertGreater(len(tokens_per_rank[0]), 0)
+        self.assertGreater(len(tokens_per_rank[1]), 0)
+        self.assertEqual(len(tokens_per_rank[0] & tokens_per_rank[1]), 0)
+
+
+class TestMixtureDataset(GeneralTestCase):
+    def test_local_source_reads_dataset_path(self):
+        documents = make_documents(20)
+        with tempfile.TemporaryDirectory() as path:
+            with open(os.path.join(path, "part_0.jsonl"), "w") as f:
+                for document in documents:
+                    f.write(json.dumps({"text": document}) + "\n")
+            mixture = get_mixture_dataset("local:1", False, "train", dataset_path=path)
+            self.assertListEqual(mixture.names, ["local"])
+            sampled = mixture.get_documents(10)
+            self.assertTrue(all(document in documents for document in sampled))
@@ -0,0 +1,73 @@
+"""
+Overhead of the ash shape checks, a training step of a small model with many blocks with checks enabled and disabled.
+
+Example:
+    python -m research.timing.ash_time --n_blocks 4,16,32 --dmodel 64 --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from lizrd.core import llm
+from lizrd.support import ash
+from lizrd.train.train_utils import get_model
+
+
+def measure(args, n_blocks: int, checks_enabled: bool) -> dict:
+    device = torch.device(args.device)
+    model = get_model(
+        max_length=args.cutoff,
+        vocab_size=args.vocab_size,
+        ff_layer_fun=lambda: llm.FeedForward(args.dmodel, 4 * args.dmodel),
+        attention_layer_fun=lambda: llm.CausalAttention(
+            args.dmodel, args.n_att_heads, attention_backend="sdpa"
+        ),
+        dm=args.dmodel,
+        n_blocks=n_blocks,
+        device=device,
+    )
+    tokens = torch.randint(args.vocab_size, (args.batch_size, args.cutoff)).to(device)
+    ash.set_checks_enabled(checks_enabled)
+    try:
+        for i in range(args.warmup + args.n_steps):
+            if i == args.warmup:
+                if device.type == "cuda":
+                    torch.cuda.synchronize(device)
+                start = time.time()
+            model(tokens).sum().backward()
+        if device.type == "cuda":
+            torch.cuda.synchronize(device)
+    finally:
+        ash.set_checks_enabled(True)
+    return {
+        "n_blocks": n_blocks,
+        "checks_enabled": checks_enabled,
+        "ms_per_step": (time.time() - start) / args.n_steps * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--cutoff", type=int, default=32)
+    parser.add_argument(
+        "--n_blocks", type=lambda s: [int(x) for x in s.split(",")], default=[4, 32]
+    )
+    parser.add_argument("--dmodel", type=int, default=64)
+    parser.add_argument("--n_att_heads", type=int, default=4)
+    parser.add_argument("--vocab_size", type=int, default=1000)
+    parser.add_argument("--n_steps", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=5)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    for n_blocks in args.n_blocks:
+        for checks_enabled in [True, False]:
+            print(measure(args, n_blocks, checks_enabled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,66 @@
+"""
+Compares the attention backends, forward and backward of a single attention layer.
+
+Example:
+    python -m research.timing.attention_time --cutoff 256,1024,2048 --device cpu
+"""
+import argparse
+import time
+
+import torch
+
+from lizrd.core import llm
+
+
+def measure(args, attention_backend: str, cutoff: int) -> dict:
+    device = torch.device(args.device)
+    layer_class = llm.CausalAttention if args.causal else llm.Attention
+    layer = layer_class(
+        args.dmodel, args.n_att_heads, attention_backend=attention_backend
+    ).to(device)
+    x = torch.randn(
+        args.batch_size, cutoff, args.dmodel, device=device, requires_grad=True
+    )
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(args.warmup + args.n_steps):
+        if i == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.time()
+        layer(x).sum().backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    result = {
+        "backend": attention_backend,
+        "cutoff": cutoff,
+        "ms_per_step": (time.time() - start) / args.n_steps * 1000,
+    }
+    if device.type == "cuda":
+        result["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument(
+        "--cutoff", type=lambda s: [int(x) for x in s.split(",")], default=[256, 1024]
+    )
+    parser.add_argument("--dmodel", type=int, default=512)
+    parser.add_argument("--n_att_heads", type=int, default=8)
+    parser.add_argument("--causal", action="store_true")
+    parser.add_argument("--n_steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    for cutoff in args.cutoff:
+        for attention_backend in llm.ATTENTION_BACKENDS:
+            print(measure(args, attention_backend, cutoff))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Step time and activation memory of the gradient checkpointing policies, `auto` for fractions of the memory
+taken by activations without checkpointing.
+
+Example:
+    python -m research.timing.checkpointing_time --n_blocks 8 --dmodel 256 --cutoff 256 --budgets 0.25,0.5,0.75
+"""
+import argparse
+import time
+
+import torch
+
+from lizrd.core import llm
+from lizrd.core.checkpointing import (
+    apply_checkpointing_policy,
+    fit_checkpointing_to_memory_budget,
+    get_checkpoints,
+    measure_checkpoints,
+)
+from lizrd.train.train_utils import get_model
+
+
+def measure_step(args, model, tokens) -> dict:
+    device = tokens.device
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+    for i in range(args.warmup + args.n_steps):
+        if i == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.time()
+        model(tokens).sum().backward()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    result = {"ms_per_step": (time.time() - start) / args.n_steps * 1000}
+    if device.type == "cuda":
+        result["peak_memory_mb"] = torch.cuda.max_memory_allocated(device) / 2**20
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--cutoff", type=int, default=256)
+    parser.add_argument("--dmodel", type=int, default=256)
+    parser.add_argument("--n_att_heads", type=int, default=4)
+    parser.add_argument("--n_blocks", type=int, default=8)
+    parser.add_argument("--vocab_size", type=int, default=1000)
+    parser.add_argument(
+        "--budgets", type=lambda s: [float(x) for x in s.split(",")], default=[0.5]
+    )
+    parser.add_argument("--n_steps", type=int, default=5)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = get_model(
+        max_length=args.cutoff,
+        vocab_size=args.vocab_size,
+        ff_layer_fun=lambda: llm.FeedForward(args.dmodel, 4 * args.dmodel),
+        attention_layer_fun=lambda: llm.CausalAttention(args.dmodel, args.n_att_heads),
+        dm=args.dmodel,
+        n_blocks=args.n_blocks,
+        device=device,
+        gradient_checkpointing=True,
+    )
+    tokens = torch.randint(args.vocab_size, (args.batch_size, args.cutoff)).to(device)
+    stats = measure_checkpoints(model, tokens[:1], batch_size=args.batch_size)
+    total_bytes = sum(stat["bytes"] for stat in stats.values())
+
+    def report(name: str):
+        checkpointed = [c for c in get_checkpoints(model) if c.enabled]
+        freed_bytes = sum(stats[checkpoint]["bytes"] for checkpoint in checkpointed)
+        print(
+            {
+                "policy": name,
+                "n_checkpointed": len(checkpointed),
+                "activation_mb": (total_bytes - freed_bytes) / 2**20,
+                **measure_step(args, model, tokens),
+            }
+        )
+
+    for checkpoint in get_checkpoints(model):
+        checkpoint.enabled = False
+    report("none")
+    for policy in ["all", "attention", "feedforward"]:
+        apply_checkpointing_policy(model, policy)
+        report(policy)
+    apply_checkpointing_policy(model, "every_k_blocks", every_k_blocks=2)
+    report("every_2_blocks")
+    for budget in args.budgets:
+        fit_checkpointing_to_memory_budget(
+            model, tokens, int(budget * total_bytes), stats=stats
+        )
+        report(f"auto_{budget}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+"""
+Compares eager and `torch.compile`d training steps of the model of `cc_train`, for every given `--ff_modes`.
+Arguments not listed below are passed to the `cc_train` parser, to configure the feedforward layers.
+
+Example:
+    python -m research.timing.compile_time --ff_modes vanilla,expert_choice,token_choice --device cpu \\
+        --dmodel 256 --dff 1024 --n_blocks 4 --n_experts 8 --expert_size 128 --topk_fraction 0.25
+"""
+import argparse
+import time
+
+import torch
+
+from lizrd.core.misc import propagate_forward_pass_cache
+from lizrd.train.train_utils import get_model
+from research.conditional.utils.argparse import introduce_parser_arguments
+from research.conditional.utils.model_utils import get_attention_layer, get_ff_layer
+
+VOCAB_SIZE = 30522
+
+
+def measure(args, model_args, compiled: bool) -> dict:
+    device = torch.device(args.device)
+    model = get_model(
+        max_length=model_args.cutoff,
+        vocab_size=VOCAB_SIZE,
+        ff_layer_fun=get_ff_layer(model_args),
+        attention_layer_fun=get_attention_layer(model_args),
+        dm=model_args.dmodel,
+        n_blocks=model_args.n_blocks,
+        device=device,
+        torch_compile=compiled,
+    )
+    # MoE layers keep their auxiliary losses in the cache, like in `ConditionalTrainer`
+    propagate_forward_pass_cache(model)
+    tokens = torch.randint(VOCAB_SIZE, (args.batch_size, model_args.cutoff)).to(device)
+
+    def step():
+        model(tokens).sum().backward()
+        model.forward_pass_cache.clear()
+
+    # the first step of the compiled model includes the compilation
+    start = time.time()
+    step()
+    first_step_time = time.time() - start
+    for i in range(args.warmup + args.n_steps):
+        if i == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize(device)
+            start = time.time()
+        step()
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return {
+        "ff_mode": model_args.ff_mode,
+        "compiled": compiled,
+        "first_step_s": first_step_time,
+        "ms_per_step": (time.time() - start) / args.n_steps * 1000,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ff_modes", type=lambda s: s.split(","), default=["vanilla"])
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--n_steps", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args, model_argv = parser.parse_known_args()
+    model_parser = introduce_parser_arguments(argparse.ArgumentParser())
+
+    for ff_mode in args.ff_modes:
+        for compiled in [False, True]:
+            model_args = model_parser.parse_args(model_argv + ["--ff_mode", ff_mode])
+            print(measure(args, model_args, compiled))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""
+Compares the default DataLoader transport of batches with `--shared_memory_batches`.
+
+Example:
+    python -m research.timing.dataloader_time --batch_size 256 --cutoff 1024 --num_workers 4
+"""
+import argparse
+import time
+
+import numpy as np
+import torch
+
+from lizrd.text.data import LLMExample
+from lizrd.text.packers import AbstractPacker
+from lizrd.text.datasets import ListDataset
+from lizrd.text.bench import DummyGPTTokenizer
+from research.datasets import wrap_packer
+
+
+class RandomTokensPacker(AbstractPacker):
+    """Packs random tokens, so that the benchmark measures the transport and not tokenization."""
+
+    def get_sample(self) -> LLMExample:
+        tokens = self.np_rng.integers(
+            DummyGPTTokenizer.VOCAB_SIZE, size=self.sequence_length + 1
+        )
+        return LLMExample(
+            tokens[:-1], tokens[1:], np.ones(self.sequence_length, dtype=np.uint8)
+        )
+
+
+def measure(args, shared_memory: bool) -> float:
+    packer = RandomTokensPacker(args.cutoff, ListDataset([""]), DummyGPTTokenizer)
+    wrapper = wrap_packer(
+        packer,
+        batch_size=args.batch_size,
+        device=torch.device(args.device),
+        num_workers=args.num_workers,
+        seed=0,
+        prefetch_depth=args.prefetch_depth,
+        shared_memory_batches=shared_memory,
+    )
+    for _ in range(args.warmup):
+        wrapper.get_batch()
+    start = time.time()
+    for _ in range(args.n_batches):
+        wrapper.get_batch()
+    return args.n_batches / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch_size", type=int, default=256)
+    parser.add_argument("--cutoff", type=int, default=1024)
+    parser.add_argument("--num_workers", type=int, default=4)
+    parser.add_argument("--prefetch_depth", type=int, default=0)
+    parser.add_argument("--n_batches", type=int, default=200)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument(
+        "--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu"
+    )
+    args = parser.parse_args()
+
+    for name, shared_memory in [("default", False), ("shared memory", True)]:
+        batches_per_second = measure(args, shared_memory)
+        tokens_per_second = batches_per_second * args.batch_size * args.cutoff
+        print(
+            f"{name}: {batches_per_second:.1f} batches/s, {tokens_per_second / 1e6:.2f}M tokens/s"
+        )
+
+
+if __name__ == "__main__":
+    main()